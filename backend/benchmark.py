@@ -0,0 +1,102 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Add the backend directory to sys.path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
+
+from main import process_batch
+from utils.concurrency import plan_concurrency, get_cpu_count
+
+def default_worker_counts(cores):
+    """
+    Description:
+    Powers of two from one worker up to the core count, and the core count itself.
+
+    Parameters:
+    cores (int): The number of usable cores.
+
+    Returns:
+    list of int: The worker counts.
+    """
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+def benchmark_batch(paths, worker_counts, threads=None, repeat=1, keep_directory=None):
+    """
+    Description:
+    Times process_batch() over the same scans with each number of workers. Every run writes to a fresh destination
+    directory, so no run resumes from the journal of another, and the directory is removed afterwards unless
+    keep_directory is given. The fastest of repeat runs is kept for each worker count.
+
+    Parameters:
+    paths (list of str): The paths to the point clouds of the batch.
+    worker_counts (list of int): The numbers of worker processes to time.
+    threads (int, Default = None): Threads per worker, derived from the core count for each worker count if None.
+    repeat (int, Default = 1): Runs per worker count.
+    keep_directory (str, Default = None): Directory the outputs of every run are kept in, under workers_<n>_run_<i>.
+
+    Returns:
+    list of dict: Per worker count the 'workers', the 'threads' planned for them, the fastest run in 'seconds'
+        and the number of trees that 'failed' in it.
+    """
+    timings = []
+    for workers in worker_counts:
+        _, planned_threads = plan_concurrency(len(paths), workers, threads)
+        best = None
+        for run in range(repeat):
+            if keep_directory:
+                destination_directory = os.path.join(keep_directory, f"workers_{workers}_run_{run}")
+                shutil.rmtree(destination_directory, ignore_errors=True)
+                os.makedirs(destination_directory)
+            else:
+                destination_directory = tempfile.mkdtemp(prefix="pinecone_benchmark_")
+            try:
+                start = time.perf_counter()
+                results = process_batch(paths, destination_directory, workers, threads)
+                seconds = time.perf_counter() - start
+            finally:
+                if not keep_directory:
+                    shutil.rmtree(destination_directory, ignore_errors=True)
+            failed = sum(1 for _, metrics in results if metrics is None)
+            print(f"{workers} workers x {planned_threads} threads, run {run + 1}: {seconds:.1f} s, {failed} failed", flush=True)
+            if best is None or seconds < best['seconds']:
+                best = {'workers': workers, 'threads': planned_threads, 'seconds': seconds, 'failed': failed}
+        timings.append(best)
+    return timings
+
+def main():
+    """
+    Description:
+    Command line entry point of the batch benchmark.
+    """
+    parser = argparse.ArgumentParser(description="Time batch processing of point clouds with several numbers of workers.")
+    parser.add_argument("path", nargs="+", help="Paths to the point clouds of the batch")
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="Numbers of worker processes to time, powers of two up to the core count by default")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads per worker, derived from the core count by default")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per number of workers, the fastest is reported")
+    parser.add_argument("--keep", default=None, help="Keep the outputs of every run in this directory instead of discarding them")
+    args = parser.parse_args()
+
+    if args.repeat < 1 or (args.workers and min(args.workers) < 1):
+        parser.error("--repeat and --workers must be at least 1")
+    worker_counts = args.workers or default_worker_counts(get_cpu_count())
+
+    timings = benchmark_batch(args.path, worker_counts, args.threads, args.repeat, args.keep)
+    baseline = timings[0]['seconds']
+    print(f"\n{'Workers':>8} {'Threads':>8} {'Seconds':>9} {'Trees/min':>10} {'Speedup':>8} {'Failed':>7}")
+    for timing in timings:
+        print(f"{timing['workers']:>8} {timing['threads']:>8} {timing['seconds']:>9.1f} "
+              f"{len(args.path) * 60 / timing['seconds']:>10.1f} {baseline / timing['seconds']:>7.2f}x {timing['failed']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+# The client deliberately imports nothing from the backend, so it starts in milliseconds instead of loading Open3D
+
+def submit(server, path, upload=False, destination=None):
+    """
+    Description:
+    Queues a scan on a running processing service, see service.py.
+
+    Parameters:
+    server (str): The base URL of the service.
+    path (str): The path to the scan.
+    upload (bool, Default = False): Send the file itself rather than its path, for services on another machine.
+    destination (str, Default = None): The destination directory on the service's machine.
+
+    Returns:
+    dict: The queued job.
+    """
+    if upload:
+        with open(path, "rb") as file:
+            request = Request(f"{server}/jobs?filename={quote(os.path.basename(path))}", data=file, method="POST",
+                              headers={"Content-Type": "application/octet-stream", "Content-Length": str(os.path.getsize(path))})
+            with urlopen(request) as response:
+                return json.load(response)
+    body = {"path": os.path.abspath(path)}
+    if destination:
+        body["destination"] = destination
+    request = Request(f"{server}/jobs", data=json.dumps(body).encode(),
+                      headers={"Content-Type": "application/json"}, method="POST")
+    with urlopen(request) as response:
+        return json.load(response)
+
+def get(server, endpoint):
+    """
+    Description:
+    Sends a GET request to the processing service.
+
+    Parameters:
+    server (str): The base URL of the service.
+    endpoint (str): The path of the endpoint.
+
+    Returns:
+    dict: The decoded JSON response.
+    """
+    with urlopen(f"{server}{endpoint}") as response:
+        return json.load(response)
+
+def wait_for_job(server, job_id, poll_interval=0.1):
+    """
+    Description:
+    Polls a job until it has finished.
+
+    Parameters:
+    server (str): The base URL of the service.
+    job_id (str): The id of the job.
+    poll_interval (float, Default = 0.1): Seconds between polls.
+
+    Returns:
+    dict: The final status of the job.
+    """
+    while True:
+        job = get(server, f"/jobs/{job_id}")
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(poll_interval)
+
+def process_remote(server, path, upload=False, destination=None):
+    """
+    Description:
+    Processes a scan on the processing service and reports the time spent outside of the processing itself.
+
+    Parameters:
+    server (str): The base URL of the service.
+    path (str): The path to the scan.
+    upload (bool, Default = False): Send the file itself rather than its path.
+    destination (str, Default = None): The destination directory on the service's machine.
+
+    Returns:
+    dict: The job result with the 'metrics', 'processing_seconds', 'wall_seconds' and 'overhead_seconds', or
+        None and the error if the job failed.
+    """
+    start_time = time.perf_counter()
+    job = wait_for_job(server, submit(server, path, upload, destination)["id"])
+    if job["status"] != "done":
+        return {"metrics": None, "error": job["error"]}
+
+    result = get(server, f"/jobs/{job['id']}/result")
+    result["wall_seconds"] = time.perf_counter() - start_time
+    result["overhead_seconds"] = result["wall_seconds"] - result["processing_seconds"]
+    return result
+
+def cold_start_seconds():
+    """
+    Description:
+    Measures what every standalone CLI invocation pays before processing starts: the interpreter start and
+    the import of the backend with Open3D, SciPy and scikit-learn. `main.py --help` does exactly that and exits.
+
+    Returns:
+    float: The seconds taken.
+
+    Raises:
+    RuntimeError: If the CLI did not start, so a failed import is never reported as a cold start.
+    """
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, main_path, "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - start_time
+    if result.returncode != 0:
+        error_lines = result.stderr.strip().splitlines()
+        raise RuntimeError(f"main.py --help exited with {result.returncode}: {error_lines[-1] if error_lines else 'no output'}")
+    return seconds
+
+def main():
+    """
+    Description:
+    Thin command line client of the processing service, the warm replacement of `main.py --process`.
+    """
+    parser = argparse.ArgumentParser(description="Process point clouds on a running processing service.")
+    parser.add_argument("path", nargs="+", help="Path to the point cloud file(s)")
+    parser.add_argument("--server", default="http://127.0.0.1:8765", help="Base URL of the processing service")
+    parser.add_argument("--destination", default=None, help="Destination directory for processed files")
+    parser.add_argument("--upload", action="store_true", help="Upload the files instead of sending their paths")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the per-tree overhead with a standalone CLI run")
+    args = parser.parse_args()
+
+    overheads = []
+    for path in args.path:
+        try:
+            result = process_remote(args.server, path, args.upload, args.destination)
+        except HTTPError as e:
+            print(f"{path}: {e.code} {json.load(e).get('error')}", file=sys.stderr)
+            continue
+        if result["metrics"] is None:
+            print(f"{path}: failed, {result['error']}", file=sys.stderr)
+            continue
+        overheads.append(result["overhead_seconds"])
+        print(json.dumps({"path": path, **result}))
+
+    if args.benchmark and overheads:
+        try:
+            cold_overhead = cold_start_seconds()
+        except RuntimeError as e:
+            print(f"Could not time the standalone CLI: {e}", file=sys.stderr)
+            return
+        warm_overhead = sum(overheads) / len(overheads)
+        print(f"Per-tree overhead, standalone CLI: {cold_overhead:.3f} s")
+        print(f"Per-tree overhead, warm workers:   {warm_overhead:.3f} s")
+
+if __name__ == "__main__":
+    main()
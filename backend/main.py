@@ -1,7 +1,11 @@
 import argparse
 import os
-import shutil
 import sys
+import logging
+import queue
+import threading
+from multiprocessing import resource_tracker
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # Add the backend directory to sys.path
 backend_dir = os.path.dirname(os.path.abspath(__file__))
@@ -9,20 +13,43 @@ if backend_dir not in sys.path:
     sys.path.insert(0, backend_dir)
     
 from utils.point_cloud_utils import point_cloud_visualizer
-from utils.file_operations import find_processed_file
+from utils.file_operations import get_base_filename, copy_file_atomic, read_metrics_csv, setup_logging
+from utils.run_journal import RunJournal
+from utils.config import STAGE_PREFIXES, VISUALIZER_MEMORY_BUDGET_MB
 from point_cloud_processor import extract_tree_taper
-from stages.point_cloud_processing_stage import processing_stage
+from stages.point_cloud_processing_stage import processing_stage, measure_diameters_at
+from stages.point_cloud_merging_stage import merging_stage
+from utils.concurrency import plan_concurrency, apply_thread_limits, get_cpu_count, get_n_jobs
+from utils.logging_utils import start_logging, configure_worker_logging
+from utils.thumbnails import write_thumbnail_index
+from utils.quick_dbh import quick_dbh
+from utils.results_table import ResultsTable, aggregate_results
+from utils.point_stream import convert_to_xyz, load_points_within_budget, load_shared_points, LAS_EXTENSIONS
+from utils.shared_arrays import SharedArray
+from utils.execution_planner import plan_execution, plan_batch, log_execution_plan, STRATEGY_DOWNSAMPLED, STRATEGY_TILED
 
-def process(original_path, destination_directory):
+def process(original_path, destination_directory, render_thumbnail=False, points=None, plan=None):
     """
     Description:
     This function will process a raw point cloud of a specified tree, resulting in a tree taper of that tree
     and performing calculations at pre-defined heights, standardized by the Ministry of Natural Resources and Forestry.
-    The processed point cloud is saved in the destination directory. 
+    The processed point cloud is saved in the destination directory. Progress is recorded in the run journal of the
+    destination directory, a tree whose stages all completed is not processed again and an interrupted one resumes
+    from its last completed stage.
+    A tree processed from the start is first given an execution plan, see plan_execution(): processed in memory,
+    over tiles, or voxel downsampled while it is loaded when it would not fit in memory. The plan is logged to the
+    log of the tree and saved beside it. The scans of a tree from several stations are first registered and fused into
+    one scan by the merging stage, see merging_stage().
     
     Parameters:
-    original_path (str): The path to the point cloud that is to be processed
+    original_path (str or list of str): The path to the point cloud that is to be processed, .xyz or .las, or the paths of
+        the scans of one tree from several stations, merged by the merging stage and named after the first
     destination_directory(str): The destination directory to save the new processed point cloud
+    render_thumbnail (bool, Default: False): Render a PNG of the tree to ./thumbnails in the destination directory
+    points (SharedArrayHandle or numpy array, Default: None): The points of original_path if already loaded, handed to the
+        cleaning stage so it does not read the file again
+    plan (dict, Default: None): The execution plan of the tree, planned with the memory available to this process if
+        None and no points are given. Given points must already follow it, see process_batch().
     
     Return:
     point_cloud_metrics(List): A list of dictionaries containing the metrics derived from the tree taper
@@ -31,36 +58,285 @@ def process(original_path, destination_directory):
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
 
+    # Several scans are the stations of one tree, named after the first, merged into one scan ahead of the stages
+    stations = list(original_path) if isinstance(original_path, (list, tuple)) else [original_path]
+    original_path = stations[0]
+    merge = len(stations) > 1
     filename = os.path.basename(original_path)
-    
-    existing_file = find_processed_file(filename, destination_directory)
-    if existing_file is None:
-        destination_path = os.path.join(destination_directory, filename)
+    _, tree_name, extension = get_base_filename(original_path)
+    # The stages read .xyz, other formats are converted once when they are copied to the destination directory
+    convert = extension.lower() in LAS_EXTENSIONS
+    if convert or merge:
+        filename = tree_name + ".xyz"
+    journal = RunJournal(destination_directory)
+    destination_path = os.path.join(destination_directory, filename)
+
+    taper_stage, metrics_stage = STAGE_PREFIXES[-2][0], STAGE_PREFIXES[-1][0]
+    if journal.is_completed(tree_name, metrics_stage) and journal.is_completed(tree_name, taper_stage):
+        logging.info("%s has already been processed, skipping", tree_name)
+        processed_point_cloud = journal.get_record(tree_name, taper_stage)["output_path"]
+        return read_metrics_csv(journal.get_record(tree_name, metrics_stage)["output_path"]), processed_point_cloud
+
+    # Only a tree without any completed taper stage needs a fresh copy, the others resume from the journal
+    resume = journal.resume_point(tree_name, [stage_name for stage_name, _ in STAGE_PREFIXES[:-1]])
+    resume_stage = resume[0]
+    shared_points = None
+    if resume_stage is None:
+        setup_logging(tree_name, destination_directory)
+        if merge:
+            _, merged = merging_stage(stations, destination_path, destination_directory, tree_name)
+            if not merged:
+                logging.error("Could not merge the stations of %s", tree_name)
+                return None, None
+        if plan is None and points is None:
+            plan = plan_execution(destination_path if merge else original_path, threads=get_n_jobs() if get_n_jobs() > 0 else None)
+        if plan is not None:
+            log_execution_plan(plan, tree_name, destination_directory)
 
-        shutil.copyfile(original_path, destination_path)
+        if convert and not merge:
+            convert_to_xyz(original_path, destination_path)
+        elif not merge:
+            copy_file_atomic(original_path, destination_path)
+
+        # Points given by the caller were already loaded following the plan
+        strategy = plan['strategy'] if plan is not None and points is None else None
+        if strategy == STRATEGY_DOWNSAMPLED:
+            points = load_points_within_budget(destination_path, plan['max_points'], use_cache=False)
+        elif strategy == STRATEGY_TILED:
+            # Shared memory, or a memory mapped file when it is short, so the tiles are read without copies
+            shared_points = load_shared_points(destination_path, spill_directory=destination_directory)
+            points = shared_points.handle
     else:
-        #A existing file is in the destination, so update to reference that one, effectively skipping steps that have been done. 
-        destination_path = existing_file
+        plan = None
 
-    processed_point_cloud = extract_tree_taper(destination_path, destination_directory)
-    point_cloud_metrics = processing_stage(processed_point_cloud, destination_directory)
+    try:
+        processed_point_cloud = extract_tree_taper(destination_path, destination_directory, points,
+                                                   tile=plan['tile'] if plan is not None else None, resume=resume)
+    finally:
+        if shared_points is not None:
+            shared_points.close()
+    if processed_point_cloud is None:
+        logging.error("Could not extract a tree taper from %s", original_path)
+        return None, None
+    point_cloud_metrics = processing_stage(processed_point_cloud, destination_directory, render_thumbnail)
     return point_cloud_metrics, processed_point_cloud
 
+def process_batch(original_paths, destination_directory=None, workers=None, threads=None, thumbnails=False, prefetch=None):
+    """
+    Description:
+    Processes several raw point clouds in parallel by running process() for each of them on a pool of worker processes.
+    The cores are split between worker processes and threads per worker by plan_concurrency(), and every worker has its
+    Open3D, BLAS and scikit-learn thread pools limited to its share so that the workers do not oversubscribe the CPU.
+    Fewer workers are started when the largest scans would not fit in memory together, and every scan is planned
+    with its worker's share of the memory left by the scans loaded ahead, see plan_batch().
+    The scans are read and parsed ahead by a thread of the main process, following their plans, and handed to the
+    workers in shared memory, so the next scan is loaded while the current ones compute and a worker never waits on
+    its input. Each worker writes the outputs of its stages in the background, see extract_tree_taper().
+    
+    Parameters:
+    original_paths (list of str): The paths to the point clouds that are to be processed
+    destination_directory (str, Default: None): The destination directory, defaults to ./pinecone next to each input
+    workers (int, Default: None): Number of worker processes, derived from the core count if not given
+    threads (int, Default: None): Number of threads per worker, derived from the core count if not given
+    thumbnails (bool, Default: False): Render a PNG of every tree in its worker and write thumbnails/index.html to
+        each destination directory for reviewing the batch in a browser
+    prefetch (int, Default: None): Most scans loaded ahead of the workers, at least one, the number of workers if None
+    The metrics of every tree of each destination directory are then aggregated to one csv, see aggregate_results().
+    
+    Return:
+    results (list): A list of (original_path, point_cloud_metrics) in the order of original_paths, metrics are None on failure
+    """
+    workers, threads, plans = plan_batch(original_paths, workers, threads, prefetch)
+    # Workers send their records to the listener of this process, which writes every tree's log file
+    log_queue = start_logging(multiprocess=True)
+    logging.info("Processing %d point clouds with %d workers of %d threads", len(original_paths), workers, threads)
+
+    # Set in the parent as well so the environment is inherited before the workers import Open3D
+    apply_thread_limits(threads)
+
+    # Scans are read by a thread of this process into shared memory while the workers compute the ones before them,
+    # at most prefetch of them are loaded and not yet handed to a worker
+    prefetch = workers if prefetch is None else prefetch
+    prefetched, prefetch_slots = queue.Queue(), threading.Semaphore(max(1, prefetch))
+    stop_prefetch = threading.Event()
+    reader = threading.Thread(target=_prefetch_scans, args=(original_paths[1:], plans[1:], destination_directory, prefetched,
+                                                            prefetch_slots, stop_prefetch),
+                              name="pinecone-prefetch", daemon=True)
+    futures, running = [], {}
+    if os.name == "posix":
+        # POSIX workers register the shared memory they attach with a resource tracker. Started now, they inherit the
+        # one of this process instead of starting their own, which would unlink the blocks again when the worker exits
+        resource_tracker.ensure_running()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(threads, log_queue)) as executor:
+            for index, (path, plan) in enumerate(zip(original_paths, plans)):
+                # One scan per worker at a time, the next ones stay with the reader until a worker is free
+                while len(running) >= workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _release_prefetched(running.pop(future))
+                if index == 0:
+                    shared_points = _prefetch_scan(path, plan, destination_directory)
+                else:
+                    shared_points = prefetched.get()
+                    prefetch_slots.release()
+                handle = shared_points.handle if shared_points is not None else None
+                future = executor.submit(_process_worker, path, destination_directory, thumbnails, handle, plan)
+                futures.append(future)
+                running[future] = shared_points
+                if index == 0:
+                    # On POSIX the pool forks its workers on the first submit, a thread running during the fork
+                    # could leave them a lock it holds
+                    reader.start()
+            results = [(path, future.result()) for path, future in zip(original_paths, futures)]
+    finally:
+        stop_prefetch.set()
+        for shared_points in running.values():
+            _release_prefetched(shared_points)
+        # Scans the reader loaded but no worker took, when the batch stopped early
+        while reader.is_alive() or not prefetched.empty():
+            try:
+                _release_prefetched(prefetched.get(timeout=0.1))
+                prefetch_slots.release()
+            except queue.Empty:
+                pass
+
+    for directory in sorted({_destination_directory(path, destination_directory) for path in original_paths}):
+        rejections = RunJournal(directory).rejections()
+        if rejections:
+            logging.warning("%d trees in %s were rejected by a quality gate: %s", len(rejections), directory,
+                            "; ".join(f"{tree} ({detail})" for tree, detail in rejections.items()))
+        # Written now so the results view opens the batch without reading every csv
+        aggregate_results(directory)
+        if thumbnails:
+            write_thumbnail_index(directory)
+
+    return results
+
+def _prefetch_scans(original_paths, plans, destination_directory, prefetched, slots, stop):
+    """
+    Description:
+    Loads the scans of process_batch() in order with _prefetch_scan() and puts them on a queue. A slot is taken
+    before each scan is loaded and released by the consumer once it hands the scan to a worker, so the reader
+    waits once it is as many scans ahead as there are slots.
+
+    Parameters:
+    original_paths (list of str): The paths to the point clouds
+    plans (list of dict): The execution plan of each point cloud, see plan_batch()
+    destination_directory (str): The destination directory, or None for ./pinecone next to each input
+    prefetched (queue.Queue): Receives a SharedArray or None per point cloud
+    slots (threading.Semaphore): One slot per scan that may be loaded ahead
+    stop (threading.Event): Set when the batch stops, the scans not loaded yet are then skipped
+    """
+    for path, plan in zip(original_paths, plans):
+        while not slots.acquire(timeout=0.1):
+            if stop.is_set():
+                return
+        if stop.is_set():
+            slots.release()
+            return
+        prefetched.put(_prefetch_scan(path, plan, destination_directory))
+
+def _prefetch_scan(original_path, plan, destination_directory):
+    """
+    Description:
+    Loads a scan of process_batch() into shared memory following its plan, downsampled scans within their budget.
+
+    Parameters:
+    original_path (str): The path to the point cloud
+    plan (dict): The execution plan of the point cloud, see plan_batch()
+    destination_directory (str): The destination directory, or None for ./pinecone next to the input
+
+    Return:
+    shared_points (SharedArray): The points, None for a tree that resumes from the journal and for a scan that could
+        not be read, whose worker then reads it itself
+    """
+    directory = _destination_directory(original_path, destination_directory)
+    try:
+        _, tree_name, _ = get_base_filename(original_path)
+        # Only the size and modification time are checked here, the worker verifies the checksums of the tree it resumes
+        resume_stage, _ = RunJournal(directory).resume_point(tree_name, [stage_name for stage_name, _ in STAGE_PREFIXES[:-1]], verify=False)
+        if resume_stage is not None:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        if plan['strategy'] == STRATEGY_DOWNSAMPLED:
+            points = load_points_within_budget(original_path, plan['max_points'], use_cache=False)
+            return SharedArray.from_array(points, spill_directory=directory)
+        return load_shared_points(original_path, spill_directory=directory)
+    except Exception as e:
+        logging.warning("Could not prefetch %s, its worker will read it: %s", original_path, e)
+        return None
+
+def _release_prefetched(shared_points):
+    """
+    Description:
+    Releases the shared memory of a prefetched scan once its worker finished.
+    """
+    if shared_points is not None:
+        shared_points.close()
+
+def _initialize_worker(threads, log_queue):
+    """
+    Description:
+    Initialises a worker process of process_batch(): limits its threads and sends its log records to the main process.
+    
+    Parameters:
+    threads (int): Number of threads the worker may use
+    log_queue (multiprocessing.Queue): The logging queue of the main process
+    """
+    apply_thread_limits(threads)
+    configure_worker_logging(log_queue)
+
+def _destination_directory(original_path, destination_directory):
+    """
+    Description:
+    The destination directory of a point cloud, ./pinecone next to it unless one is given.
+    """
+    if destination_directory is None:
+        return os.path.join(os.path.dirname(original_path), "pinecone")
+    return destination_directory
+
+def _process_worker(original_path, destination_directory, render_thumbnail=False, points_handle=None, plan=None):
+    """
+    Description:
+    Runs process() inside a worker process, so one failing tree does not abort the rest of the batch.
+    
+    Parameters:
+    original_path (str): The path to the point cloud that is to be processed
+    destination_directory (str): The destination directory, or None for ./pinecone next to the input
+    render_thumbnail (bool, Default: False): Render a PNG of the tree
+    points_handle (SharedArrayHandle, Default: None): The points of original_path loaded into shared memory by the parent
+    plan (dict, Default: None): The execution plan of the tree, see plan_batch()
+    
+    Return:
+    point_cloud_metrics (List): The metrics derived from the tree taper, or None on failure
+    """
+    destination_directory = _destination_directory(original_path, destination_directory)
+    try:
+        point_cloud_metrics, _ = process(original_path, destination_directory, render_thumbnail, points_handle, plan)
+        return point_cloud_metrics
+    except Exception as e:
+        logging.error("Failed to process %s: %s", original_path, e)
+        return None
+
 # Function to visualize the point cloud
-def visualize_point_cloud(path_to_visualize, original_path = None):
+def visualize_point_cloud(path_to_visualize, original_path = None, memory_budget_mb = VISUALIZER_MEMORY_BUDGET_MB, subsample_method = "voxel"):
     """
     Description:
     Calls the point_cloud_visualizer() to draw and visualize an open3d object. Visualizes the point cloud,
     or a visualization of both the original point cloud, and the processed point cloud in a single window.
+    The point clouds are subsampled to fit the memory budget.
     
     Parameters:
     path_to_visualize (str): The path to the processed point cloud
     original_path (str, Default: None): The path to the original point cloud 
+    memory_budget_mb (float, Default: VISUALIZER_MEMORY_BUDGET_MB): Memory the displayed points may use in megabytes
+    subsample_method (str, Default: "voxel"): "voxel" or "random" subsampling of point clouds over the budget
     """
-    point_cloud_visualizer(path_to_visualize, original_path)
+    point_cloud_visualizer(path_to_visualize, original_path, memory_budget_mb, subsample_method)
 
 # Function to process and then visualize the point cloud
-def process_and_visualize(original_path, destination_directory):
+def process_and_visualize(original_path, destination_directory, memory_budget_mb = VISUALIZER_MEMORY_BUDGET_MB, subsample_method = "voxel"):
     """
     Description:
     Processes a point cloud by calling process() and than visualizes both the original and the processed point cloud
@@ -69,10 +345,18 @@ def process_and_visualize(original_path, destination_directory):
     Parameters:
     original_path (str): The path to the point cloud to be processed
     destination_directory (str): The path to the destination directory to save the processed point cloud
+    memory_budget_mb (float, Default: VISUALIZER_MEMORY_BUDGET_MB): Memory the displayed points may use in megabytes
+    subsample_method (str, Default: "voxel"): "voxel" or "random" subsampling of point clouds over the budget
+
+    Return:
+    point_cloud_metrics (List): The metrics returned by process(), None if the point cloud could not be processed
     """
     starting_point_cloud = original_path
     point_cloud_metrics, processed_file_path = process(original_path, destination_directory)
-    visualize_point_cloud(processed_file_path, starting_point_cloud)
+    if processed_file_path is None:
+        logging.error("Not visualizing %s, it could not be processed", original_path)
+        return None
+    visualize_point_cloud(processed_file_path, starting_point_cloud, memory_budget_mb, subsample_method)
     return point_cloud_metrics
 
 def main():
@@ -82,20 +366,65 @@ def main():
     No longer used but retained for reference/testing.
     """
     parser = argparse.ArgumentParser(description="Process and/or visualize point cloud files.")
-    parser.add_argument("path", help="Path to the point cloud file")
+    parser.add_argument("path", nargs="+", help="Path to the point cloud file, several files are processed as a batch")
     parser.add_argument("--destination", help="Destination directory for processed files", default=None)
     parser.add_argument("--process", action="store_true", help="Process the point cloud")
     parser.add_argument("--visualize", action="store_true", help="Visualize the point cloud")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes for a batch, derived from the core count by default")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads per worker, derived from the core count by default")
+    parser.add_argument("--merge", action="store_true", help="Process the given scans as the stations of one tree, merged into one scan named after the first")
+    parser.add_argument("--prefetch", type=int, default=None, help="Most scans of a batch read ahead of the workers, at least one, the number of workers by default")
+    parser.add_argument("--thumbnails", action="store_true", help="Render a PNG of every processed tree and an HTML index of them")
+    parser.add_argument("--memory-budget", type=float, default=VISUALIZER_MEMORY_BUDGET_MB, help="Memory in MB the visualized points may use, larger scans are subsampled")
+    parser.add_argument("--subsample", choices=["voxel", "random"], default="voxel", help="How scans over the memory budget are subsampled for visualization")
+    parser.add_argument("--quick-dbh", action="store_true", help="Preview the DBH of raw scans from the breast height band only, without processing them")
+    parser.add_argument("--measure-at", type=float, nargs="+", default=None, help="Re-measure the diameter of a processed tree taper at these heights in meters, read from its octree index")
     args = parser.parse_args()
 
-    destination_directory = args.destination if args.destination else os.path.join(os.path.dirname(args.path), "pinecone")
+    start_logging()
+    if args.quick_dbh:
+        for path in args.path:
+            preview = quick_dbh(path)
+            if preview is None:
+                print(f"{path}: no stem found at breast height")
+            else:
+                print(f"{path}: DBH {preview['dbh']:.3f} m, confidence {preview['confidence']:.2f}")
+        return
+
+    if args.merge:
+        if args.visualize or len(args.path) < 2:
+            parser.error("--merge needs the scans of at least two stations and does not support --visualize")
+        destination_directory = _destination_directory(args.path[0], args.destination)
+        _, threads = plan_concurrency(1, 1, args.threads)
+        apply_thread_limits(threads)
+        process(args.path, destination_directory, args.thumbnails)
+        return
+
+    if len(args.path) > 1:
+        if args.visualize:
+            parser.error("--visualize only supports a single point cloud")
+        if not args.process:
+            parser.error("several point clouds are only processed as a batch with --process")
+        process_batch(args.path, args.destination, args.workers, args.threads, args.thumbnails, args.prefetch)
+        return
+
+    path = args.path[0]
+    if args.measure_at:
+        for height, diameter in measure_diameters_at(path, args.measure_at):
+            print(f"{height:.2f} m: " + ("no fit" if diameter is None else f"{diameter:.4f} m"))
+        return
+    destination_directory = _destination_directory(path, args.destination)
+    _, threads = plan_concurrency(1, 1, args.threads)
+    apply_thread_limits(threads)
 
     if args.process and not args.visualize:
-        process(args.path, destination_directory)
+        process(path, destination_directory, args.thumbnails)
+        if args.thumbnails:
+            write_thumbnail_index(destination_directory)
     elif args.visualize and not args.process:
-        visualize_point_cloud(args.path)
+        visualize_point_cloud(path, memory_budget_mb=args.memory_budget, subsample_method=args.subsample)
     elif args.process and args.visualize:
-        process_and_visualize(args.path, destination_directory)
+        process_and_visualize(path, destination_directory, args.memory_budget, args.subsample)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
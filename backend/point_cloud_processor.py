@@ -1,19 +1,25 @@
-from turtle import setup
-from backend.stages.point_cloud_processing_stage import processing_stage
-from utils.file_operations import modify_filename, setup_logging, get_base_filename
-from utils.point_cloud_utils import get_current_stage
+from stages.point_cloud_processing_stage import processing_stage
+from utils.file_operations import modify_filename, setup_logging, get_base_filename, background_writes, after_writes
+from utils.run_journal import RunJournal
 from stages.point_cloud_cleaning_stage import cleaning_stage
 from stages.point_cloud_preprocessing_stage import preprocessing_stage
 from utils.config import STAGE_PREFIXES
+from utils.quality_gates import QualityGateError
 import os
+import inspect
 import logging
 import open3d as o3d
 
-def extract_tree_taper(filepath, log_path):
+def extract_tree_taper(filepath, log_path, points=None, tile=None, resume=None):
     """
     Parameters:
     filepath (str): Path to the point cloud file to be processed.
     log_path (str): Path to the directory where logs should be stored.
+    points (SharedArrayHandle or numpy array, Default = None): The points of filepath already loaded by the caller, handed to
+        the first stage instead of it reading the file. Ignored when resuming from a later stage.
+    tile (bool, Default = None): Passed to the stages accepting a tile flag, see plan_execution(). Decided by each stage if None.
+    resume (tuple, Default = None): The stage and output path to resume from, as returned by RunJournal.resume_point() for the
+        cleaning and preprocessing stages, when the caller already looked it up. Looked up in the journal if None.
 
     Returns:
     str: Path to the processed point cloud file if all stages complete successfully.
@@ -21,48 +27,84 @@ def extract_tree_taper(filepath, log_path):
     
     Description:
     Processes a point cloud file sequentially through defined stages.
-    The function identifies the current stage based on the file's naming convention, then applies the appropriate
-    processing functions for each stage in sequence. If a stage completes successfully, the file is prepared for the next stage.
-    Processing halts if a stage fails to complete or an error occurs. Updates the filename on success to denote preprocessiong completion. 
+    The run journal in log_path is checked first, every stage up to the most advanced one whose output is recorded and
+    still intact is skipped and that output is used as the input of the next stage. Each completed stage is recorded in the journal
+    before the input it consumed is removed, so an interrupted run resumes from the last completed stage.
+    Stage outputs are written on a background thread while the next stage computes from the copy kept in memory, see
+    background_writes(); the journal records and removals wait for the writes before them.
+    Processing halts if a stage fails to complete or an error occurs. A tree failing a quality gate is recorded as rejected in the
+    journal with the reason code of the gate, see utils.quality_gates. Updates the filename on success to denote preprocessiong completion. 
     """
     _, base_filename, _ = get_base_filename(filepath)
     setup_logging(base_filename, log_path)
+    journal = RunJournal(log_path)
     stages_map = {
         'cleaning': cleaning_stage,
         'preprocessing': preprocessing_stage,
     }
+    last_stage_name = list(stages_map)[-1]
 
-    initial_stage = get_current_stage(filepath)
-    logging.info(f"Initial processing stage: {initial_stage}")
-    if initial_stage == STAGE_PREFIXES[-1][0]:
-        return filepath
+    # Resume after the most advanced stage whose output is intact, everything before it is skipped
+    resume_stage, resume_path = resume if resume is not None else journal.resume_point(base_filename, list(stages_map))
+    skipping = resume_stage is not None
+    if skipping:
+        filepath = resume_path
+        points = None
+        logging.info("Stage '%s' already completed, resuming from %s", resume_stage, filepath)
 
-    for stage_name, _ in STAGE_PREFIXES:
-        if stage_name == "processing":
-            continue
-        if stage_name in stages_map:
-            logging.info(f"Checking stage: {stage_name}")
+    try:
+        with background_writes() as writer:
+            for stage_name, _ in STAGE_PREFIXES:
+                if stage_name == "processing":
+                    continue
+                if stage_name not in stages_map:
+                    logging.error("No processing function defined for stage '%s'", stage_name)
+                    continue
 
-            # Check if it is the current stage, or next stage to be completed
-            if initial_stage == stage_name or initial_stage == "new" or initial_stage == "":
-                logging.info(f"Starting stage: {stage_name}")
-                
+                logging.info("Checking stage: %s", stage_name)
+                if skipping:
+                    skipping = stage_name != resume_stage
+                    continue
+
+                logging.info("Starting stage: %s", stage_name)
                 try:
                     stage_function = stages_map[stage_name]
-                    filepath, process_success = stage_function(filepath, log_path)
+                    stage_options = {'tile': tile} if 'tile' in inspect.signature(stage_function).parameters else {}
+                    new_filepath, process_success = stage_function(filepath, log_path, points=points, **stage_options)
+                    # Later stages read the output of the stage before them
+                    points = None
                     if not process_success:
-                        logging.error(f"Stage '{stage_name}' did not complete successfully.")
+                        logging.error("Stage '%s' did not complete successfully.", stage_name)
                         return None
-                    
+
+                    if stage_name == last_stage_name:
+                        writer.flush()
+                        new_filepath = modify_filename(new_filepath, STAGE_PREFIXES[-1][1])
+                    # Recorded once the output is on disk, and the input it consumed is only removed after that
+                    after_writes(journal.record_stage, base_filename, stage_name, new_filepath)
+                    after_writes(_remove_consumed_input, filepath, new_filepath)
+                    filepath = new_filepath
+
+                except QualityGateError as e:
+                    # Recorded so the batch can report why the tree was rejected
+                    logging.error("Rejected %s during the '%s' stage: %s", base_filename, stage_name, e)
+                    after_writes(journal.record_stage, base_filename, stage_name, None, "rejected", str(e))
+                    return None
+
                 except Exception as e:
-                    logging.error(f"An error occurred during the '{stage_name}' stage: {e}")
-                    return None                
-            # Flag to continue to the next stages
-            initial_stage = "new"
-            
-        else:
-            logging.error(f"No processing function defined for stage '{stage_name}'")
+                    logging.error("An error occurred during the '%s' stage: %s", stage_name, e)
+                    return None
+    except Exception as e:
+        logging.error("Failed to write the output of a stage of %s: %s", base_filename, e)
+        return None
 
     logging.info("Processing completed for all stages.")
-    new_filepath = modify_filename(filepath, STAGE_PREFIXES[-1][1])
-    return new_filepath
\ No newline at end of file
+    return filepath
+
+def _remove_consumed_input(filepath, new_filepath):
+    """
+    Description:
+    Removes the input of a stage once its output is recorded, unless the stage wrote to the same file.
+    """
+    if os.path.exists(filepath) and os.path.abspath(filepath) != os.path.abspath(new_filepath):
+        os.remove(filepath)
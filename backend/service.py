@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+# Add the backend directory to sys.path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
+
+from main import process
+from utils.concurrency import plan_concurrency, apply_thread_limits, get_cpu_count
+from utils.logging_utils import start_logging, configure_worker_logging
+from utils.file_operations import get_base_filename
+from utils.run_journal import RunJournal
+from utils.config import STAGE_PREFIXES, SERVICE_FINISHED_JOBS, SERVICE_FINISHED_JOB_SECONDS
+
+# Largest accepted upload and request header block, in bytes
+MAX_UPLOAD_SIZE = 8 * 1024 ** 3
+MAX_HEADER_SIZE = 64 * 1024
+
+HTTP_REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+class HTTPError(Exception):
+    """
+    Description:
+    An error to be returned to the client with an HTTP status code.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ProcessingService:
+    """
+    Description:
+    A local HTTP service that queues scans onto a pool of warm worker processes running process(), the same
+    extract_tree_taper + processing_stage chain as the CLI. Workers import Open3D, SciPy and scikit-learn once
+    when the pool starts, so a request only pays for its own processing. At most `workers` jobs run at a time
+    and at most `max_queued` wait, further submissions are refused until the queue drains. Workers are replaced
+    after `recycle_after` jobs to bound the memory a long-lived worker can accumulate. A scan submitted again
+    while a job for the same tree and destination is queued or running joins that job instead of processing the
+    tree twice into the same directory. Finished jobs are forgotten once more than SERVICE_FINISHED_JOBS have
+    accumulated or after SERVICE_FINISHED_JOB_SECONDS, so a long-lived service keeps a bounded history.
+
+    Endpoints:
+    GET  /jobs                   List every job.
+    POST /jobs                   Queue a scan already on disk, JSON body {"path": ..., "destination": optional}.
+                                 Answers 202 for a new job, 200 with the pending job of the same tree otherwise.
+    POST /jobs?filename=<name>   Queue an uploaded scan, the request body is the .xyz file.
+    GET  /jobs/<id>              Status of a job.
+    GET  /jobs/<id>/progress     Stages of the job completed so far, read from the run journal.
+    GET  /jobs/<id>/result       Metrics of a finished job.
+
+    Parameters:
+    upload_directory (str): Directory uploaded scans are stored in, each job in its own subdirectory.
+    workers (int, Default = None): Number of worker processes, derived from the core count if not given.
+    threads (int, Default = None): Number of threads per worker, derived from the core count if not given.
+    max_queued (int, Default = 1000): Most jobs allowed to wait for a worker.
+    recycle_after (int, Default = None): Number of jobs after which a worker is replaced, never if None.
+    """
+
+    def __init__(self, upload_directory, workers=None, threads=None, max_queued=1000, recycle_after=None):
+        self.upload_directory = upload_directory
+        self.workers, self.threads = plan_concurrency(get_cpu_count(), workers, threads)
+        self.max_queued = max_queued
+        self.recycle_after = recycle_after
+        self.jobs = {}
+        self.executor = None
+        self.log_queue = None
+        self.semaphore = None
+
+    def start_workers(self):
+        """
+        Description:
+        Starts the worker pool. Each worker loads the heavy libraries in its initializer, warm_worker(), as it starts,
+        so no job pays for them; no warm-up tasks are sent, they would count towards recycle_after.
+        """
+        apply_thread_limits(self.threads)
+        pool_options = {}
+        if self.recycle_after:
+            if sys.version_info >= (3, 11):
+                # Recycling workers is not supported with fork, spawn is already the default on Windows
+                pool_options = {'max_tasks_per_child': self.recycle_after, 'mp_context': multiprocessing.get_context("spawn")}
+            else:
+                logging.warning("Recycling workers requires Python 3.11 or newer, workers will not be recycled")
+        # Workers send their records to the listener of the service, which writes every tree's log file
+        self.log_queue = start_logging(multiprocess=True, console_level=logging.INFO, context=pool_options.get('mp_context'))
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker, initargs=(self.threads, self.log_queue), **pool_options)
+        self.semaphore = asyncio.Semaphore(self.workers)
+        logging.info("Started a pool of %d warm workers with %d threads each", self.workers, self.threads)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, path, destination_directory=None):
+        """
+        Description:
+        Queues a scan for processing, unless a job for the same tree and destination directory is already queued
+        or running, in which case that job is returned.
+
+        Parameters:
+        path (str): The path to the scan.
+        destination_directory (str, Default = None): The destination directory, defaults to ./pinecone next to the scan.
+
+        Returns:
+        dict: The new job, or the pending job of the same tree.
+        bool: True if a new job was queued, False if the pending job was returned.
+        """
+        if not os.path.isfile(path):
+            raise HTTPError(400, f"No such file: {path}")
+        destination_directory = os.path.abspath(destination_directory or os.path.join(os.path.dirname(path), "pinecone"))
+        key = (destination_directory, get_base_filename(path)[1])
+        self._evict_finished()
+        queued = 0
+        for job in self.jobs.values():
+            if job['status'] in ('queued', 'running') and job['key'] == key:
+                return job, False
+            queued += job['status'] == 'queued'
+        if queued >= self.max_queued:
+            raise HTTPError(503, "The job queue is full, try again later")
+
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'path': path,
+            'destination': destination_directory,
+            'key': key,
+            'status': 'queued',
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            'result': None,
+        }
+        self.jobs[job_id] = job
+        asyncio.get_running_loop().create_task(self._run(job))
+        return job, True
+
+    def _evict_finished(self):
+        """
+        Description:
+        Forgets the finished jobs older than SERVICE_FINISHED_JOB_SECONDS, then the oldest finished jobs beyond
+        SERVICE_FINISHED_JOBS. Queued and running jobs are always kept.
+        """
+        finished = sorted((job for job in self.jobs.values() if job['finished_at'] is not None), key=lambda job: job['finished_at'])
+        expiry = time.time() - SERVICE_FINISHED_JOB_SECONDS
+        excess = len(finished) - SERVICE_FINISHED_JOBS
+        for index, job in enumerate(finished):
+            if index >= excess and job['finished_at'] >= expiry:
+                break
+            del self.jobs[job['id']]
+
+    async def _run(self, job):
+        async with self.semaphore:
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            try:
+                loop = asyncio.get_running_loop()
+                job['result'] = await loop.run_in_executor(self.executor, run_job, job['path'], job['destination'])
+                job['status'] = 'done' if job['result']['metrics'] is not None else 'failed'
+                if job['status'] == 'failed':
+                    job['error'] = "Processing did not complete, see the log of the tree"
+            except Exception as e:
+                logging.error("Job %s failed: %s", job['id'], e)
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            finally:
+                job['finished_at'] = time.time()
+                self._evict_finished()
+
+    def get_job(self, job_id):
+        if job_id not in self.jobs:
+            raise HTTPError(404, f"No such job: {job_id}")
+        return self.jobs[job_id]
+
+    def job_status(self, job):
+        return {key: value for key, value in job.items() if key not in ('result', 'key')}
+
+    def job_progress(self, job):
+        """
+        Description:
+        Reads the stages a job has completed from the run journal of its destination directory.
+
+        Parameters:
+        job (dict): The job.
+
+        Returns:
+        dict: The job id, status, completed stages and the fraction of stages completed.
+        """
+        _, tree_name, _ = get_base_filename(job['path'])
+        completed = []
+        if os.path.isdir(job['destination']):
+            journal = RunJournal(job['destination'])
+            for stage_name, _ in STAGE_PREFIXES:
+                record = journal.get_record(tree_name, stage_name)
+                if record is not None and record['status'] == 'completed' and record['updated_at'] >= job['submitted_at']:
+                    completed.append(stage_name)
+        if job['status'] == 'done':
+            completed = [stage_name for stage_name, _ in STAGE_PREFIXES]
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'completed_stages': completed,
+            'progress': len(completed) / len(STAGE_PREFIXES),
+        }
+
+    async def handle_connection(self, reader, writer):
+        """
+        Description:
+        Serves a single HTTP/1.1 request on a connection, then closes it.
+        """
+        try:
+            status, body = await self._dispatch(reader)
+        except HTTPError as e:
+            status, body = e.status, {'error': str(e)}
+        except Exception as e:
+            logging.error("Request failed: %s", e)
+            status, body = 500, {'error': str(e)}
+
+        payload = json.dumps(body).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + payload
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader):
+        try:
+            header_block = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise HTTPError(400, "Malformed request")
+        if len(header_block) > MAX_HEADER_SIZE:
+            raise HTTPError(400, "Request headers too large")
+
+        request_line, *header_lines = header_block.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        content_length = int(headers.get("content-length", 0))
+
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["jobs"]:
+            if method == "GET":
+                return 200, [self.job_status(job) for job in self.jobs.values()]
+            if method != "POST":
+                raise HTTPError(405, "Use GET or POST on /jobs")
+            if "filename" in query:
+                path = await self._receive_upload(reader, query["filename"][0], content_length)
+                destination_directory = None
+            else:
+                try:
+                    request = json.loads(await reader.readexactly(content_length)) if content_length else {}
+                except (ValueError, asyncio.IncompleteReadError):
+                    raise HTTPError(400, "The request body is not valid JSON")
+                if not isinstance(request, dict) or "path" not in request:
+                    raise HTTPError(400, "A path or an uploaded file is required")
+                path, destination_directory = request["path"], request.get("destination")
+            job, created = self.submit(path, destination_directory)
+            return (202 if created else 200), self.job_status(job)
+
+        if len(parts) in (2, 3) and parts[0] == "jobs" and method == "GET":
+            job = self.get_job(parts[1])
+            if len(parts) == 2:
+                return 200, self.job_status(job)
+            if parts[2] == "progress":
+                return 200, self.job_progress(job)
+            if parts[2] == "result":
+                if job['status'] != 'done':
+                    raise HTTPError(409, f"Job {job['id']} is {job['status']}")
+                return 200, {'id': job['id'], **job['result']}
+
+        raise HTTPError(404, f"No such endpoint: {method} {url.path}")
+
+    async def _receive_upload(self, reader, filename, content_length):
+        """
+        Description:
+        Streams an uploaded scan to its own directory under the upload directory.
+
+        Parameters:
+        reader (asyncio.StreamReader): The connection to read from.
+        filename (str): The name of the uploaded file.
+        content_length (int): The size of the upload in bytes.
+
+        Returns:
+        str: The path the upload was saved to.
+        """
+        filename = os.path.basename(filename)
+        if os.path.splitext(filename)[1].lower() != ".xyz":
+            raise HTTPError(400, "Only .xyz files are supported")
+        if content_length <= 0:
+            raise HTTPError(400, "The upload is empty")
+        if content_length > MAX_UPLOAD_SIZE:
+            raise HTTPError(413, "The upload is too large")
+
+        upload_path = os.path.join(self.upload_directory, uuid.uuid4().hex, filename)
+        os.makedirs(os.path.dirname(upload_path))
+        remaining = content_length
+        with open(upload_path, "wb") as file:
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise HTTPError(400, "The upload ended early")
+                file.write(chunk)
+                remaining -= len(chunk)
+        return upload_path
+
+def warm_worker(threads, log_queue):
+    """
+    Description:
+    Initialises a worker process: limits its threads, sends its log records to the service and loads the
+    libraries used by the stages, so the cost is paid once per worker rather than once per tree.
+
+    Parameters:
+    threads (int): Number of threads the worker may use.
+    log_queue (multiprocessing.Queue): The logging queue of the service.
+    """
+    apply_thread_limits(threads)
+    configure_worker_logging(log_queue)
+    import open3d
+    import scipy.optimize
+    import sklearn.ensemble
+    import sklearn.cluster
+
+def run_job(path, destination_directory):
+    """
+    Description:
+    Processes one scan inside a worker process.
+
+    Parameters:
+    path (str): The path to the scan.
+    destination_directory (str): The destination directory.
+
+    Returns:
+    dict: The 'metrics' returned by process(), None on failure, the 'processed_path' of the tree taper and the
+        'processing_seconds' spent in process(), which the client compares to its own wall time to report overhead.
+    """
+    start_time = time.perf_counter()
+    point_cloud_metrics, processed_path = process(path, destination_directory)
+    return {
+        'metrics': point_cloud_metrics,
+        'processed_path': processed_path,
+        'processing_seconds': time.perf_counter() - start_time,
+    }
+
+async def serve(host, port, upload_directory, workers=None, threads=None, max_queued=1000, recycle_after=None):
+    """
+    Description:
+    Runs the processing service until interrupted.
+
+    Parameters:
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+    upload_directory (str): Directory uploaded scans are stored in.
+    workers (int, Default = None): Number of worker processes.
+    threads (int, Default = None): Number of threads per worker.
+    max_queued (int, Default = 1000): Most jobs allowed to wait for a worker.
+    recycle_after (int, Default = None): Number of jobs after which a worker is replaced.
+    """
+    service = ProcessingService(upload_directory, workers, threads, max_queued, recycle_after)
+    service.start_workers()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    logging.info("Processing service listening on http://%s:%d", host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.shutdown()
+
+def main():
+    """
+    Description:
+    Command line entry point of the processing service.
+    """
+    parser = argparse.ArgumentParser(description="Serve point cloud processing over HTTP to the local network.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--upload-directory", default=os.path.join(os.getcwd(), "pinecone_uploads"), help="Directory uploaded scans are stored in")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, the limit of concurrently processed trees")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads per worker")
+    parser.add_argument("--max-queued", type=int, default=1000, help="Most jobs allowed to wait for a worker")
+    parser.add_argument("--recycle-after", type=int, default=None, help="Replace a worker after this many jobs to bound its memory growth")
+    args = parser.parse_args()
+
+    start_logging(console_level=logging.INFO)
+    os.makedirs(args.upload_directory, exist_ok=True)
+    try:
+        asyncio.run(serve(args.host, args.port, args.upload_directory, args.workers, args.threads, args.max_queued, args.recycle_after))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
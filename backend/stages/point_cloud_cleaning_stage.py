@@ -1,45 +1,70 @@
 from tkinter import CURRENT
 import open3d as o3d
 import os
+import inspect
 import numpy as np
 import logging
-from utils.file_operations import setup_logging, write_to_file
-from utils.config import STAGE_PREFIXES
+from utils.file_operations import setup_logging, write_to_file, load_stage_input
+from utils.config import STAGE_PREFIXES, TILING_MIN_POINTS, DEDUP_TOLERANCE, CLEANING_RADIUS_OUTLIERS
+from utils.neighbour_graph import NeighbourGraph
+from utils.tiling import tiled_statistical_outliers, tiled_radius_outliers, tiled_voxel_downsample, tiling_workers
+from utils.quality_gates import enforce_quality_gates, QualityGateError
 
 # Map of the order of functions for this stage with the value being the name of the function to be called
 cleaning_operations = {
     0: 'extract_xyz_coordinates',
     1: 'remove_statistical_outliers',
-    # 2: 'remove_radius_outliers',
-    2: 'voxel_downsample',
+    2: 'remove_radius_outliers',
+    3: 'voxel_downsample',
 }
 
-def cleaning_stage(filepath, log_path):
+# Operations of cleaning_operations skipped unless enabled, see cleaning_stage()
+optional_cleaning_operations = {'remove_radius_outliers'}
+
+def cleaning_stage(filepath, log_path, points=None, tile=None, dedup_tolerance=DEDUP_TOLERANCE, radius_outliers=CLEANING_RADIUS_OUTLIERS):
     """
     Description:
     Driver code for the cleaning stage execution, aimed at producing a less dense point cloud by 
     removing noise and outliers without altering its overall structure. This stage consists of 
-    multiple operations executed in a predefined order.
+    multiple operations executed in a predefined order. The quality gates are checked on the loaded and on the cleaned
+    point cloud, raising a QualityGateError to abort a scan that is not worth cleaning or preprocessing. Clouds of at least TILING_MIN_POINTS points run the
+    operations accepting a tile flag over overlapping tiles on a process pool, see utils.tiling, unless the execution plan decided otherwise.
 
     Parameters:
     filepath (str): The file path of the input point cloud.
     log_path (str): The path to store log files.
+    points (SharedArrayHandle or numpy array, Default = None): The points of the input, used instead of reading filepath, see load_stage_input().
+    tile (bool, Default = None): Run the tileable operations over tiles, decided from the point count if None, see plan_execution().
+    dedup_tolerance (float, Default = DEDUP_TOLERANCE): Duplicate points within this many meters are thinned as the input is loaded,
+        so the neighbour based operations only see unique points, see load_stage_input().
+    radius_outliers (bool, Default = CLEANING_RADIUS_OUTLIERS): Also remove radius outliers after the statistical outliers.
 
     Returns:
     tuple: A tuple containing the filepath of the cleaned point cloud (str) and a flag (bool) 
     indicating whether the stage completed successfully.
     """
-    point_cloud = o3d.io.read_point_cloud(filepath)
     logging.info("Executing Cleaning Stage...")
+    point_cloud = load_stage_input(filepath, points, dedup_tolerance)
+    enforce_quality_gates(np.asarray(point_cloud.points), 'loaded')
     current_step = 0 
+    skipped = set() if radius_outliers else optional_cleaning_operations
+    operations = [operation for _, operation in sorted(cleaning_operations.items()) if operation not in skipped]
+
+    # Large clouds run the operations that decompose into independent tiles on a process pool
+    if tile is None:
+        tile = len(point_cloud.points) >= TILING_MIN_POINTS and tiling_workers() > 1
+    # Built once and shared by every neighbour based operation, kept in sync as points are removed. Tiled runs
+    # do without it, the tiles build their own small KD-trees so nothing spans the whole cloud
+    neighbour_graph = None if tile else NeighbourGraph(np.asarray(point_cloud.points))
     
-    while current_step in cleaning_operations:
-        operation = cleaning_operations[current_step]
+    while current_step < len(operations):
+        operation = operations[current_step]
         
         try:
             # Retrieve the operation function by name and execute it.
             operation_function = globals()[operation]
-            point_cloud, step_completed = operation_function(point_cloud)
+            operation_params = {'tile': tile} if 'tile' in inspect.signature(operation_function).parameters else {}
+            point_cloud, step_completed = operation_function(point_cloud, neighbour_graph=neighbour_graph, **operation_params)
             
             if not step_completed:
                 logging.error(f"Step failed in {operation}, exiting...")
@@ -47,24 +72,28 @@ def cleaning_stage(filepath, log_path):
             
             current_step += 1
 
-            if current_step == len(cleaning_operations): 
+            if current_step == len(operations): 
+                enforce_quality_gates(np.asarray(point_cloud.points), 'cleaning')
                 new_filepath = write_to_file(point_cloud, filepath,"_cl")
                 logging.info("Cleaning stage completed.")
                 return new_filepath, True
             
+        except QualityGateError:
+            raise
         except Exception as e:
             logging.error(f"Error in {operation}: {e}")
             break  
         
-    return new_filepath, False
+    return filepath, False
 
-def extract_xyz_coordinates(point_cloud):
+def extract_xyz_coordinates(point_cloud, neighbour_graph=None):
     """
     Description:
     Extracts XYZ coordinates from a point cloud, removing excess values such as RGB.
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
+    neighbour_graph (NeighbourGraph, Default = None): Unused, the coordinates are unchanged.
 
     Returns:
     tuple: A tuple containing the new point cloud (open3d.geometry.PointCloud), its corresponding 
@@ -80,16 +109,19 @@ def extract_xyz_coordinates(point_cloud):
         logging.error(f"Failed to extract XYZ coordinates: {e}")
         return point_cloud, False
 
-# Deprecated due to resource constraints
-def remove_radius_outliers(point_cloud, nb_neighbors=15, radius=0.05):
+def remove_radius_outliers(point_cloud, nb_neighbors=15, radius=0.05, neighbour_graph=None, tile=False):
     """
     Description:
-    [Deprecated] Removes radius outliers from a point cloud and saves the intermediate state.
+    Removes radius outliers from a point cloud, the points with no more than nb_neighbors other points within
+    the radius. With a neighbour graph this reuses the k-NN distances cached for the statistical outlier
+    removal, a point is kept when its (nb_neighbors + 1)-th nearest neighbour (counting itself) lies within the radius.
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
     nb_neighbors (int): Number of neighbors to use for radius outlier removal. Default is 15.
     radius (float): Radius for outlier removal. Default is 0.05.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
+    tile (bool, Default = False): Count the neighbours over tiles in parallel, see tiled_radius_outliers().
 
     Returns:
     tuple: A tuple containing the new point cloud after removing outliers (open3d.geometry.pointCloud) 
@@ -97,7 +129,14 @@ def remove_radius_outliers(point_cloud, nb_neighbors=15, radius=0.05):
     """
     logging.info("Attempting to remove radius outliers...")
     try:
-        _, rad_ind = point_cloud.remove_radius_outlier(nb_points=nb_neighbors, radius=radius)
+        if tile:
+            rad_ind = tiled_radius_outliers(np.asarray(point_cloud.points), nb_neighbors, radius)
+        elif neighbour_graph is None:
+            _, rad_ind = point_cloud.remove_radius_outlier(nb_points=nb_neighbors, radius=radius)
+        else:
+            distances, _ = neighbour_graph.knn(nb_neighbors + 1)
+            rad_ind = np.flatnonzero(distances[:, -1] <= radius)
+            neighbour_graph.select(rad_ind)
         new_point_cloud = point_cloud.select_by_index(rad_ind)
         logging.info("Radius outliers removed")
         return new_point_cloud, True
@@ -105,15 +144,18 @@ def remove_radius_outliers(point_cloud, nb_neighbors=15, radius=0.05):
         logging.error(f"Failed to remove Radius Outliers: {e}")
         return point_cloud, False
 
-def remove_statistical_outliers(point_cloud, nb_neighbors = 20, std_ratio = 1.0):
+def remove_statistical_outliers(point_cloud, nb_neighbors = 20, std_ratio = 1.0, neighbour_graph=None, tile=False):
     """
     Description:
-    Removes statistical outliers from a point cloud.
+    Removes statistical outliers from a point cloud, points whose average distance to their neighbours
+    is more than std_ratio standard deviations above the mean.
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
     nb_neighbors (int): Number of neighbors to use for statistical outlier removal. Default is 20.
     std_ratio (float): Standard deviation ratio for statistical outlier removal. Default is 1.0.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
+    tile (bool, Default = False): Compute the neighbour distances over tiles in parallel, see tiled_statistical_outliers().
 
     Returns:
     tuple: A tuple containing the new point cloud (open3d.geometry.PointCloud), and a flag (bool) 
@@ -121,14 +163,24 @@ def remove_statistical_outliers(point_cloud, nb_neighbors = 20, std_ratio = 1.0)
     """
     logging.info("Removing statistical outliers...")   
     try:
-        cl, ind = point_cloud.remove_statistical_outlier(nb_neighbors=nb_neighbors, std_ratio=std_ratio)
+        if tile:
+            ind = tiled_statistical_outliers(np.asarray(point_cloud.points), nb_neighbors, std_ratio)
+            if neighbour_graph is not None:
+                neighbour_graph.select(ind)
+        elif neighbour_graph is None:
+            cl, ind = point_cloud.remove_statistical_outlier(nb_neighbors=nb_neighbors, std_ratio=std_ratio)
+        else:
+            average_distances = neighbour_graph.mean_neighbour_distances(nb_neighbors)
+            threshold = average_distances.mean() + std_ratio * average_distances.std(ddof=1)
+            ind = np.flatnonzero(average_distances < threshold)
+            neighbour_graph.select(ind)
         new_point_cloud = point_cloud.select_by_index(ind)
         return new_point_cloud, True
     except Exception as e:
         logging.error(f"Failed to remove statistical outliers: {e}")
         return point_cloud, False
 
-def voxel_downsample(point_cloud, voxel_size = 0.02):
+def voxel_downsample(point_cloud, voxel_size = 0.02, neighbour_graph=None, tile=False):
     """
     Description:
     Downsamples a point cloud using voxel grid downsampling.
@@ -136,6 +188,8 @@ def voxel_downsample(point_cloud, voxel_size = 0.02):
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
     voxel_size (float): Voxel size for downsampling. Default is 0.02.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache, reset to the downsampled points.
+    tile (bool, Default = False): Average the voxels over tiles in parallel, see tiled_voxel_downsample().
 
     Returns:
     tuple: A tuple containing the new point cloud after downsampling (open3d.geometry.PointCloud), 
@@ -143,7 +197,13 @@ def voxel_downsample(point_cloud, voxel_size = 0.02):
     """
     logging.info("Voxel downsampling...")    
     try:
-        new_point_cloud = point_cloud.voxel_down_sample(voxel_size=voxel_size)
+        if tile:
+            new_point_cloud = o3d.geometry.PointCloud()
+            new_point_cloud.points = o3d.utility.Vector3dVector(tiled_voxel_downsample(np.asarray(point_cloud.points), voxel_size))
+        else:
+            new_point_cloud = point_cloud.voxel_down_sample(voxel_size=voxel_size)
+        if neighbour_graph is not None:
+            neighbour_graph.reset(np.asarray(new_point_cloud.points))
         return new_point_cloud, True
     except Exception as e:
         logging.error(f"Failed to voxel downsample: {e}")
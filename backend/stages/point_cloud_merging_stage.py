@@ -0,0 +1,138 @@
+import os
+import json
+import logging
+import numpy as np
+import open3d as o3d
+from utils.file_operations import partial_filepath
+from utils.point_stream import iter_point_chunks
+from utils.point_cloud_utils import fuse_voxels
+from utils.config import (MERGE_ICP_VOXEL_SIZES, MERGE_ICP_DISTANCE_FACTOR, MERGE_ICP_ITERATIONS, MERGE_CONVERGED_DISTANCE,
+                          MERGE_CONVERGED_DEGREES, MERGE_FULL_RESOLUTION_ITERATIONS, MERGE_MIN_FITNESS, MERGE_FUSION_VOXEL_SIZE)
+
+def merging_stage(filepaths, destination_path, log_path, tree_name):
+    """
+    Description:
+    Merges the scans of one tree taken from several scanner stations into a single scan, ahead of the cleaning stage.
+    The first station is the reference; every other station is registered to the stations merged before it with
+    register_station() and the registered stations are fused with fuse_voxels() at MERGE_FUSION_VOXEL_SIZE, so the
+    overlaps are no denser than the rest of the tree. The stations must already be roughly aligned, as exported by
+    the scanner or its registration software, ICP only corrects the remaining offsets.
+    The merged scan is written as .xyz to destination_path, and the transformation and fitness of every station
+    to logs/<tree>_merge.json.
+
+    Parameters:
+    filepaths (list of str): The file paths of the station scans, the reference first.
+    destination_path (str): The path of the merged .xyz scan.
+    log_path (str): The directory holding the logs directory.
+    tree_name (str): The name of the tree.
+
+    Returns:
+    tuple: The path of the merged scan (str) and a flag (bool) indicating whether the stage completed successfully.
+    """
+    logging.info("Executing Merging Stage on %d stations...", len(filepaths))
+    try:
+        stations = [np.concatenate(list(iter_point_chunks(path)) or [np.empty((0, 3))]) for path in filepaths]
+    except (OSError, ValueError) as e:
+        logging.error("Failed to read the stations of %s: %s", tree_name, e)
+        return destination_path, False
+    for path, station in zip(filepaths, stations):
+        if len(station) == 0:
+            logging.error("Station %s has no points", path)
+            return destination_path, False
+
+    registered = [stations[0]]
+    records = [{'path': filepaths[0], 'points': len(stations[0]), 'transformation': np.eye(4).tolist(), 'fitness': 1.0}]
+    for path, station in zip(filepaths[1:], stations[1:]):
+        target = fuse_voxels(np.concatenate(registered), MERGE_FUSION_VOXEL_SIZE)
+        transformation, fitness, success = register_station(station, target)
+        if not success:
+            logging.error("Could not register station %s of %s, only %.0f%% of its points overlap the stations before it", path, tree_name, fitness * 100)
+            return destination_path, False
+        registered.append(_transform_points(station, transformation))
+        records.append({'path': path, 'points': len(station), 'transformation': transformation.tolist(), 'fitness': fitness})
+
+    merged = fuse_voxels(np.concatenate(registered), MERGE_FUSION_VOXEL_SIZE)
+    temporary_path = partial_filepath(destination_path)
+    with open(temporary_path, 'w') as xyz_file:
+        np.savetxt(xyz_file, merged, fmt="%.6f")
+    os.replace(temporary_path, destination_path)
+    logging.info("Merged %d stations of %d points into %d points", len(stations), sum(map(len, stations)), len(merged))
+
+    merge_path = os.path.join(log_path, "logs", tree_name + "_merge.json")
+    try:
+        os.makedirs(os.path.dirname(merge_path), exist_ok=True)
+        with open(partial_filepath(merge_path), 'w') as merge_file:
+            json.dump(records, merge_file, indent=1)
+        os.replace(partial_filepath(merge_path), merge_path)
+    except OSError as e:
+        logging.warning("Could not save the station transformations of %s: %s", tree_name, e)
+
+    logging.info("Merging Stage Completed successfully.")
+    return destination_path, True
+
+def register_station(source, target, initial_transformation=None):
+    """
+    Description:
+    Registers a station to a target cloud with multi-resolution ICP. Point to plane ICP with a Tukey loss runs on
+    voxel downsampled copies of both clouds from the coarsest to the finest of MERGE_ICP_VOXEL_SIZES, each level starting from the
+    transformation of the one before, so the costly fine levels only polish an almost aligned station. Only once
+    the finest level moved the station less than MERGE_CONVERGED_DISTANCE and MERGE_CONVERGED_DEGREES is it refined
+    against the full resolution points, with a few iterations at the finest correspondence distance.
+
+    Parameters:
+    source (numpy array): An (N, 3) array, the points of the station.
+    target (numpy array): An (M, 3) array, the points it is registered to.
+    initial_transformation (numpy array, Default = None): 4x4 initial guess, the identity if None.
+
+    Returns:
+    transformation (numpy array): The 4x4 transformation taking the station onto the target.
+    fitness (float): The share of the station's points within the correspondence distance of the target at the finest level.
+    success (bool): Whether the fitness reached MERGE_MIN_FITNESS.
+    """
+    source_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(source))
+    target_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(target))
+    transformation = np.eye(4) if initial_transformation is None else np.asarray(initial_transformation, dtype=float)
+    fitness, moved, turned = 0.0, np.inf, np.inf
+
+    for voxel_size in MERGE_ICP_VOXEL_SIZES:
+        source_down = source_cloud.voxel_down_sample(voxel_size)
+        target_down = target_cloud.voxel_down_sample(voxel_size)
+        target_down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+        distance = voxel_size * MERGE_ICP_DISTANCE_FACTOR
+        # The robust loss lets the points outside the overlap of the stations weigh less than those inside it
+        result = o3d.pipelines.registration.registration_icp(
+            source_down, target_down, distance, transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(o3d.pipelines.registration.TukeyLoss(k=distance / 2)),
+            o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=MERGE_ICP_ITERATIONS))
+        logging.info("ICP at %.3f m: fitness %.3f, inlier RMSE %.4f m", voxel_size, result.fitness, result.inlier_rmse)
+
+        # How far the level moved the station, by the mean distance of its points so it does not depend on the origin
+        points = np.asarray(source_down.points)
+        moved = np.mean(np.linalg.norm(_transform_points(points, result.transformation) - _transform_points(points, transformation), axis=1))
+        rotation = result.transformation[:3, :3] @ transformation[:3, :3].T
+        turned = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1.0, 1.0)))
+        transformation, fitness = result.transformation, result.fitness
+
+    if fitness < MERGE_MIN_FITNESS:
+        return transformation, fitness, False
+
+    if moved < MERGE_CONVERGED_DISTANCE and turned < MERGE_CONVERGED_DEGREES:
+        distance = MERGE_ICP_VOXEL_SIZES[-1]
+        target_cloud.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=distance * 2, max_nn=30))
+        result = o3d.pipelines.registration.registration_icp(
+            source_cloud, target_cloud, distance, transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(o3d.pipelines.registration.TukeyLoss(k=distance / 2)),
+            o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=MERGE_FULL_RESOLUTION_ITERATIONS))
+        transformation = result.transformation
+        logging.info("ICP at full resolution: fitness %.3f, inlier RMSE %.4f m", result.fitness, result.inlier_rmse)
+    else:
+        logging.warning("Station still moved %.3f m and %.2f degrees at the finest level, skipping the full resolution refinement", moved, turned)
+
+    return transformation, fitness, True
+
+def _transform_points(points, transformation):
+    """
+    Description:
+    Applies a 4x4 rigid transformation to an (N, 3) array of points.
+    """
+    return points @ transformation[:3, :3].T + transformation[:3, 3]
@@ -1,17 +1,23 @@
 import os
 import sys
+import inspect
+import json
 import open3d as o3d
 import numpy as np
 import time
 import logging
-from utils.file_operations import setup_logging, write_to_file
+from utils.file_operations import setup_logging, write_to_file, alignment_filepath, partial_filepath, load_stage_input
 from sklearn.ensemble import IsolationForest
+from sklearn.cluster import DBSCAN
 
 backend_dir = os.path.dirname(os.path.abspath(__file__))
 if backend_dir not in sys.path:
     sys.path.insert(0, backend_dir)
     
-from utils.point_cloud_utils import get_height, slice_point_cloud, fit_circle_to_points 
+from utils.point_cloud_utils import get_height, slice_point_cloud, fit_circle_to_points, estimate_stem_axis, rotation_to_vertical
+from utils.neighbour_graph import NeighbourGraph
+from utils.concurrency import get_n_jobs
+from utils.quality_gates import enforce_quality_gates
 
 # Map of the order of functions for this stage with the value being the name of the function to be called
 # Parameters can be updated here which will be passed into the function
@@ -19,57 +25,72 @@ preprocessing_operations = {
     0: {'function': 'ground_segmentation', 'params': {}},
     1: {'function': 'remove_outliers_isolation_forest', 'params': {'num_iterations': 12}},
     2: {'function': 'keep_only_largest_cluster', 'params': {}},
-    3: {'function': 'reduce_branches', 'params': {}},
+    3: {'function': 'align_stem_axis', 'params': {}},
+    4: {'function': 'reduce_branches', 'params': {}},
 }
 
-def preprocessing_stage(filepath, log_path):
+def preprocessing_stage(filepath, log_path, points=None):
     """        
     Description:
     This driver function preprocesses a point cloud by using various pre-defined, and custom functions to 
     reduce what we define as "noise" to produce as close to a tree taper as we can. 
+    Operations accepting a stage_info dictionary can record information for the later stages, which is saved
+    next to the output as <tree name>_alignment.json (currently the rotation applied by align_stem_axis).
+    The quality gates are checked on the result, raising a QualityGateError for a taper the processing stage cannot measure.
     
     Parameters:
     filepath (str): The file path of the input point cloud.
     log_path (str): The path to store log files.
+    points (SharedArrayHandle or numpy array, Default = None): The points of the input, used instead of reading filepath, see load_stage_input().
 
     Returns:
     new_filepath (str): The file path of the final processed point cloud.
     bool: True if the preprocessing is successful, False otherwise.
     """
     logging.info("Preprocessing Stage Initiated")
-    point_cloud = o3d.io.read_point_cloud(filepath)
+    point_cloud = load_stage_input(filepath, points)
+
+    # Built once and shared by every neighbour based operation, kept in sync as points are removed
+    neighbour_graph = NeighbourGraph(np.asarray(point_cloud.points))
+    stage_info = {}
 
     for current_step, operation_info in preprocessing_operations.items():
         operation_function = globals()[operation_info['function']]
-        operation_params = operation_info['params']
+        operation_params = dict(operation_info['params'])
+        if 'stage_info' in inspect.signature(operation_function).parameters:
+            operation_params['stage_info'] = stage_info
 
         try:
             # Execute the preprocessing function with parameters unpacked
-            if operation_params:
-                point_cloud, success_flag = operation_function(point_cloud, **operation_params)
-            else:
-                point_cloud, success_flag = operation_function(point_cloud)
+            point_cloud, success_flag = operation_function(point_cloud, neighbour_graph=neighbour_graph, **operation_params)
                 
             if not success_flag:
                 logging.error(f"Error in {operation_info['function']}, exiting...")
-                return None
+                return filepath, False
                 
         except Exception as e:
             logging.error(f"Error in {operation_info['function']}: {e}")
-            return None
+            return filepath, False
 
     # After completing all steps, update the filename to reflect preprocessing completion and write the updated point cloud
+    enforce_quality_gates(np.asarray(point_cloud.points), 'preprocessing')
     new_filepath = write_to_file(point_cloud, filepath,"_pp")
+    if stage_info:
+        info_path = alignment_filepath(new_filepath)
+        with open(partial_filepath(info_path), 'w') as info_file:
+            json.dump(stage_info, info_file)
+        os.replace(partial_filepath(info_path), info_path)
     logging.info("Preprocessing Stage Completed successfully.")
     return new_filepath, True
 
-def ground_segmentation(point_cloud):
+def ground_segmentation(point_cloud, neighbour_graph=None):
     """
     Description:
     Loads a point cloud isolates the ground plane by slicing the point cloud vertically and finding the largest plane, vertically. 
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
 
     Returns:
     point_cloud (open3d.geometry.PointCloud): Point cloud with the removed ground plane
@@ -85,6 +106,8 @@ def ground_segmentation(point_cloud):
             if np.any(~mask): 
                 point_cloud.points = o3d.utility.Vector3dVector(np.asarray(point_cloud.points)[mask])
                 z_values = z_values[mask]
+                if neighbour_graph is not None:
+                    neighbour_graph.select(mask)
                 break
         return point_cloud, True
     
@@ -92,7 +115,7 @@ def ground_segmentation(point_cloud):
         logging.error(f"Failed to isolate ground points: {e}")
         return point_cloud, False
 
-def isolation_forest_step(point_cloud, contamination=0.12):
+def isolation_forest_step(point_cloud, contamination=0.12, neighbour_graph=None):
     """
     Description:
     Identifies and removes outliers based on the contamination rate.
@@ -100,6 +123,7 @@ def isolation_forest_step(point_cloud, contamination=0.12):
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The input point cloud.
     contamination (float): Estimated proportion of outliers.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
 
     Returns:
     point_cloud (open3d.geometry.PointCloud): Point cloud after outlier removal.
@@ -108,11 +132,13 @@ def isolation_forest_step(point_cloud, contamination=0.12):
     logging.info("Attempting a step of Isolation Forest...")
     try:
         xyz = np.asarray(point_cloud.points)
-        model = IsolationForest(contamination=contamination)
+        model = IsolationForest(contamination=contamination, n_jobs=get_n_jobs())
         model.fit(xyz)
         outliers = model.predict(xyz)
         inliers_mask = outliers > 0
         point_cloud = point_cloud.select_by_index(np.where(inliers_mask)[0])
+        if neighbour_graph is not None:
+            neighbour_graph.select(inliers_mask)
         return point_cloud, True
 
     except Exception as e:
@@ -120,7 +146,7 @@ def isolation_forest_step(point_cloud, contamination=0.12):
         return point_cloud, False
 
     
-def remove_outliers_isolation_forest(point_cloud, num_iterations=12, contamination=0.12):
+def remove_outliers_isolation_forest(point_cloud, num_iterations=12, contamination=0.12, neighbour_graph=None):
     """
     Description:
     Refines the point cloud by repeatedly removing outliers with the Isolation Forest algorithm.
@@ -129,6 +155,7 @@ def remove_outliers_isolation_forest(point_cloud, num_iterations=12, contaminati
     point_cloud (open3d.geometry.PointCloud): The input point cloud.
     num_iterations (int, Default = 12): Number of iterations to refine outlier removal.
     contamination (float, Default = 0.12): Estimated proportion of outliers in each iteration.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
 
     Returns:
     point_cloud (open3d.geometry.PointCloud): Processed point cloud with outliers removed.
@@ -138,7 +165,7 @@ def remove_outliers_isolation_forest(point_cloud, num_iterations=12, contaminati
     success_flag = True
     for iteration in range(num_iterations):
         try:
-            point_cloud, success_flag = isolation_forest_step(point_cloud, contamination)
+            point_cloud, success_flag = isolation_forest_step(point_cloud, contamination, neighbour_graph)
             if not success_flag:
                 break 
             
@@ -148,15 +175,17 @@ def remove_outliers_isolation_forest(point_cloud, num_iterations=12, contaminati
     logging.info("Iterative Isolation Forest Stage Completed")
     return point_cloud, success_flag
 
-def keep_only_largest_cluster(point_cloud, eps=0.05, min_points=10):
+def keep_only_largest_cluster(point_cloud, eps=0.05, min_points=10, neighbour_graph=None):
     """
     Description:
-    Applies DBSCAN clustering to a point cloud, identifying the largest continuous cluster of points
+    Applies DBSCAN clustering to a point cloud, identifying the largest continuous cluster of points.
+    With a neighbour graph the eps-neighbourhoods are taken from the shared KD-tree rather than building a new one.
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The point cloud to process.
     eps (float, Default = 0.05): Maximum distance between two data points for neighborhood.
     min_points (int, Default = 10): Minimum number of points considered as a cluster.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache of the point cloud.
 
     Returns:
     point_cloud (open3d.geometry.PointCloud): The point cloud after keeping only the largest cluster.
@@ -164,17 +193,70 @@ def keep_only_largest_cluster(point_cloud, eps=0.05, min_points=10):
     """
     logging.info("Attempting DBSCAN...")
     try:
-        labels = np.array(point_cloud.cluster_dbscan(eps=eps, min_points=min_points, print_progress=False))
+        if neighbour_graph is None:
+            labels = np.array(point_cloud.cluster_dbscan(eps=eps, min_points=min_points, print_progress=False))
+        else:
+            radius_graph = neighbour_graph.radius_neighbour_graph(eps)
+            labels = DBSCAN(eps=eps, min_samples=min_points, metric="precomputed", n_jobs=get_n_jobs()).fit_predict(radius_graph)
         largest_cluster_idx = np.argmax(np.bincount(labels[labels >= 0]))
         largest_cluster_indices = np.where(labels == largest_cluster_idx)[0]
         point_cloud = point_cloud.select_by_index(largest_cluster_indices)
+        if neighbour_graph is not None:
+            neighbour_graph.select(largest_cluster_indices)
         return point_cloud, True
 
     except Exception as e:
         logging.error(f"Failed DBSCAN: {e}")
         return point_cloud, False
     
-def reduce_branches(point_cloud):
+def align_stem_axis(point_cloud, voxel_size=0.05, min_tilt_degrees=0.5, max_tilt_degrees=45, neighbour_graph=None, stage_info=None):
+    """
+    Description:
+    Rotates a leaning tree so its stem runs along Z, so that reduce_branches() and the measurements of the 
+    processing stage slice perpendicular to the stem instead of cutting ellipses. The stem axis is estimated 
+    once on a voxel subsample, see estimate_stem_axis(), and the points are rotated in place about the axis centre.
+
+    Parameters:
+    point_cloud (open3d.geometry.PointCloud): The input point cloud representing a tree taper.
+    voxel_size (float, Default = 0.05): Voxel size of the subsample used to estimate the axis.
+    min_tilt_degrees (float, Default = 0.5): Smaller tilts are left as they are.
+    max_tilt_degrees (float, Default = 45): Larger tilts are assumed to be a failed estimate and left as they are.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache, rotated along with the points.
+    stage_info (dict, Default = None): Receives the applied 'stem_rotation' and 'stem_tilt_degrees'.
+
+    Returns:
+    point_cloud (open3d.geometry.PointCloud): The point cloud with the stem along Z
+    Bool: Denotes completion of the function
+    """
+    logging.info("Estimating stem axis...")
+    try:
+        points = np.asarray(point_cloud.points)
+        axis, centre = estimate_stem_axis(points, voxel_size)
+        tilt_degrees = float(np.degrees(np.arccos(np.clip(axis[2], -1, 1))))
+
+        if tilt_degrees < min_tilt_degrees:
+            logging.info("Stem tilt of %.2f degrees, no alignment needed", tilt_degrees)
+            return point_cloud, True
+        if tilt_degrees > max_tilt_degrees:
+            logging.warning("Estimated stem tilt of %.2f degrees is implausible, leaving the tree as it is", tilt_degrees)
+            return point_cloud, True
+
+        rotation = rotation_to_vertical(axis)
+        points[:] = (points - centre) @ rotation.T + centre
+        if neighbour_graph is not None:
+            neighbour_graph.rotate(rotation, centre)
+        if stage_info is not None:
+            stage_info['stem_rotation'] = rotation.tolist()
+            stage_info['stem_tilt_degrees'] = tilt_degrees
+
+        logging.info("Aligned the stem axis, tilted %.2f degrees from vertical", tilt_degrees)
+        return point_cloud, True
+
+    except Exception as e:
+        logging.error("Failed to align the stem axis: %s", e)
+        return point_cloud, False
+
+def reduce_branches(point_cloud, neighbour_graph=None):
     """
     Description:
     Reduces the branches along the tree taper by performing incremental slices and using cylinder fitting
@@ -182,6 +264,7 @@ def reduce_branches(point_cloud):
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The input point cloud representing a tree taper.
+    neighbour_graph (NeighbourGraph, Default = None): Shared neighbour cache, reset since points are moved.
 
     Returns:
     point_cloud (open3d.geometry.PointCloud): The point cloud with adjusted outliers to be inliers
@@ -220,5 +303,7 @@ def reduce_branches(point_cloud):
             original_points[mask] = updated_points
 
             point_cloud.points = o3d.utility.Vector3dVector(original_points)
-            
+
+    if neighbour_graph is not None:
+        neighbour_graph.reset(np.asarray(point_cloud.points))
     return point_cloud, True
\ No newline at end of file
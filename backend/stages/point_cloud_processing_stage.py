@@ -1,10 +1,15 @@
 from tkinter.tix import Tree
 import open3d as o3d
 import logging
-from utils.point_cloud_utils import calculate_diameter_at_height, get_height
-from utils.file_operations import get_base_filename
-import csv
-import math
+from utils.point_cloud_utils import fit_slice_at_height, sort_points_by_height, get_height
+import numpy as np
+from utils.file_operations import get_base_filename, write_csv, alignment_filepath
+import json
+from utils.run_journal import RunJournal
+from utils.taper_model import TaperModel
+from utils.tree_metrics import compute_tree_metrics, metric_headers, metric_values
+from utils.thumbnails import render_tree_thumbnail, thumbnail_directory
+from utils.octree_index import OctreeIndex
 
 ### Added for log testing, remove when implemented ###
 import os
@@ -12,24 +17,42 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from utils.file_operations import setup_logging
 
-def processing_stage(filepath, log_path):
+# Spacing in meters of the slice fits the continuous taper model is fitted to
+TAPER_MODEL_SPACING = 0.25
+
+# Half thickness in meters of the band read around each height re-measured from the octree, the thickest slab of
+# fit_slice_at_height()
+REMEASURE_HALF_THICKNESS = 0.15
+
+def processing_stage(filepath, log_path, render_thumbnail=False):
     """
     Description:
     Analyzes a tree point cloud to measure the Circumference, to obtain Diameter, at various heights by taking in a point cloud of a cleaned tree taper.
     The heights required are defined by the Ministry of Natural Resources and Forestry. DBH Defined at 1.3 meters, it measures this, and the heights below DBH
     (0.1, 0.5, and 0.9) and then starting from DBH, it calculates the rest of the tree divided into 10 equal segments. 
     Creates a csv file in a directory called ./csv in the same directory filepath is located with the information appended to it in a standardized format of 
-    Tree name, Total height, Increment for the cookies above dbh, estimated volume, the height and diameter for the remaining 9 cookies as individual entries each(so 2 for each cookie)
+    Tree name, Total height, Increment for the cookies above dbh, estimated volume, the height and diameter for the remaining 9 cookies as individual entries each(so 2 for each cookie),
+    followed by the fit quality of each cookie and the extended metrics of compute_tree_metrics() (basal area, form factor, lean, sweep and
+    merchantable volumes), which are derived from the cookie fits without another pass over the point cloud. Every cookie is fitted on an adaptive slab, see fit_slice_at_height(), so sparse upper stems still produce a diameter.
+    A continuous TaperModel is also fitted to slices every TAPER_MODEL_SPACING meters and saved beside the csv as <tree name>_taper.json,
+    so diameters and volumes at any other height can be queried without reprocessing the point cloud.
+    An OctreeIndex sidecar of the taper is built from the points already in memory, so measure_diameters_at() and the
+    comparison view later read only the part of the cloud they need.
+    With render_thumbnail a PNG of the side profile and the taper is rendered headlessly from the arrays already in memory
+    to ./thumbnails/<tree name>.png, see render_tree_thumbnail().
     
     Parameters:
     filepath (str): The file path of the point cloud.
     log_path (str): The path to store log files.
+    render_thumbnail (bool, Default = False): Render the thumbnail of the tree.
     
     Returns:
     measurements(list of dictionaries): a list of dictionaries denoting height of the measurement ('height') 
         and the diameter ('diameter') at that height. 
     """
     point_cloud = o3d.io.read_point_cloud(filepath)
+    # Sorted once so every cookie locates its slab with a binary search
+    sorted_points = sort_points_by_height(np.asarray(point_cloud.points))
 
     base_height, highest_point, total_height = get_height(point_cloud)
     
@@ -41,6 +64,8 @@ def processing_stage(filepath, log_path):
     number_of_cookies = 10
     increment_height = (total_height - DBH) / number_of_cookies
     measurements = []
+    fit_qualities = []
+    centres = []
     current_height = base_height + DBH
 
     base_directory, base_filename, _ = get_base_filename(filepath)
@@ -51,29 +76,25 @@ def processing_stage(filepath, log_path):
         'taper volume': 0  
     }
 
-    # Below DBH
-    for height in under_dbh_height:
-        diameter = calculate_diameter_at_height(point_cloud, base_height + height)
-        measurements.append([height, diameter])
-
-    # From DBH upward
-    for _ in range(number_of_cookies):
-        diameter = calculate_diameter_at_height(point_cloud, current_height)
-        measurements.append([current_height - base_height, diameter])
-        current_height += increment_height
-
-    # Calculate volume based on the previous measurments using volume of a cone for each segment, and appending the results
-    total_volume = 0
-    for i in range(1, len(measurements)):
-        height1, diameter1 = measurements[i - 1]
-        height2, diameter2 = measurements[i]
-        h = height2 - height1
-        r1 = diameter1 / 2
-        r2 = diameter2 / 2
-        volume = (1/3) * math.pi * h * (r1**2 + r1*r2 + r2**2)
-        total_volume += volume
-        
-    tree_info['taper volume'] = total_volume
+    cookie_heights = [base_height + height for height in under_dbh_height]
+    cookie_heights += [current_height + i * increment_height for i in range(number_of_cookies)]
+
+    for cookie_height in cookie_heights:
+        slice_fit = fit_slice_at_height(sorted_points, cookie_height)
+        if slice_fit is None:
+            logging.warning("No diameter could be measured at %.2f m", cookie_height - base_height)
+            measurements.append([cookie_height - base_height, None])
+            fit_qualities.append(None)
+            centres.append(None)
+        else:
+            measurements.append([cookie_height - base_height, slice_fit['diameter']])
+            fit_qualities.append(slice_fit['fit_quality'])
+            centres.append((slice_fit['x'], slice_fit['y']))
+
+    # Volume uses the volume of a cone for each segment between cookies, segments with a missing diameter on either end are left out
+    heights, diameters = zip(*measurements)
+    tree_metrics = compute_tree_metrics(heights, diameters, centres, total_height, DBH, stem_rotation=load_stem_rotation(filepath))
+    tree_info['taper volume'] = tree_metrics['volume']
 
     # Prepare row data for CSV output
     row_data = [
@@ -85,20 +106,107 @@ def processing_stage(filepath, log_path):
     # Add measurements to the row data
     for measurement in measurements:
         row_data.extend(measurement)
+    row_data.extend(fit_qualities)
+    row_data.extend(metric_values(tree_metrics))
    
     headers = ['tree_name', 'tree_height', 'increment', 'volume']
-    for i in range(1, len(row_data) // 2): 
+    for i in range(1, len(measurements) + 1): 
         headers.extend([f'height_{i}', f'diameter_{i}'])
+    headers.extend([f'fit_quality_{i}' for i in range(1, len(measurements) + 1)])
+    headers.extend(metric_headers())
     
     # Write a csv to a new (or existing) directory called /csv
     csv_directory = base_directory + "/csv"
     if not os.path.exists(csv_directory):
         os.makedirs(csv_directory)        
     csv_filename = os.path.join(csv_directory, base_filename + ".csv")
-    
-    with open(csv_filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)  
-        writer.writerow(row_data)
+    write_csv(csv_filename, headers, row_data)
+    taper_model = fit_taper_model(sorted_points, base_height, total_height, os.path.join(csv_directory, base_filename + "_taper.json"))
+    if render_thumbnail:
+        render_tree_thumbnail(sorted_points, measurements, total_height,
+                              os.path.join(thumbnail_directory(base_directory), base_filename + ".png"), taper_model)
+    try:
+        OctreeIndex.build(filepath, sorted_points)
+    except (OSError, ValueError) as e:
+        logging.warning("Failed to build the octree index of %s: %s", filepath, e)
+    RunJournal(log_path).record_stage(base_filename, "processing", csv_filename)
         
-    return row_data
\ No newline at end of file
+    return row_data
+
+def measure_diameters_at(filepath, heights):
+    """
+    Description:
+    Re-measures the diameter of a processed tree taper at arbitrary heights above its base. Only the band around
+    each height is read from the OctreeIndex of the cloud, which is built first if missing or out of date.
+
+    Parameters:
+    filepath (str): The file path of the point cloud given to processing_stage().
+    heights (list of float): The heights above the base of the tree in meters.
+
+    Returns:
+    measurements(list of lists): The height and the diameter at that height, None where no circle could be fitted.
+    """
+    index = OctreeIndex.open(filepath, build=True)
+    base_height = index.min_bound[2]
+    measurements = []
+    for height in heights:
+        band = index.z_range(base_height + height - REMEASURE_HALF_THICKNESS, base_height + height + REMEASURE_HALF_THICKNESS)
+        slice_fit = fit_slice_at_height(sort_points_by_height(band), base_height + height) if len(band) else None
+        if slice_fit is None:
+            logging.warning("No diameter could be measured at %.2f m", height)
+        measurements.append([height, None if slice_fit is None else slice_fit['diameter']])
+    return measurements
+
+def fit_taper_model(sorted_points, base_height, total_height, model_path):
+    """
+    Description:
+    Fits a TaperModel to slices taken every TAPER_MODEL_SPACING meters along the stem and saves it to model_path.
+    Each slice is weighted by its fit quality so poorly fitted slices pull the model less.
+
+    Parameters:
+    sorted_points (numpy array): The points of the tree taper sorted by Z.
+    base_height (float): The Z value of the base of the tree.
+    total_height (float): The height of the tree.
+    model_path (str): The path of the JSON file to save the model to.
+
+    Returns:
+    TaperModel or None: The fitted model, or None if too few slices could be fitted.
+    """
+    heights, radii, weights = [], [], []
+    for height in np.arange(TAPER_MODEL_SPACING / 2, total_height, TAPER_MODEL_SPACING):
+        slice_fit = fit_slice_at_height(sorted_points, base_height + height)
+        if slice_fit is not None:
+            heights.append(height)
+            radii.append(slice_fit['radius'])
+            weights.append(1 / (slice_fit['fit_quality'] + 1e-3))
+
+    try:
+        taper_model = TaperModel(heights, radii, total_height, weights)
+    except ValueError as e:
+        logging.error("Failed to fit a taper model: %s", e)
+        return None
+
+    taper_model.save(model_path)
+    logging.info("Taper model saved to %s", model_path)
+    return taper_model
+
+def load_stem_rotation(filepath):
+    """
+    Description:
+    Reads the rotation applied to the tree by align_stem_axis() during preprocessing, if any.
+
+    Parameters:
+    filepath (str): The file path of the point cloud.
+
+    Returns:
+    list or None: The 3x3 rotation matrix, or None if the tree was not rotated.
+    """
+    info_path = alignment_filepath(filepath)
+    if not os.path.exists(info_path):
+        return None
+    try:
+        with open(info_path) as info_file:
+            return json.load(info_file).get('stem_rotation')
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read the stem alignment of %s: %s", filepath, e)
+        return None
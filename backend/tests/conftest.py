@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The backend modules import each other as top level packages (from utils.x import ...), as when run from backend
+backend_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if backend_root not in sys.path:
+    sys.path.insert(0, backend_root)
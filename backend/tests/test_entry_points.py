@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+import pytest
+
+repository_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The scripts documented in the README, each run the way it is documented: python ./backend/<script>.py
+SCRIPTS = ["main.py", "watch.py", "service.py", "benchmark.py", "client.py"]
+
+@pytest.mark.parametrize("script", SCRIPTS)
+def test_script_starts_without_pythonpath(script):
+    environment = {name: value for name, value in os.environ.items() if name != "PYTHONPATH"}
+    result = subprocess.run([sys.executable, os.path.join(".", "backend", script), "--help"], cwd=repository_root,
+                            env=environment, capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert "usage:" in result.stdout
+
+def test_cold_start_times_a_working_cli():
+    from client import cold_start_seconds
+    assert cold_start_seconds() > 0
@@ -0,0 +1,83 @@
+import os
+import pytest
+import point_cloud_processor
+from utils.run_journal import RunJournal
+from utils.file_operations import stage_filepath
+
+STAGES = ['cleaning', 'preprocessing']
+
+def write_points(path, lines=100):
+    with open(path, 'w') as file:
+        file.writelines(f"{index} {index} {index}\n" for index in range(lines))
+    return path
+
+@pytest.fixture
+def journal(tmp_path):
+    """
+    A journal in which tree completed the cleaning and preprocessing stages.
+    """
+    journal = RunJournal(str(tmp_path))
+    for stage, suffix in [('cleaning', '_cl'), ('preprocessing', '_pp')]:
+        journal.record_stage("tree", stage, write_points(str(tmp_path / f"tree{suffix}.xyz")))
+    return journal
+
+def test_resumes_from_the_most_advanced_intact_stage(journal, tmp_path):
+    assert journal.resume_point("tree", STAGES) == ('preprocessing', str(tmp_path / "tree_pp.xyz"))
+
+def test_truncated_output_is_redone(journal, tmp_path):
+    path = tmp_path / "tree_pp.xyz"
+    with open(path, 'r+') as file:
+        file.truncate(os.path.getsize(path) // 2)
+    assert not journal.is_completed("tree", 'preprocessing')
+    assert journal.resume_point("tree", STAGES) == ('cleaning', str(tmp_path / "tree_cl.xyz"))
+
+def test_output_rewritten_with_the_same_size_is_redone(journal, tmp_path):
+    path = tmp_path / "tree_pp.xyz"
+    assert journal.is_completed("tree", 'preprocessing')
+    stat = os.stat(path)
+    with open(path, 'r+') as file:
+        file.write("9")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert os.path.getsize(path) == stat.st_size
+    assert not journal.is_completed("tree", 'preprocessing')
+
+def test_missing_output_is_redone(journal, tmp_path):
+    os.remove(tmp_path / "tree_pp.xyz")
+    assert not journal.is_completed("tree", 'preprocessing')
+    assert journal.resume_point("tree", STAGES) == ('cleaning', str(tmp_path / "tree_cl.xyz"))
+    os.remove(tmp_path / "tree_cl.xyz")
+    assert journal.resume_point("tree", STAGES) == (None, None)
+
+def test_quick_check_trusts_size_and_modification_time(journal, tmp_path):
+    assert journal.resume_point("tree", STAGES, verify=False)[0] == 'preprocessing'
+    os.utime(tmp_path / "tree_pp.xyz", ns=(0, 0))
+    assert journal.resume_point("tree", STAGES, verify=False)[0] == 'cleaning'
+
+def test_rejected_stage_is_not_completed(tmp_path):
+    journal = RunJournal(str(tmp_path))
+    journal.record_stage("tree", 'cleaning', None, "rejected", "insufficient_height")
+    assert not journal.is_completed("tree", 'cleaning')
+    assert journal.rejections() == {"tree": "insufficient_height"}
+
+def test_extract_tree_taper_resumes_after_cleaning(tmp_path, monkeypatch):
+    raw_path = write_points(str(tmp_path / "tree.xyz"))
+    cleaned_path = write_points(str(tmp_path / "tree_cl.xyz"))
+    RunJournal(str(tmp_path)).record_stage("tree", 'cleaning', cleaned_path)
+    calls = []
+
+    def cleaning_stage(filepath, log_path, points=None, tile=None):
+        raise AssertionError("the completed cleaning stage was run again")
+
+    def preprocessing_stage(filepath, log_path, points=None):
+        calls.append(filepath)
+        return write_points(stage_filepath(filepath, '_pp')), True
+
+    monkeypatch.setattr(point_cloud_processor, 'cleaning_stage', cleaning_stage)
+    monkeypatch.setattr(point_cloud_processor, 'preprocessing_stage', preprocessing_stage)
+    processed_path = point_cloud_processor.extract_tree_taper(raw_path, str(tmp_path))
+
+    assert calls == [cleaned_path]
+    assert processed_path == str(tmp_path / "tree_pr.xyz") and os.path.isfile(processed_path)
+    # The consumed input is removed once the stage is recorded
+    assert not os.path.exists(cleaned_path)
+    assert RunJournal(str(tmp_path)).resume_point("tree", STAGES) == ('preprocessing', processed_path)
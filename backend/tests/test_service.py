@@ -0,0 +1,68 @@
+import asyncio
+import time
+import pytest
+import service
+from service import ProcessingService, HTTPError
+
+def write_scan(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("0 0 0\n1 1 1\n")
+    return str(path)
+
+@pytest.fixture
+def run_service(tmp_path, monkeypatch):
+    """
+    Runs a function against a service whose jobs stay queued, no worker pool is started.
+    """
+    async def never_runs(self, job):
+        pass
+    monkeypatch.setattr(ProcessingService, "_run", never_runs)
+
+    def run(function):
+        async def main():
+            return function(ProcessingService(str(tmp_path / "uploads"), workers=1, threads=1, max_queued=2))
+        return asyncio.run(main())
+    return run
+
+def test_pending_tree_is_coalesced(tmp_path, run_service):
+    scan = write_scan(tmp_path / "tree.xyz")
+    def submit_twice(processing_service):
+        first, created = processing_service.submit(scan)
+        again, created_again = processing_service.submit(scan, str(tmp_path / "pinecone"))
+        other, created_other = processing_service.submit(scan, str(tmp_path / "elsewhere"))
+        return created, again is first, created_again, created_other, len(processing_service.jobs)
+    assert run_service(submit_twice) == (True, True, False, True, 2)
+
+def test_finished_tree_is_processed_again(tmp_path, run_service):
+    scan = write_scan(tmp_path / "tree.xyz")
+    def resubmit(processing_service):
+        first, _ = processing_service.submit(scan)
+        first.update(status='done', finished_at=time.time())
+        second, created = processing_service.submit(scan)
+        return created, second is first
+    assert run_service(resubmit) == (True, False)
+
+def test_queue_limit_counts_distinct_trees(tmp_path, run_service):
+    scans = [write_scan(tmp_path / f"tree{index}.xyz") for index in range(3)]
+    def fill(processing_service):
+        for scan in scans[:2]:
+            processing_service.submit(scan)
+        processing_service.submit(scans[0])
+        with pytest.raises(HTTPError) as error:
+            processing_service.submit(scans[2])
+        return error.value.status
+    assert run_service(fill) == 503
+
+def test_finished_jobs_are_evicted_by_count_and_age(tmp_path, run_service, monkeypatch):
+    monkeypatch.setattr(service, "SERVICE_FINISHED_JOBS", 2)
+    scans = [write_scan(tmp_path / f"tree{index}.xyz") for index in range(5)]
+    def finish_and_evict(processing_service):
+        now = time.time()
+        jobs = []
+        for index, scan in enumerate(scans[:4]):
+            jobs.append(processing_service.submit(scan)[0])
+            jobs[-1].update(status='done', finished_at=now + index)
+        jobs[0]['finished_at'] = now - service.SERVICE_FINISHED_JOB_SECONDS - 1
+        pending, _ = processing_service.submit(scans[4])
+        return set(processing_service.jobs) == {jobs[2]['id'], jobs[3]['id'], pending['id']}
+    assert run_service(finish_and_evict)
@@ -0,0 +1,59 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from utils.tiling import plan_tiles, tiled_statistical_outliers, tiled_radius_outliers, tiled_voxel_downsample
+
+# Tile widths small enough that every operation crosses many tile edges, run inline and on a process pool
+TILINGS = [
+    {'tile_size': 0.3, 'workers': 1},
+    {'tile_size': 0.3, 'workers': 2},
+    {'tile_size': 0.45, 'tile_height': 0.4, 'workers': 2},
+]
+
+@pytest.fixture(scope="module")
+def points():
+    """
+    A trunk-like cylinder with scattered noise, 1.5 m across and 2 m high.
+    """
+    rng = np.random.default_rng(7)
+    angles = rng.uniform(0, 2 * np.pi, 30000)
+    radii = 0.3 + rng.normal(0, 0.01, angles.size)
+    trunk = np.column_stack([radii * np.cos(angles), radii * np.sin(angles), rng.uniform(0, 2, angles.size)])
+    noise = rng.uniform([-0.75, -0.75, 0], [0.75, 0.75, 2], (1500, 3))
+    return np.concatenate([trunk, noise])
+
+def to_point_cloud(points):
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+
+def test_plan_tiles_covers_every_point_once(points):
+    order, tiles = plan_tiles(points, 0.3)
+    assert np.array_equal(np.sort(order), np.arange(len(points)))
+    assert tiles[0]['start'] == 0 and tiles[-1]['end'] == len(points)
+    for tile in tiles:
+        core = points[order[tile['start']:tile['end']], :2]
+        assert np.all(core >= tile['core_min']) and np.all(core < tile['core_max'] + 1e-9)
+
+@pytest.mark.parametrize("tiling", TILINGS)
+def test_tiled_statistical_outliers_matches_untiled(points, tiling):
+    _, expected = to_point_cloud(points).remove_statistical_outlier(nb_neighbors=20, std_ratio=1.0)
+    kept = tiled_statistical_outliers(points, 20, 1.0, **tiling)
+    assert np.array_equal(kept, np.sort(expected))
+
+@pytest.mark.parametrize("tiling", TILINGS)
+def test_tiled_radius_outliers_matches_untiled(points, tiling):
+    _, expected = to_point_cloud(points).remove_radius_outlier(nb_points=15, radius=0.05)
+    kept = tiled_radius_outliers(points, 15, 0.05, **tiling)
+    assert np.array_equal(kept, np.sort(expected))
+
+@pytest.mark.parametrize("tiling", TILINGS[:2])
+def test_tiled_voxel_downsample_matches_untiled(points, tiling):
+    expected = np.asarray(to_point_cloud(points).voxel_down_sample(0.02).points)
+    downsampled = tiled_voxel_downsample(points, 0.02, **tiling)
+    assert downsampled.shape == expected.shape
+    # Both are one centroid per voxel, only the order of the voxels differs
+    assert np.allclose(downsampled[np.lexsort(downsampled.T)], expected[np.lexsort(expected.T)])
+
+def test_tiled_voxel_downsample_does_not_depend_on_the_tiling(points):
+    one_tile = tiled_voxel_downsample(points, 0.02, tile_size=10.0, workers=1)
+    many_tiles = tiled_voxel_downsample(points, 0.02, tile_size=0.25, workers=2)
+    assert np.allclose(one_tile, many_tiles)
@@ -0,0 +1,96 @@
+import os
+import logging
+
+# Environment variables read by the native thread pools of Open3D (OpenMP), NumPy/SciPy (OpenBLAS, MKL) and numexpr
+THREAD_ENVIRONMENT_VARIABLES = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+]
+
+# Fewest threads worth giving a worker, Isolation Forest and the KD-tree queries stop scaling well below this
+MIN_THREADS_PER_WORKER = 2
+
+# Thread budget of the current process, None until apply_thread_limits() is called
+_thread_budget = None
+
+def get_cpu_count():
+    """
+    Description:
+    Gets the number of cores this process is allowed to run on, falling back to the total core count.
+
+    Returns:
+    int: The number of usable cores.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def plan_concurrency(num_jobs=1, workers=None, threads=None, cores=None):
+    """
+    Description:
+    Splits the available cores between worker processes and threads per worker so the two never
+    oversubscribe the CPU. A single tree gets one worker using every core, a batch gets as many workers as
+    there are trees while keeping at least MIN_THREADS_PER_WORKER threads each. Either value can be fixed
+    by the caller, in which case the other is derived from it.
+
+    Parameters:
+    num_jobs (int, Default = 1): Number of trees to be processed.
+    workers (int, Default = None): Fixed number of worker processes.
+    threads (int, Default = None): Fixed number of threads per worker.
+    cores (int, Default = None): Number of cores to plan for, defaults to the usable core count.
+
+    Returns:
+    workers (int): Number of worker processes.
+    threads (int): Number of threads per worker.
+    """
+    cores = cores or get_cpu_count()
+    num_jobs = max(1, num_jobs)
+
+    if workers is None and threads is None:
+        workers = min(num_jobs, max(1, cores // MIN_THREADS_PER_WORKER))
+    elif workers is None:
+        workers = min(num_jobs, max(1, cores // threads))
+
+    workers = max(1, min(workers, num_jobs))
+    if threads is None:
+        threads = max(1, cores // workers)
+
+    return workers, threads
+
+def apply_thread_limits(threads):
+    """
+    Description:
+    Limits the native thread pools of the current process to the given number of threads. The environment
+    variables are inherited by any worker process started afterwards, and threadpoolctl (installed alongside
+    scikit-learn) is used to resize the pools of libraries that are already loaded.
+
+    Parameters:
+    threads (int): Number of threads this process may use.
+    """
+    global _thread_budget
+    _thread_budget = max(1, int(threads))
+
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(_thread_budget)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=_thread_budget)
+    except ImportError:
+        logging.warning("threadpoolctl is not available, thread limits only apply to newly started processes")
+
+    logging.info("Thread budget set to %d", _thread_budget)
+
+def get_n_jobs():
+    """
+    Description:
+    Gets the number of threads to pass as n_jobs/workers to scikit-learn and SciPy in this process.
+
+    Returns:
+    int: The thread budget, or -1 (all cores) if no budget has been applied.
+    """
+    return _thread_budget if _thread_budget is not None else -1
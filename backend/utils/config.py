@@ -4,3 +4,84 @@ STAGE_PREFIXES = [
     ('preprocessing', '_pp'),
     ('processing', '_pr')
 ]
+
+
+# Name of the run journal kept in each destination directory
+JOURNAL_FILENAME = 'pinecone_journal.sqlite'
+
+# Name of the csv aggregating the metrics of every tree of a destination directory, one row per tree
+RESULTS_FILENAME = 'pinecone_results.csv'
+
+# Name of the state file the hot folder watcher keeps in the watched directory
+WATCH_STATE_FILENAME = 'pinecone_watch.json'
+
+# Times a scan is processed again after the pool of the watcher broke while it was queued or running
+WATCH_MAX_POOL_CRASHES = 3
+
+# Marker inserted before the extension of files that are still being written
+PARTIAL_SUFFIX = '.partial'
+
+# Suffix of the memory mappable .npy cache of a scan's points, written next to the scan
+POINT_CACHE_SUFFIX = '_points.npy'
+
+# Finished jobs the processing service keeps for their status and result, and the seconds it keeps each of them
+SERVICE_FINISHED_JOBS = 1000
+SERVICE_FINISHED_JOB_SECONDS = 24 * 3600
+
+# Most points read at a time when streaming a scan
+STREAM_CHUNK_POINTS = 500_000
+
+# Memory the comparison view may use in megabytes, and the memory used by each displayed point
+# (float64 position and colour held by Open3D plus the float32 copies uploaded for rendering)
+VISUALIZER_MEMORY_BUDGET_MB = 1024
+BYTES_PER_DISPLAYED_POINT = 72
+
+# Points of a raw scan in the same cell of this size in meters are duplicates (multiple returns, overlapping sweeps)
+# and only the first is loaded by the cleaning stage, 0 keeps every point
+DEDUP_TOLERANCE = 0.001
+
+# The neighbour graph keeps its KD-tree as points are removed until fewer than this share of its points remain
+NEIGHBOUR_TREE_REBUILD_FRACTION = 0.5
+
+# Radius outlier removal is opt-in, the statistical outlier removal alone cleans typical scans
+CLEANING_RADIUS_OUTLIERS = False
+
+# Clouds with at least this many points run the tileable cleaning operations on tiles over a process pool
+TILING_MIN_POINTS = 2_000_000
+
+# Width in meters of the halo of neighbouring points each tile sees, and the number of tiles per worker
+TILE_OVERLAP = 0.1
+TILES_PER_WORKER = 4
+
+# Suffix of the octree sidecar directory written next to each processed cloud, and the average points per leaf
+OCTREE_SUFFIX = '_octree'
+OCTREE_LEAF_POINTS = 4096
+
+# Share of the available memory a processing run plans to use, and the peak bytes per point measured for the
+# in memory stages (Open3D copies, KD-trees and the neighbour graph) and estimated for the tiled cleaning stage,
+# which holds the Open3D copies and the points in tile order but no KD-tree over the whole cloud
+PLANNER_MEMORY_FRACTION = 0.7
+PLANNER_IN_MEMORY_BYTES_PER_POINT = 800
+PLANNER_TILED_BYTES_PER_POINT = 400
+
+# Raw scan points processed per second by the whole pipeline on one core, for the predicted cost of a plan
+PLANNER_POINTS_PER_SECOND = 35_000
+
+# Coarse to fine registration of the stations of a multi-station scan: voxel sizes in meters of the downsampled
+# levels, the distance within which points correspond as a factor of the voxel size, and the iterations per level.
+# The coarsest distance stays below the radius of a thin stem, so points seen by one station only do not pull
+# it onto the far side of the stem seen by the other
+MERGE_ICP_VOXEL_SIZES = (0.1, 0.05, 0.02)
+MERGE_ICP_DISTANCE_FACTOR = 1.5
+MERGE_ICP_ITERATIONS = 30
+
+# A station is refined at full resolution once the finest level moved its points less than the finest voxel size
+# on average and turned it less than MERGE_CONVERGED_DEGREES, and rejected when fewer than MERGE_MIN_FITNESS of its
+# points correspond at the finest level
+MERGE_CONVERGED_DISTANCE = 0.02
+MERGE_CONVERGED_DEGREES = 1.0
+MERGE_FULL_RESOLUTION_ITERATIONS = 10
+MERGE_MIN_FITNESS = 0.2
+
+# Voxel size in meters the registered stations are fused at, half the voxel size of the cleaning stage
+MERGE_FUSION_VOXEL_SIZE = 0.01
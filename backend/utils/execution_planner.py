@@ -0,0 +1,223 @@
+import os
+import json
+import ctypes
+import logging
+import laspy
+from utils.config import (TILING_MIN_POINTS, PLANNER_MEMORY_FRACTION, PLANNER_IN_MEMORY_BYTES_PER_POINT,
+                          PLANNER_TILED_BYTES_PER_POINT, PLANNER_POINTS_PER_SECOND)
+from utils.concurrency import plan_concurrency, get_cpu_count
+from utils.file_operations import partial_filepath
+from utils.point_stream import load_point_cache, STREAMABLE_EXTENSIONS, LAS_EXTENSIONS
+
+# Execution strategies, see plan_execution()
+STRATEGY_IN_MEMORY = "in_memory"
+STRATEGY_TILED = "tiled"
+STRATEGY_DOWNSAMPLED = "downsampled"
+
+# Bytes read from the start of a text scan to estimate its bytes per point
+ESTIMATE_SAMPLE_BYTES = 1024 * 1024
+
+# Bytes per point of a scan loaded into shared memory by a batch, float64 XYZ
+SHARED_BYTES_PER_POINT = 24
+
+class _MemoryStatus(ctypes.Structure):
+    """
+    Description:
+    The MEMORYSTATUSEX structure filled by GlobalMemoryStatusEx on Windows.
+    """
+    _fields_ = [
+        ('dwLength', ctypes.c_ulong),
+        ('dwMemoryLoad', ctypes.c_ulong),
+        ('ullTotalPhys', ctypes.c_ulonglong),
+        ('ullAvailPhys', ctypes.c_ulonglong),
+        ('ullTotalPageFile', ctypes.c_ulonglong),
+        ('ullAvailPageFile', ctypes.c_ulonglong),
+        ('ullTotalVirtual', ctypes.c_ulonglong),
+        ('ullAvailVirtual', ctypes.c_ulonglong),
+        ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+    ]
+
+def available_memory():
+    """
+    Description:
+    Gets the memory available to new allocations without swapping: the available physical memory reported by
+    GlobalMemoryStatusEx on Windows, MemAvailable on Linux and the free physical pages elsewhere.
+
+    Returns:
+    int or None: The available memory in bytes, None if it cannot be determined.
+    """
+    if os.name == "nt":
+        status = _MemoryStatus()
+        status.dwLength = ctypes.sizeof(_MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return int(status.ullAvailPhys)
+        return None
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_point_count(path):
+    """
+    Description:
+    Estimates the number of points of a scan without reading it: exact from the point cache or a LAS header,
+    from the size of the file and the length of its first lines for text formats.
+
+    Parameters:
+    path (str): The file path of the scan.
+
+    Returns:
+    int: The estimated number of points.
+    """
+    cached_points = load_point_cache(path)
+    if cached_points is not None:
+        return len(cached_points)
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in LAS_EXTENSIONS:
+        with laspy.open(path) as reader:
+            return int(reader.header.point_count)
+
+    file_size = os.path.getsize(path)
+    if extension in STREAMABLE_EXTENSIONS:
+        with open(path, 'rb') as scan_file:
+            sample = scan_file.read(ESTIMATE_SAMPLE_BYTES)
+        lines = sample.count(b'\n')
+        if lines == 0 or len(sample) == file_size:
+            return max(lines, 1)
+        return int(file_size / (len(sample) / lines))
+    # Binary formats store at least three floats per point
+    return file_size // 12
+
+def plan_execution(path, memory_budget=None, threads=None, shared=False):
+    """
+    Description:
+    Chooses how a scan is processed from its estimated point count and the memory it may use:
+    in_memory: The whole scan goes through the stages as is, when PLANNER_IN_MEMORY_BYTES_PER_POINT per point fit.
+    tiled: The points are loaded into shared memory, or a memory mapped file when shared memory is short, and the
+        cleaning operations run over tiles on a process pool, each tile building its own KD-tree, so neither the
+        shared neighbour graph nor any other KD-tree over the whole scan is built.
+        Needs at least TILING_MIN_POINTS points, more than one thread and PLANNER_TILED_BYTES_PER_POINT per point.
+    downsampled: The scan is streamed and voxel downsampled to the points that fit in memory before the stages.
+    The predicted cost is the peak memory from the same per point figures and the time from PLANNER_POINTS_PER_SECOND,
+    measured on a single core; both are rough, meant to explain the decision rather than to schedule by.
+
+    Parameters:
+    path (str): The file path of the scan.
+    memory_budget (int, Default = None): Bytes the tree may use, a share of the available memory if None.
+    threads (int, Default = None): Threads the tree may use, every core if None.
+    shared (bool, Default = False): The points are also held in shared memory, as loaded by process_batch(), at
+        SHARED_BYTES_PER_POINT per point on top of the in memory cost.
+
+    Returns:
+    plan (dict): The 'strategy', 'max_points' to downsample to (None unless downsampled), 'tile' flag for the
+        cleaning stage (True when tiled, None to let the stage decide), the inputs of the decision and the 'predicted_peak_mb' and 'predicted_seconds'.
+    """
+    threads = threads or get_cpu_count()
+    estimated_points = estimate_point_count(path)
+    if memory_budget is None:
+        available = available_memory()
+        memory_budget = int(available * PLANNER_MEMORY_FRACTION) if available is not None else None
+
+    strategy, max_points, processed_points = STRATEGY_IN_MEMORY, None, estimated_points
+    in_memory_bytes_per_point = PLANNER_IN_MEMORY_BYTES_PER_POINT + (SHARED_BYTES_PER_POINT if shared else 0)
+    bytes_per_point = in_memory_bytes_per_point
+    if memory_budget is None:
+        reason = "the available memory is unknown"
+    elif estimated_points * in_memory_bytes_per_point <= memory_budget:
+        reason = "the scan fits in memory"
+    elif (estimated_points >= TILING_MIN_POINTS and threads > 1
+          and estimated_points * PLANNER_TILED_BYTES_PER_POINT <= memory_budget):
+        strategy, bytes_per_point = STRATEGY_TILED, PLANNER_TILED_BYTES_PER_POINT
+        reason = "the scan only fits in memory without global neighbour graphs"
+    else:
+        strategy = STRATEGY_DOWNSAMPLED
+        max_points = processed_points = max(1, memory_budget // in_memory_bytes_per_point)
+        reason = f"the scan exceeds the memory budget {estimated_points / max_points:.1f} times"
+
+    return {
+        'path': path,
+        'file_size_mb': round(os.path.getsize(path) / 1024 ** 2, 1),
+        'estimated_points': estimated_points,
+        'memory_budget_mb': None if memory_budget is None else round(memory_budget / 1024 ** 2),
+        'threads': threads,
+        'strategy': strategy,
+        'reason': reason,
+        'max_points': max_points,
+        # Only the tiled strategy forces tiling, the cleaning stage decides from the point count otherwise
+        'tile': True if strategy == STRATEGY_TILED else None,
+        'predicted_peak_mb': round(processed_points * bytes_per_point / 1024 ** 2),
+        'predicted_seconds': round(processed_points / PLANNER_POINTS_PER_SECOND, 1),
+    }
+
+def plan_batch(paths, workers=None, threads=None, prefetch=None):
+    """
+    Description:
+    Plans a batch: the number of workers from plan_concurrency(), reduced while the largest scans processed in
+    memory at the same time, with the largest scans loaded ahead of them, would exceed the available memory, then
+    the plan of every scan with its share of the memory left by the scans loaded ahead and its share of the
+    threads. A fixed number of workers is kept, its scans are downsampled instead.
+
+    Parameters:
+    paths (list of str): The file paths of the scans.
+    workers (int, Default = None): Fixed number of worker processes.
+    threads (int, Default = None): Fixed number of threads per worker.
+    prefetch (int, Default = None): Scans loaded into shared memory ahead of the workers, see process_batch(); the
+        number of workers if None.
+
+    Returns:
+    workers (int): Number of worker processes.
+    threads (int): Number of threads per worker.
+    plans (list of dict): The plan of each scan, see plan_execution().
+    """
+    planned_workers, planned_threads = plan_concurrency(len(paths), workers, threads)
+    available = available_memory()
+    points = sorted((estimate_point_count(path) for path in paths), reverse=True)
+
+    def prefetched_bytes(worker_count):
+        ahead = max(1, worker_count if prefetch is None else prefetch)
+        return sum(points[:ahead]) * SHARED_BYTES_PER_POINT
+
+    if workers is None and available is not None:
+        usable = available * PLANNER_MEMORY_FRACTION
+        peaks = [count * (PLANNER_IN_MEMORY_BYTES_PER_POINT + SHARED_BYTES_PER_POINT) for count in points]
+        while planned_workers > 1 and sum(peaks[:planned_workers]) + prefetched_bytes(planned_workers) > usable:
+            planned_workers -= 1
+        planned_workers, planned_threads = plan_concurrency(len(paths), planned_workers, threads)
+
+    memory_budget = None
+    if available is not None:
+        usable = max(available * PLANNER_MEMORY_FRACTION - prefetched_bytes(planned_workers), 0)
+        memory_budget = int(usable / planned_workers)
+    plans = [plan_execution(path, memory_budget, planned_threads, shared=True) for path in paths]
+    return planned_workers, planned_threads, plans
+
+def log_execution_plan(plan, tree_name, log_path):
+    """
+    Description:
+    Logs the decision of a plan to the log of the tree and saves the plan as logs/<tree>_plan.json beside it.
+
+    Parameters:
+    plan (dict): The plan, see plan_execution().
+    tree_name (str): The name of the tree.
+    log_path (str): The directory holding the logs directory.
+    """
+    logging.info("Execution plan for %s: %s (%s), %d points estimated, predicted peak %d MB and %.1f s",
+                 tree_name, plan['strategy'], plan['reason'], plan['estimated_points'], plan['predicted_peak_mb'],
+                 plan['predicted_seconds'])
+    plan_path = os.path.join(log_path, "logs", tree_name + "_plan.json")
+    try:
+        os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+        temporary_path = partial_filepath(plan_path)
+        with open(temporary_path, 'w') as plan_file:
+            json.dump(plan, plan_file, indent=1)
+        os.replace(temporary_path, plan_path)
+    except OSError as e:
+        logging.warning("Could not save the execution plan of %s: %s", tree_name, e)
@@ -1,9 +1,24 @@
 import open3d as o3d
+import numpy as np
 import logging
 import os
 import glob
-from utils.config import STAGE_PREFIXES
-import logging
+import csv
+import queue
+import shutil
+import threading
+import contextvars
+from contextlib import contextmanager
+from utils.config import STAGE_PREFIXES, PARTIAL_SUFFIX
+from utils.logging_utils import set_tree_context
+from utils.shared_arrays import SharedArrayHandle, attached_array
+from utils.spatial_hash import deduplicate_points
+
+# Writer of the stage outputs of the current context, see background_writes()
+_background_writer = contextvars.ContextVar("pinecone_background_writer", default=None)
+
+# Stage outputs queued on a background writer and not yet on disk, by file path
+_pending_outputs = {}
 
 def read_point_cloud(path):
     """
@@ -33,6 +48,58 @@ def read_point_cloud(path):
         return None
 
 
+def load_stage_input(filepath, points=None, dedup_tolerance=None):
+    """
+    Description:
+    Builds the Open3D point cloud a stage works on: from points handed over by the caller when given, so a
+    worker process given a SharedArrayHandle maps the shared points instead of reading or unpickling them,
+    otherwise from the file. The points are copied into Open3D here, at the only place the stage needs it.
+    The output of the previous stage that a background writer has not finished writing is taken from memory.
+    With a dedup_tolerance the duplicate points are thinned on the way in, see deduplicate_points(), before the
+    copy for points handed over, and the number removed is logged.
+
+    Parameters:
+    filepath (str): The file path of the point cloud, read when points is None.
+    points (SharedArrayHandle or numpy array, Default = None): The (N, 3) points of the point cloud.
+    dedup_tolerance (float, Default = None): Cell size in meters within which points are duplicates, no thinning if None.
+
+    Returns:
+    open3d.geometry.PointCloud: The point cloud.
+    """
+    if points is None:
+        pending_point_cloud = _pending_outputs.get(filepath)
+        if pending_point_cloud is not None:
+            # Still being written by the background writer, the stage before left it in memory
+            point_cloud = o3d.geometry.PointCloud(pending_point_cloud)
+        else:
+            point_cloud = o3d.io.read_point_cloud(filepath)
+        if dedup_tolerance:
+            unique_points, removed = _deduplicate(np.asarray(point_cloud.points), dedup_tolerance)
+            if removed:
+                point_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(unique_points))
+        return point_cloud
+
+    point_cloud = o3d.geometry.PointCloud()
+    if isinstance(points, SharedArrayHandle):
+        with attached_array(points) as shared_points:
+            unique_points, _ = _deduplicate(shared_points[:, :3], dedup_tolerance)
+            point_cloud.points = o3d.utility.Vector3dVector(np.ascontiguousarray(unique_points, dtype=np.float64))
+    else:
+        unique_points, _ = _deduplicate(np.asarray(points)[:, :3], dedup_tolerance)
+        point_cloud.points = o3d.utility.Vector3dVector(np.ascontiguousarray(unique_points, dtype=np.float64))
+    return point_cloud
+
+def _deduplicate(points, dedup_tolerance):
+    """
+    Description:
+    deduplicate_points() logging the number of points removed, the points are returned as is without a tolerance.
+    """
+    if not dedup_tolerance:
+        return points, 0
+    unique_points, removed = deduplicate_points(points, dedup_tolerance)
+    logging.info("Removed %d duplicate points within %g m on load, %d remain", removed, dedup_tolerance, len(unique_points))
+    return unique_points, removed
+
 def modify_filename(filepath, prefix):
     """    
     Description:
@@ -48,14 +115,71 @@ def modify_filename(filepath, prefix):
     new_filepath (str): The modified file path with the updated or appended prefix and step.
     """
     
-    directory, name, ext = get_base_filename(filepath)
-    new_filename = f"{name}{prefix}{ext}"
-    new_filepath = os.path.join(directory, new_filename)
+    new_filepath = stage_filepath(filepath, prefix)
 
     if os.path.exists(filepath):
-        os.rename(filepath, new_filepath)
+        os.replace(filepath, new_filepath)
     return new_filepath
 
+def stage_filepath(filepath, prefix):
+    """
+    Description:
+    Builds the file path for a processing stage prefix without touching the file on disk, removing any
+    existing stage prefix before adding the new one.
+
+    Parameters:
+    filepath (str): The original file path.
+    prefix (str): The new prefix to add or update in the filename.
+
+    Returns:
+    str: The file path with the updated or appended prefix.
+    """
+    directory, name, ext = get_base_filename(filepath)
+    return os.path.join(directory, f"{name}{prefix}{ext}")
+
+def partial_filepath(filepath):
+    """
+    Description:
+    Builds the temporary path a file is written to before being atomically moved into place. The marker is
+    inserted before the extension so writers that infer the format from the extension still work.
+
+    Parameters:
+    filepath (str): The final file path.
+
+    Returns:
+    str: The temporary file path.
+    """
+    name, ext = os.path.splitext(filepath)
+    return f"{name}{PARTIAL_SUFFIX}{ext}"
+
+def alignment_filepath(filepath):
+    """
+    Description:
+    Path of the alignment sidecar of a tree, written by the preprocessing stage next to its output.
+
+    Parameters:
+    filepath (str): The path of any stage file of the tree.
+
+    Returns:
+    str: The path of <tree name>_alignment.json in the same directory.
+    """
+    directory, name, _ = get_base_filename(filepath)
+    return os.path.join(directory, f"{name}_alignment.json")
+
+def copy_file_atomic(source_path, destination_path):
+    """
+    Description:
+    Copies a file to a temporary path next to the destination and renames it into place, so an interrupted
+    copy never leaves a truncated file under the destination name.
+
+    Parameters:
+    source_path (str): The file to copy.
+    destination_path (str): The path to copy it to.
+    """
+    temporary_path = partial_filepath(destination_path)
+    shutil.copyfile(source_path, temporary_path)
+    os.replace(temporary_path, destination_path)
+
 def get_base_filename(filepath):
     """
     Description:
@@ -83,7 +207,10 @@ def write_to_file(point_cloud, filepath, prefix):
     """    
     Description:
     This function updates the provided filepath by appending a specified prefix to the filename.
-    Uses modify_filename() for the name itself, then writes the given point cloud to that file
+    Uses stage_filepath() for the name itself, then writes the given point cloud to a temporary file which
+    is renamed to that name once complete, so a crash never leaves a truncated file under a stage name.
+    Inside background_writes() the write is queued and the path returned right away, see after_writes().
+    The original file is left in place for the caller to remove once the new one is recorded.
     
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The up to date point cloud to be written to new file.
@@ -93,33 +220,208 @@ def write_to_file(point_cloud, filepath, prefix):
     Returns:
     str: The modified file path with the updated or appended prefix and step.
     """
-    new_filepath = modify_filename(filepath, prefix)
-    o3d.io.write_point_cloud(new_filepath, point_cloud)
+    new_filepath = stage_filepath(filepath, prefix)
+    writer = _background_writer.get()
+    if writer is None:
+        _write_point_cloud(point_cloud, new_filepath)
+    else:
+        _pending_outputs[new_filepath] = point_cloud
+        writer.submit(_write_point_cloud, point_cloud, new_filepath)
     return new_filepath
 
-def setup_logging(log_name, log_path):
+def _write_point_cloud(point_cloud, filepath):
+    """
+    Description:
+    Writes a point cloud to a temporary file renamed to filepath once complete.
+    """
+    temporary_path = partial_filepath(filepath)
+    try:
+        if not o3d.io.write_point_cloud(temporary_path, point_cloud):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise IOError(f"Failed to write point cloud to {filepath}")
+        os.replace(temporary_path, filepath)
+    finally:
+        _pending_outputs.pop(filepath, None)
+
+class BackgroundWriter:
     """
-    Set up logging configuration to save log messages to a file, creating a new logger for each file processed.
+    Description:
+    Runs write tasks on a background thread in the order they are submitted, so the output of a stage is written
+    while the next stage computes. At most max_pending tasks wait, further submissions block until one completes.
+    Once a task fails the remaining ones are skipped, as they may depend on it, and flush() raises its error.
+    The thread runs in a copy of the submitting context, so its log records go to the log of the tree.
 
     Parameters:
-    filepath (str): The file path of the point cloud, used to generate log file name.
-    log_path (str): Directory path where log file will be saved.
+    max_pending (int, Default = 2): Most tasks waiting to run.
     """
-    logger = logging.getLogger(log_name)
-    logger.setLevel(logging.INFO)
 
-    log_directory = os.path.join(log_path, "logs")
-    os.makedirs(log_directory, exist_ok=True)
-    log_file = os.path.join(log_directory, log_name + ".log")
+    def __init__(self, max_pending=2):
+        self._tasks = queue.Queue(maxsize=max_pending)
+        self._error = None
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run,), name="pinecone-writer", daemon=True)
+        self._thread.start()
 
-    # Check if the logger already has handlers to prevent duplicate logs
-    if not logger.handlers:
-        file_handler = logging.FileHandler(log_file)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-    
-    return logger
+    def submit(self, function, *args):
+        """
+        Description:
+        Queues function(*args) to run after the tasks submitted before it.
+        """
+        self._tasks.put((function, args))
+
+    def flush(self):
+        """
+        Description:
+        Waits for every submitted task to complete.
+
+        Raises:
+        Exception: The error of the first task that failed since the last flush().
+        """
+        self._tasks.join()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        """
+        Description:
+        Waits for the submitted tasks and stops the thread, without raising their errors.
+        """
+        self._tasks.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                function, args = task
+                if self._error is None:
+                    function(*args)
+            except Exception as e:
+                logging.error("Background write failed: %s", e)
+                self._error = e
+            finally:
+                self._tasks.task_done()
+
+@contextmanager
+def background_writes(max_pending=2):
+    """
+    Description:
+    Context manager making write_to_file() queue its writes on a BackgroundWriter, and after_writes() run its
+    callbacks once the writes before them completed. The writes are flushed on exit.
+
+    Parameters:
+    max_pending (int, Default = 2): Most writes waiting to run.
+
+    Yields:
+    BackgroundWriter: The writer, flush() it before reading a written file from disk.
+    """
+    writer = BackgroundWriter(max_pending)
+    token = _background_writer.set(writer)
+    try:
+        yield writer
+        writer.flush()
+    finally:
+        _background_writer.reset(token)
+        writer.close()
+
+def after_writes(function, *args):
+    """
+    Description:
+    Runs function(*args) once the writes queued so far are on disk: on the background writer, after them, inside
+    background_writes(), and right away otherwise. Used for what must only happen to a complete file, such as
+    recording it in the run journal.
+
+    Parameters:
+    function (callable): The function to run.
+    *args: Its arguments.
+    """
+    writer = _background_writer.get()
+    if writer is None:
+        function(*args)
+    else:
+        writer.submit(function, *args)
+
+def write_csv(csv_filename, headers, row_data):
+    """
+    Description:
+    Writes a header and a single row to a UTF-8 csv file, through a temporary file renamed into place once complete.
+
+    Parameters:
+    csv_filename (str): The path of the csv file.
+    headers (list): The column names.
+    row_data (list): The values of the row.
+    """
+    temporary_path = partial_filepath(csv_filename)
+    with open(temporary_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(headers)
+        writer.writerow(row_data)
+    os.replace(temporary_path, csv_filename)
+
+def read_metrics_csv(csv_filename):
+    """
+    Description:
+    Reads back the row of metrics written by the processing stage, converting numeric values to floats.
+
+    Parameters:
+    csv_filename (str): The path of the csv file.
+
+    Returns:
+    list: The row data in the same format returned by processing_stage().
+    """
+    with open(csv_filename, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        row = next(reader)
+    return parse_metrics_row(row)
+
+def parse_metrics_row(row):
+    """
+    Description:
+    Converts a row of metrics read from a csv file back to the format returned by processing_stage(): numeric
+    values as floats, empty values as None.
+
+    Parameters:
+    row (list of str): The values of the row.
+
+    Returns:
+    list: The row data.
+    """
+    # The tree name is always kept as text, even when it looks like a number
+    return [row[0]] + [parse_metric_value(value) for value in row[1:]]
+
+def parse_metric_value(value):
+    """
+    Description:
+    Converts a value of a metrics csv to a float, or None if empty, keeping other text as is.
+
+    Parameters:
+    value (str): The value read from the csv.
+
+    Returns:
+    float, str or None: The converted value.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return value if value != '' else None
+
+def setup_logging(log_name, log_path):
+    """
+    Set up logging so the messages logged while processing a file are saved to a log file named after it.
+    Messages go through the background writer of utils.logging_utils, so logging never blocks on file I/O,
+    and are routed by tree, so each tree gets its own file even when several are processed by a pool of workers.
+
+    Parameters:
+    log_name (str): The base filename of the point cloud, used as the log file name.
+    log_path (str): Directory path where the logs directory will be created.
+    """
+    set_tree_context(log_name, log_path)
+    return logging.getLogger(log_name)
 
 
 def find_processed_file(input_filename, search_directory):
@@ -142,8 +444,8 @@ def find_processed_file(input_filename, search_directory):
         pattern = os.path.join(search_directory, file_to_search + '*')
         matching_files = glob.glob(pattern)
     
-        # Filter out directories
-        matching_files = [f for f in matching_files if os.path.isfile(f)]
+        # Filter out directories and files that are still being written
+        matching_files = [f for f in matching_files if os.path.isfile(f) and PARTIAL_SUFFIX not in os.path.basename(f)]
         matched_file = matching_files[0] if matching_files else None
         if matched_file is not None:
                 logging.info(f"Existing file found at {0}, resuming from this file...", matched_file)
@@ -0,0 +1,225 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import contextvars
+import multiprocessing
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+import queue as queue_module
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Most per-tree log files kept open at once by the router
+MAX_OPEN_LOG_FILES = 32
+
+# Most message groups tracked by the sampling filter, the least recently logged are forgotten first
+MAX_SAMPLED_LOG_GROUPS = 10000
+
+# The tree being processed by the current thread, and the directory its log file goes to
+_tree_context = contextvars.ContextVar("pinecone_tree_context", default=(None, None))
+
+# Process-wide state of the logging pipeline, set up once by start_logging() or configure_worker_logging()
+_state_lock = threading.Lock()
+_log_queue = None
+_listener = None
+
+class TreeContextFilter(logging.Filter):
+    """
+    Description:
+    Stamps every record with the tree being processed and the directory of its log file, so the records can be
+    routed to the right file after they have crossed a queue, possibly from another process.
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "tree"):
+            record.tree, record.log_directory = _tree_context.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """
+    Description:
+    Rate limits repetitive records below WARNING. Records are grouped by logger and message template (not the
+    formatted message, so the arguments do not matter); each group may log `burst` records per `interval`
+    seconds and the rest are dropped before they are formatted or queued. The next record let through in a
+    group reports how many were dropped. Warnings and errors are never dropped. Only the MAX_SAMPLED_LOG_GROUPS
+    most recently logged groups are tracked.
+
+    Parameters:
+    burst (int, Default = 20): Records allowed per group per interval.
+    interval (float, Default = 1.0): Length of the interval in seconds.
+    """
+
+    def __init__(self, burst=20, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._groups.pop(key, (now, 0, 0))
+            # Messages formatted before logging each form their own group, forget the least recently logged
+            if len(self._groups) >= MAX_SAMPLED_LOG_GROUPS:
+                self._groups.popitem(last=False)
+            if now - window_start >= self.interval:
+                window_start, count = now, 0
+            if count >= self.burst:
+                self._groups[key] = (window_start, count, suppressed + 1)
+                return False
+            self._groups[key] = (window_start, count + 1, 0)
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+class TreeRoutingHandler(logging.Handler):
+    """
+    Description:
+    Writes every record to the console handler, and records of a tree to that tree's log file in addition.
+    Runs in the background thread of the QueueListener, so file writes never block the processing code.
+    Only the most recently used files are kept open.
+
+    Parameters:
+    console_level (int, Default = logging.WARNING): Lowest level written to the console.
+    """
+
+    def __init__(self, console_level=logging.WARNING):
+        super().__init__()
+        formatter = logging.Formatter(LOG_FORMAT)
+        self.console_handler = logging.StreamHandler()
+        self.console_handler.setLevel(console_level)
+        self.console_handler.setFormatter(formatter)
+        self.formatter = formatter
+        self._file_handlers = OrderedDict()
+
+    def _file_handler(self, tree, log_directory):
+        log_file = os.path.join(log_directory, tree + ".log")
+        handler = self._file_handlers.pop(log_file, None)
+        if handler is None:
+            os.makedirs(log_directory, exist_ok=True)
+            handler = logging.FileHandler(log_file)
+            handler.setFormatter(self.formatter)
+            if len(self._file_handlers) >= MAX_OPEN_LOG_FILES:
+                _, oldest = self._file_handlers.popitem(last=False)
+                oldest.close()
+        self._file_handlers[log_file] = handler
+        return handler
+
+    def emit(self, record):
+        if record.levelno >= self.console_handler.level:
+            self.console_handler.handle(record)
+        tree = getattr(record, "tree", None)
+        log_directory = getattr(record, "log_directory", None)
+        if tree and log_directory:
+            try:
+                self._file_handler(tree, log_directory).handle(record)
+            except OSError:
+                self.handleError(record)
+
+    def close(self):
+        for handler in self._file_handlers.values():
+            handler.close()
+        self._file_handlers.clear()
+        self.console_handler.close()
+        super().close()
+
+def _install_queue_handler(log_queue, level):
+    """
+    Description:
+    Replaces the handlers of the root logger with a single QueueHandler feeding log_queue.
+    """
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(TreeContextFilter())
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+def start_logging(multiprocess=False, level=logging.INFO, console_level=logging.WARNING, context=None):
+    """
+    Description:
+    Sets up the non-blocking logging pipeline of the main process: the root logger only puts records on a queue
+    and a QueueListener thread routes them to the console and to the log file of their tree. Safe to call more
+    than once, an existing pipeline is reused unless a multiprocess queue is needed and only a local one exists.
+
+    Parameters:
+    multiprocess (bool, Default = False): Use a multiprocessing queue that worker processes can log to, see configure_worker_logging().
+    level (int, Default = logging.INFO): Lowest level recorded.
+    console_level (int, Default = logging.WARNING): Lowest level written to the console.
+    context (multiprocessing context, Default = None): Context of the worker processes the queue is passed to, the
+        default context if None. A queue can only be sent to processes started by the context that created it.
+
+    Returns:
+    queue: The queue records are sent through, to be passed to worker processes.
+    """
+    global _log_queue, _listener
+    with _state_lock:
+        if _listener is not None:
+            if not multiprocess or not isinstance(_log_queue, queue_module.Queue):
+                return _log_queue
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+
+        _log_queue = (context or multiprocessing).Queue(-1) if multiprocess else queue_module.Queue(-1)
+        _listener = QueueListener(_log_queue, TreeRoutingHandler(console_level), respect_handler_level=False)
+        _listener.start()
+        _install_queue_handler(_log_queue, level)
+    return _log_queue
+
+def stop_logging():
+    """
+    Description:
+    Flushes the queue and stops the listener thread, closing every log file.
+    """
+    global _listener
+    with _state_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+atexit.register(stop_logging)
+
+def configure_worker_logging(log_queue, level=logging.INFO):
+    """
+    Description:
+    Sends the records of a worker process to the queue of the main process, which writes them. Used as (part of)
+    the initializer of a process pool, with the queue returned by start_logging(multiprocess=True).
+
+    Parameters:
+    log_queue (multiprocessing.Queue): The queue of the main process.
+    level (int, Default = logging.INFO): Lowest level recorded.
+    """
+    global _log_queue, _listener
+    with _state_lock:
+        # A forked worker inherits the listener of the main process, which only the main process may stop
+        _listener = None
+        _log_queue = log_queue
+        _install_queue_handler(log_queue, level)
+
+def set_tree_context(tree, log_path):
+    """
+    Description:
+    Routes the records logged from now on by this thread (or task) to logs/<tree>.log inside log_path, starting
+    the logging pipeline if this process has none yet.
+
+    Parameters:
+    tree (str): The base filename of the tree.
+    log_path (str): The directory in which the logs directory is created.
+    """
+    if _log_queue is None:
+        start_logging()
+    _tree_context.set((tree, os.path.join(log_path, "logs")))
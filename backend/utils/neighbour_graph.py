@@ -0,0 +1,206 @@
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+from utils.concurrency import get_n_jobs
+from utils.config import NEIGHBOUR_TREE_REBUILD_FRACTION
+
+class NeighbourGraph:
+    """
+    Description:
+    A KD-tree and k-nearest-neighbour cache built once per point cloud and shared between the cleaning and
+    preprocessing operations, so statistical outliers, radius outliers and DBSCAN all query the same index
+    instead of each building their own. The cache follows the point cloud as operations mask points away:
+    rows that lost a neighbour are marked stale and only those are re-queried the next time they are needed.
+    The KD-tree is kept as points are removed, its queries skipping the removed points, and is only rebuilt
+    lazily once fewer than NEIGHBOUR_TREE_REBUILD_FRACTION of the points it was built over remain.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of the point coordinates.
+    k (int, Default = 20): Number of neighbours (including the point itself) to cache per point.
+    """
+
+    def __init__(self, points, k=20):
+        self.k = k
+        self.reset(points)
+
+    def reset(self, points):
+        """
+        Description:
+        Discards the cached tree and neighbours, used when an operation moves points rather than removing them.
+
+        Parameters:
+        points (numpy array): The new (N, 3) array of point coordinates.
+        """
+        self.points = np.ascontiguousarray(np.asarray(points)[:, :3], dtype=np.float64)
+        self._tree = None
+        # Index of each point of the tree among the current points, -1 once removed; None while they are the same
+        self._tree_map = None
+        self._distances = None
+        self._indices = None
+        self._stale = None
+
+    def rotate(self, rotation, centre):
+        """
+        Description:
+        Rotates the points about a centre. Distances are unchanged by a rotation, so the cached neighbours stay
+        valid and only the KD-tree has to be rebuilt.
+
+        Parameters:
+        rotation (numpy array): The 3x3 rotation matrix.
+        centre (numpy array): The point to rotate about.
+        """
+        self.points = (self.points - centre) @ rotation.T + centre
+        self._tree = None
+        self._tree_map = None
+
+    def __len__(self):
+        return self.points.shape[0]
+
+    @property
+    def tree(self):
+        """
+        Description:
+        The KD-tree over exactly the current points, built lazily on first use and rebuilt if points were
+        removed since.
+        """
+        if self._tree is None or self._tree_map is not None:
+            self._tree = cKDTree(self.points)
+            self._tree_map = None
+        return self._tree
+
+    def knn(self, k=None):
+        """
+        Description:
+        Returns the cached k nearest neighbours of every point, computing or refreshing only what is missing.
+        The first column is always the point itself with a distance of 0.
+
+        Parameters:
+        k (int, Default = None): Number of neighbours to return, defaults to the k the graph was built with.
+
+        Returns:
+        distances (numpy array): An (N, k) array of the distances to each neighbour.
+        indices (numpy array): An (N, k) array of the neighbour indices.
+        """
+        k = self.k if k is None else k
+        k = min(k, len(self))
+
+        if self._distances is None or self._distances.shape[1] < k:
+            self.k = max(self.k, k)
+            query_k = min(self.k, len(self))
+            self._distances, self._indices = self._query(self.points, query_k)
+            self._stale = None
+        elif self._stale is not None:
+            stale_rows = np.flatnonzero(self._stale)
+            if stale_rows.size:
+                query_k = self._distances.shape[1]
+                self._distances[stale_rows], self._indices[stale_rows] = self._query(self.points[stale_rows], query_k)
+            self._stale = None
+
+        return self._distances[:, :k], self._indices[:, :k]
+
+    def _query(self, query_points, k):
+        if self._tree is None or self._tree_map is None:
+            distances, indices = self.tree.query(query_points, k=k, workers=get_n_jobs())
+            if k == 1:
+                distances, indices = distances[:, None], indices[:, None]
+            return distances, indices
+
+        # The tree still holds removed points: ask for enough extra neighbours to make up for the removed ones,
+        # doubling for the rows that still come up short, and keep the first k that remain
+        tree_size = self._tree.n
+        distances = np.empty((len(query_points), k))
+        indices = np.empty((len(query_points), k), dtype=np.int64)
+        rows = np.arange(len(query_points))
+        query_k = min(tree_size, int(np.ceil(k * tree_size / max(1, len(self)))))
+        while rows.size:
+            row_distances, row_indices = self._tree.query(query_points[rows], k=query_k, workers=get_n_jobs())
+            if query_k == 1:
+                row_distances, row_indices = row_distances[:, None], row_indices[:, None]
+            row_indices = self._tree_map[row_indices]
+            remaining = row_indices >= 0
+            complete = np.count_nonzero(remaining, axis=1) >= k
+            if query_k == tree_size:
+                complete[:] = True
+            order = np.argsort(~remaining[complete], axis=1, kind='stable')[:, :k]
+            distances[rows[complete]] = np.take_along_axis(row_distances[complete], order, axis=1)
+            indices[rows[complete]] = np.take_along_axis(row_indices[complete], order, axis=1)
+            rows = rows[~complete]
+            query_k = min(tree_size, query_k * 2)
+        return distances, indices
+
+    def select(self, mask):
+        """
+        Description:
+        Keeps only the points selected by mask, remapping the cached neighbour indices to the new ordering.
+        Rows whose neighbours were removed are marked stale instead of being re-queried immediately.
+
+        Parameters:
+        mask (numpy array): A boolean mask, or an array of indices, of the points to keep.
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            index_mask = np.zeros(len(self), dtype=bool)
+            index_mask[mask] = True
+            mask = index_mask
+
+        self.points = self.points[mask]
+        remap = np.full(mask.shape[0], -1, dtype=np.int64)
+        remap[mask] = np.arange(np.count_nonzero(mask))
+
+        if self._tree is not None:
+            if len(self) < NEIGHBOUR_TREE_REBUILD_FRACTION * self._tree.n:
+                self._tree = None
+                self._tree_map = None
+            elif self._tree_map is None:
+                self._tree_map = remap
+            else:
+                self._tree_map = np.where(self._tree_map >= 0, remap[self._tree_map], -1)
+
+        if self._indices is None:
+            return
+
+        indices = remap[self._indices[mask]]
+        stale = np.any(indices < 0, axis=1)
+        if self._stale is not None:
+            stale |= self._stale[mask]
+
+        # Stale rows keep a valid placeholder until they are refreshed
+        indices[stale] = np.arange(len(self))[stale, None]
+        self._indices = indices
+        self._distances = self._distances[mask]
+        self._stale = stale
+
+        # Too few points left to hold the cached k, start over on the next query
+        if len(self) < self._indices.shape[1]:
+            self._distances = None
+            self._indices = None
+            self._stale = None
+
+    def mean_neighbour_distances(self, nb_neighbors):
+        """
+        Description:
+        Average distance from each point to its nb_neighbors nearest neighbours, matching Open3D's statistical outlier removal.
+
+        Parameters:
+        nb_neighbors (int): Number of neighbours to average over.
+
+        Returns:
+        numpy array: The average neighbour distance of each point.
+        """
+        distances, _ = self.knn(nb_neighbors)
+        return distances.mean(axis=1)
+
+    def radius_neighbour_graph(self, radius):
+        """
+        Description:
+        Builds a sparse graph of all pairs of points within radius of each other from the shared KD-tree,
+        suitable for a precomputed-metric DBSCAN.
+
+        Parameters:
+        radius (float): Maximum distance between two neighbouring points.
+
+        Returns:
+        scipy.sparse.csr_matrix: An (N, N) sparse distance matrix.
+        """
+        logging.debug("Building radius neighbour graph with radius %s over %d points", radius, len(self))
+        return self.tree.sparse_distance_matrix(self.tree, radius, output_type="coo_matrix").tocsr()
@@ -0,0 +1,278 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from utils.config import OCTREE_SUFFIX, OCTREE_LEAF_POINTS, PARTIAL_SUFFIX
+
+# Deepest octree supported, the Morton codes of 3 x 21 bits fit in 64 bits
+MAX_OCTREE_DEPTH = 21
+
+# Layout of the leaf table: the Morton code of each leaf, the range of its points and their actual bounds
+LEAF_DTYPE = np.dtype([('code', '<u8'), ('start', '<i8'), ('count', '<i8'), ('min', '<f8', 3), ('max', '<f8', 3)])
+
+def octree_directory(path):
+    """
+    Description:
+    The path of the octree sidecar of a point cloud, a directory next to it.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+
+    Returns:
+    str: The path of the sidecar directory.
+    """
+    return os.path.splitext(path)[0] + OCTREE_SUFFIX
+
+class OctreeIndex:
+    """
+    Description:
+    A multi-resolution octree over a point cloud persisted next to it, so a z-range, a bounding box or a coarse level
+    of detail can be loaded without reading the rest of the cloud. The sidecar directory holds:
+    points.npy: The points sorted by the Morton code of their leaf, so every leaf is one contiguous range.
+    leaves.npy: The leaf table, see LEAF_DTYPE, small enough to be read whole.
+    lod.npy: One point per occupied cell of every level above the leaves, coarsest level first.
+    meta.json: The grid, the depth, the offsets of the levels in lod.npy and the size and mtime of the source.
+    The points and levels are memory mapped, a query only reads the pages of the leaves it selects.
+
+    Parameters:
+    directory (str): The sidecar directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.points = np.load(os.path.join(directory, "points.npy"), mmap_mode='r')
+        self.leaves = np.load(os.path.join(directory, "leaves.npy"))
+        self.lod = np.load(os.path.join(directory, "lod.npy"), mmap_mode='r')
+
+    @property
+    def depth(self):
+        return self.meta['depth']
+
+    @property
+    def num_points(self):
+        return self.meta['num_points']
+
+    @property
+    def min_bound(self):
+        return np.array(self.meta['min_bound'])
+
+    @property
+    def max_bound(self):
+        return np.array(self.meta['max_bound'])
+
+    @classmethod
+    def build(cls, path, points=None, leaf_points=OCTREE_LEAF_POINTS):
+        """
+        Description:
+        Builds the octree sidecar of a point cloud, replacing any previous one. The depth is the shallowest at
+        which the occupied leaves hold at most leaf_points points on average. The sidecar is written to a temporary directory and renamed into place.
+
+        Parameters:
+        path (str): The file path of the point cloud.
+        points (numpy array, Default = None): The (N, 3) points of the cloud if already loaded, read from path otherwise.
+        leaf_points (int, Default = OCTREE_LEAF_POINTS): Average number of points per occupied leaf to aim for.
+
+        Returns:
+        OctreeIndex: The index.
+        """
+        if points is None:
+            from utils.point_stream import iter_point_chunks
+            points = np.concatenate(list(iter_point_chunks(path)) or [np.empty((0, 3))])
+        points = np.asarray(points, dtype=np.float64)[:, :3]
+        if len(points) == 0:
+            raise ValueError(f"Cannot index the empty point cloud {path}")
+
+        min_bound, max_bound = points.min(axis=0), points.max(axis=0)
+        # A cube, so the cells of every level are cubes
+        size = max(float(np.max(max_bound - min_bound)), 1e-9) * (1 + 1e-9)
+        cells = np.minimum(((points - min_bound) / size * 2 ** MAX_OCTREE_DEPTH).astype(np.uint64), 2 ** MAX_OCTREE_DEPTH - 1)
+        finest_codes = morton_codes(cells)
+        del cells
+        order = np.argsort(finest_codes, kind='stable')
+        points, finest_codes = points[order], finest_codes[order]
+
+        # Filling the cube is a lower bound on the depth, a scanned surface occupies far fewer cells, so deepen
+        # until the occupied leaves hold leaf_points points on average
+        depth = int(np.clip(np.ceil(np.log(max(len(points) / leaf_points, 1)) / np.log(8)) + 1, 1, MAX_OCTREE_DEPTH))
+        while depth < MAX_OCTREE_DEPTH and len(points) / _occupied_cells(finest_codes, depth) > leaf_points:
+            depth += 1
+        codes = finest_codes >> np.uint64(3 * (MAX_OCTREE_DEPTH - depth))
+        del finest_codes
+
+        leaf_codes, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+        leaves = np.empty(len(leaf_codes), dtype=LEAF_DTYPE)
+        leaves['code'], leaves['start'], leaves['count'] = leaf_codes, starts, counts
+        leaves['min'] = np.minimum.reduceat(points, starts, axis=0)
+        leaves['max'] = np.maximum.reduceat(points, starts, axis=0)
+
+        # Level l keeps the first point of every occupied cell of depth l, the codes of a cell's points are contiguous
+        lod_levels, lod_offsets = [], [0]
+        for level in range(depth):
+            _, first_indices = np.unique(codes >> np.uint64(3 * (depth - level)), return_index=True)
+            lod_levels.append(points[first_indices])
+            lod_offsets.append(lod_offsets[-1] + len(first_indices))
+
+        meta = {
+            'depth': depth,
+            'num_points': len(points),
+            'origin': min_bound.tolist(),
+            'size': size,
+            'min_bound': min_bound.tolist(),
+            'max_bound': max_bound.tolist(),
+            'lod_offsets': lod_offsets,
+            'source_size': os.path.getsize(path),
+            'source_mtime': os.path.getmtime(path),
+        }
+
+        directory = octree_directory(path)
+        temporary_directory = directory + PARTIAL_SUFFIX
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        os.makedirs(temporary_directory)
+        np.save(os.path.join(temporary_directory, "points.npy"), points)
+        np.save(os.path.join(temporary_directory, "leaves.npy"), leaves)
+        np.save(os.path.join(temporary_directory, "lod.npy"), np.concatenate(lod_levels))
+        with open(os.path.join(temporary_directory, "meta.json"), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
+
+        logging.info("Built an octree of depth %d with %d leaves over %d points of %s", depth, len(leaves), len(points), path)
+        return cls(directory)
+
+    @classmethod
+    def open(cls, path, build=False):
+        """
+        Description:
+        Opens the octree sidecar of a point cloud, if it exists and was built from the current version of the file.
+
+        Parameters:
+        path (str): The file path of the point cloud.
+        build (bool, Default = False): Build the sidecar if it is missing or out of date.
+
+        Returns:
+        OctreeIndex or None: The index, None if there is none and build is False.
+        """
+        directory = octree_directory(path)
+        try:
+            index = cls(directory)
+            if (index.meta['source_size'] == os.path.getsize(path)
+                    and index.meta['source_mtime'] == os.path.getmtime(path)):
+                return index
+            logging.info("The octree of %s is out of date", path)
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls.build(path) if build else None
+
+    def _gather(self, leaves):
+        """
+        Description:
+        Reads the points of the selected leaves, each a contiguous range of the memory mapped points.
+        """
+        if len(leaves) == 0:
+            return np.empty((0, 3))
+        return np.concatenate([self.points[start:start + count] for start, count in zip(leaves['start'], leaves['count'])])
+
+    def z_range(self, low, high):
+        """
+        Description:
+        Loads the points with low <= Z <= high, reading only the leaves that overlap the range.
+
+        Parameters:
+        low (float): The lowest Z.
+        high (float): The highest Z.
+
+        Returns:
+        numpy array: The (n, 3) points in the range, in Morton order.
+        """
+        leaves = self.leaves[(self.leaves['max'][:, 2] >= low) & (self.leaves['min'][:, 2] <= high)]
+        points = self._gather(leaves)
+        return points[(points[:, 2] >= low) & (points[:, 2] <= high)]
+
+    def bounding_box(self, min_bound, max_bound):
+        """
+        Description:
+        Loads the points inside an axis aligned box, reading only the leaves that overlap it.
+
+        Parameters:
+        min_bound (array like): The lowest corner of the box.
+        max_bound (array like): The highest corner of the box.
+
+        Returns:
+        numpy array: The (n, 3) points in the box, in Morton order.
+        """
+        min_bound, max_bound = np.asarray(min_bound, dtype=float), np.asarray(max_bound, dtype=float)
+        leaves = self.leaves[np.all((self.leaves['max'] >= min_bound) & (self.leaves['min'] <= max_bound), axis=1)]
+        points = self._gather(leaves)
+        return points[np.all((points >= min_bound) & (points <= max_bound), axis=1)]
+
+    def level_of_detail(self, level):
+        """
+        Description:
+        Loads a coarse version of the cloud with one point per occupied cell of the given level. Level 0 is a
+        single point, and the depth of the octree is the full cloud.
+
+        Parameters:
+        level (int): The level, 0 to depth.
+
+        Returns:
+        numpy array: The (n, 3) points of the level.
+        """
+        if level >= self.depth:
+            return np.asarray(self.points)
+        offsets = self.meta['lod_offsets']
+        return np.asarray(self.lod[offsets[level]:offsets[level + 1]])
+
+    def level_for_budget(self, max_points):
+        """
+        Description:
+        The finest level with at most max_points points.
+
+        Parameters:
+        max_points (int): The most points wanted.
+
+        Returns:
+        int: The level, see level_of_detail().
+        """
+        if self.num_points <= max_points:
+            return self.depth
+        level_sizes = np.diff(self.meta['lod_offsets'])
+        return max(int(np.searchsorted(level_sizes, max_points, side='right')) - 1, 0)
+
+def _occupied_cells(codes, depth):
+    """
+    Description:
+    The number of cells of a depth occupied by points, from their sorted Morton codes at MAX_OCTREE_DEPTH.
+    """
+    cell_codes = codes >> np.uint64(3 * (MAX_OCTREE_DEPTH - depth))
+    return 1 + int(np.count_nonzero(cell_codes[1:] != cell_codes[:-1]))
+
+def morton_codes(cells):
+    """
+    Description:
+    Interleaves the bits of integer cell coordinates into Morton (Z-order) codes, so cells close in space get
+    close codes and every octree cell is a contiguous range of codes.
+
+    Parameters:
+    cells (numpy array): The (N, 3) unsigned cell coordinates, below 2 ** 21.
+
+    Returns:
+    numpy array: The N uint64 codes.
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    return _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | (_spread_bits(cells[:, 2]) << np.uint64(2))
+
+def _spread_bits(values):
+    """
+    Description:
+    Spreads the lowest 21 bits of each value so two zero bits follow every bit.
+    """
+    values = values & np.uint64(0x1fffff)
+    values = (values | (values << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    values = (values | (values << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return values
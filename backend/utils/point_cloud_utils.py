@@ -4,8 +4,10 @@ import open3d as o3d
 import numpy as np
 import logging
 from utils.file_operations import modify_filename
-from utils.config import STAGE_PREFIXES
+from utils.config import STAGE_PREFIXES, VISUALIZER_MEMORY_BUDGET_MB
+from utils.point_stream import load_points_within_budget, point_budget
 from scipy.optimize import least_squares
+from utils.spatial_hash import voxel_hash_keys
 
 def get_current_stage(filepath):
     """
@@ -27,19 +29,26 @@ def get_current_stage(filepath):
 
     return default_stage
 
-def point_cloud_visualizer(path, origin_path = None):
+def point_cloud_visualizer(path, origin_path = None, memory_budget_mb = VISUALIZER_MEMORY_BUDGET_MB, subsample_method = "voxel"):
     """
     Description:
     Opens and visualizes a point cloud from a given file path, or a comparison of two point clouds. 
     Draws the original in red, and the derived point cloud in gray, or just a single point cloud in gray.
+    The point clouds are loaded through the streaming reader of utils.point_stream, voxel downsampled or randomly
+    subsampled to the number of points that fits the memory budget, so even the largest raw scans can be compared.
+    The derived point cloud gets up to half of the budget, the original the rest.
 
     Parameters:
     path (str): The file path of the point cloud to visualize.
     origin_path (str, optional): Another path of a point cloud (the original) to visualize alongside the new one.
+    memory_budget_mb (float, Default = VISUALIZER_MEMORY_BUDGET_MB): Memory the displayed points may use in megabytes.
+    subsample_method (str, Default = "voxel"): "voxel" or "random", see load_points_within_budget().
     """
+    max_points = point_budget(memory_budget_mb)
     try:
-        point_cloud = o3d.io.read_point_cloud(path)
-        if not point_cloud.has_points():
+        points = load_points_within_budget(path, max_points // 2 if origin_path is not None else max_points,
+                                           subsample_method, use_cache=False)
+        if len(points) == 0:
             raise ValueError("The point cloud is empty.")
     except Exception as e:
         raise ValueError(f"Could not read point cloud for visualization: {e}")
@@ -47,26 +56,22 @@ def point_cloud_visualizer(path, origin_path = None):
     vis = o3d.visualization.Visualizer()
     vis.create_window(window_name="Project Pinecone Visualizer", width=1920, height=1080)
 
-    point_cloud_color = [0.5, 0.5, 0.5] 
-    point_cloud.colors = o3d.utility.Vector3dVector([point_cloud_color for i in range(len(point_cloud.points))])
+    point_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    point_cloud.colors = o3d.utility.Vector3dVector(np.tile([0.5, 0.5, 0.5], (len(points), 1)))
     vis.add_geometry(point_cloud)
 
     # Check and add a second point cloud if the path is provided, appending it bseide the previous point cloud for a comparison
     if origin_path is not None:
         try:
-            new_point_cloud = o3d.io.read_point_cloud(origin_path)
-            if not new_point_cloud.has_points():
+            origin_points = load_points_within_budget(origin_path, max(1, max_points - len(points)), subsample_method)
+            if len(origin_points) == 0:
                 raise ValueError("The second point cloud is empty.")
 
-            # Matrix to move the second point cloud for comparison
-            translation = np.array([[1, 0, 0, 5],  # distance on the x axis away from the first point cloud
-                                    [0, 1, 0, 0],
-                                    [0, 0, 1, 0],
-                                    [0, 0, 0, 1]])
-            new_point_cloud.transform(translation)
-            
-            new_point_cloud_color = [1, 0, 0]
-            new_point_cloud.colors = o3d.utility.Vector3dVector([new_point_cloud_color for i in range(len(new_point_cloud.points))])
+            # Move the second point cloud 5 units along the x axis away from the first point cloud for comparison
+            origin_points += np.array([5.0, 0.0, 0.0])
+
+            new_point_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(origin_points))
+            new_point_cloud.colors = o3d.utility.Vector3dVector(np.tile([1.0, 0.0, 0.0], (len(origin_points), 1)))
 
             vis.add_geometry(new_point_cloud)
         except Exception as e:
@@ -104,7 +109,7 @@ def fit_circle_to_points(points):
     tuple: The center coordinates(x and y naught) and the radius of the fitted circle.
     """
     try:
-        logging.info("Attempting fit_circle_to_points()...")
+        logging.debug("Attempting fit_circle_to_points()...")
         def residuals(params, x, y):
             # for use in the least_squares algorithm to get the residuals of the distance 
             # https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.least_squares.html#scipy.optimize.least_squares 
@@ -120,12 +125,28 @@ def fit_circle_to_points(points):
         result = least_squares(residuals, initialization, args=(x, y))
 
         xo, yo, radius = result.x
-        logging.info(f"Extracted radius {radius} at {xo}, {yo}")
+        logging.debug("Extracted radius %s at %s, %s", radius, xo, yo)
         return xo, yo, radius
     except Exception as e:
         logging.error(f"Failed to radius: {e}")
         return 
         
+def fit_circle_algebraic(points):
+    """
+    Description:
+    Least squares circle through 2D points in its linear form x^2 + y^2 = 2ax + 2by + c. A single linear solve,
+    far cheaper than fit_circle_to_points() but more sensitive to noise, suited to screening and first estimates.
+
+    Parameters:
+    points (numpy array): A 2d array of x and y points.
+
+    Returns:
+    tuple: The centre (numpy array of x and y) and the radius of the fitted circle.
+    """
+    design = np.column_stack([2 * points, np.ones(len(points))])
+    (a, b, c), *_ = np.linalg.lstsq(design, np.sum(points ** 2, axis=1), rcond=None)
+    return np.array([a, b]), float(np.sqrt(max(c + a ** 2 + b ** 2, 0.0)))
+
 def slice_point_cloud(point_cloud, lower_height, upper_height):
     """
     Description:
@@ -141,7 +162,7 @@ def slice_point_cloud(point_cloud, lower_height, upper_height):
     mask (numpy array): A mask indicating which points in the original point cloud are within the specified height range.
     """
     try:
-        logging.info("Attempting slice_point_cloud()...")
+        logging.debug("Attempting slice_point_cloud()...")
         points = np.asarray(point_cloud.points)
     
         # Filter based on the height
@@ -152,26 +173,214 @@ def slice_point_cloud(point_cloud, lower_height, upper_height):
     
         mask = (points[:, 2] >= lower_height) & (points[:, 2] <= upper_height)
 
-        logging.info(f"Sliced the point cloud at {lower_height} and {upper_height}")
+        logging.debug("Sliced the point cloud at %s and %s", lower_height, upper_height)
         return sliced_point_cloud, mask
     except Exception as e:
         logging.error(f"Failed to slice point cloud: {e}")
         return 
 
-def calculate_diameter_at_height(point_cloud, height):
+def sort_points_by_height(points):
+    """
+    Description:
+    Sorts points by their Z value so that any horizontal slab can be located with a binary search
+    instead of a scan over the whole point cloud. Used to share one sort between many slice fits.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+
+    Returns:
+    numpy array: The points sorted by ascending Z.
+    """
+    points = np.asarray(points)
+    return points[np.argsort(points[:, 2], kind="stable")]
+
+def fit_slice_at_height(sorted_points, height, adaptive=True, half_thickness=0.01, target_points=200,
+                        min_half_thickness=0.0025, max_half_thickness=0.15, max_points=1000):
+    """
+    Description:
+    Fits a circle to a horizontal slab of points centred on a height. In adaptive mode the slab grows on sparse
+    data until it holds target_points, and shrinks on dense data while it holds far more than that, within the
+    given thickness limits. Slabs still holding more than max_points are subsampled, so the cost of a fit is bounded
+    regardless of scan density. The fit quality is the RMS distance of the points to the circle relative to its radius.
+
+    Parameters:
+    sorted_points (numpy array): An (N, 3) array of points sorted by Z, see sort_points_by_height().
+    height (float): The height to fit the circle at.
+    adaptive (bool, Default = True): Adapt the slab thickness to the point density, otherwise use half_thickness.
+    half_thickness (float, Default = 0.01): The initial (or fixed) half thickness of the slab in meters.
+    target_points (int, Default = 200): The number of points the adaptive slab aims for.
+    min_half_thickness (float, Default = 0.0025): The thinnest the adaptive slab may become.
+    max_half_thickness (float, Default = 0.15): The thickest the adaptive slab may become.
+    max_points (int, Default = 1000): The most points passed to the circle fit.
+
+    Returns:
+    slice_fit (dict): The 'height', centre 'x' and 'y', 'radius', 'diameter', 'fit_quality', 'num_points' and 
+        'half_thickness' of the fit, or None if no circle could be fitted.
+    """
+    z_values = sorted_points[:, 2]
+
+    def slab_bounds(half):
+        return (np.searchsorted(z_values, height - half, side="left"),
+                np.searchsorted(z_values, height + half, side="right"))
+
+    start, end = slab_bounds(half_thickness)
+    if adaptive:
+        while end - start < target_points and half_thickness < max_half_thickness:
+            half_thickness = min(half_thickness * 1.5, max_half_thickness)
+            start, end = slab_bounds(half_thickness)
+        while end - start > 4 * target_points and half_thickness > min_half_thickness:
+            smaller_half = max(half_thickness / 1.5, min_half_thickness)
+            smaller_start, smaller_end = slab_bounds(smaller_half)
+            if smaller_end - smaller_start < target_points:
+                break
+            half_thickness, start, end = smaller_half, smaller_start, smaller_end
+
+    num_points = end - start
+    if num_points < 3:
+        logging.warning("Only %d points found within %.3f m of height %.3f, no circle fitted.", num_points, half_thickness, height)
+        return None
+
+    points = sorted_points[start:end, :2]
+    if num_points > max_points:
+        # A fixed seed keeps repeated measurements of the same tree identical
+        points = points[np.random.default_rng(0).choice(num_points, max_points, replace=False)]
+
+    circle = fit_circle_to_points(points)
+    if circle is None:
+        return None
+    xo, yo, radius = circle
+    residuals = np.hypot(points[:, 0] - xo, points[:, 1] - yo) - radius
+    fit_quality = float(np.sqrt(np.mean(residuals ** 2)) / abs(radius)) if radius != 0 else float("inf")
+
+    logging.debug("Fitted radius %.4f at height %.3f from %d points, half thickness %.4f, fit quality %.4f",
+                  radius, height, num_points, half_thickness, fit_quality)
+    return {
+        'height': height,
+        'x': xo,
+        'y': yo,
+        'radius': abs(radius),
+        'diameter': 2 * abs(radius),
+        'fit_quality': fit_quality,
+        'num_points': int(num_points),
+        'half_thickness': half_thickness,
+    }
+
+def voxel_subsample(points, voxel_size):
+    """
+    Description:
+    Keeps the first point of every occupied voxel, a cheap way to get an evenly spread sample of a point cloud
+    without averaging or building an Open3D object.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+    voxel_size (float): Edge length of the voxels in meters.
+
+    Returns:
+    numpy array: The subsampled points, in their original order.
+    """
+    points = np.asarray(points)
+    voxel_keys = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64)
+    _, first_indices = np.unique(voxel_keys, axis=0, return_index=True)
+    return points[np.sort(first_indices)]
+
+def fuse_voxels(points, voxel_size):
+    """
+    Description:
+    Replaces the points of every occupied voxel by their centroid, so overlapping scans of the same surface are
+    fused into one layer instead of being stacked.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+    voxel_size (float): Edge length of the voxels in meters.
+
+    Returns:
+    numpy array: The centroids, one per occupied voxel.
+    """
+    points = np.asarray(points)
+    if len(points) == 0:
+        return points.reshape(0, 3)
+    keys = voxel_hash_keys(points, voxel_size, points.min(axis=0))
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    sums = np.column_stack([np.bincount(inverse, weights=points[:, axis], minlength=len(unique_keys)) for axis in range(3)])
+    return sums / counts[:, None]
+
+def estimate_stem_axis(points, voxel_size=0.05, iterations=3, inlier_distance_factor=2.5):
+    """
+    Description:
+    Estimates the direction of the stem with PCA on a voxel subsample of the points. The first principal component
+    of a tree taper follows the stem, each refinement iteration drops points far from the current axis (remaining
+    branches and noise, by a robust median/MAD threshold) and repeats the PCA on the rest.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+    voxel_size (float, Default = 0.05): Voxel size of the subsample used for the estimate.
+    iterations (int, Default = 3): Number of refinement iterations.
+    inlier_distance_factor (float, Default = 2.5): Points further than the median distance to the axis plus this many MADs are dropped.
+
+    Returns:
+    axis (numpy array): Unit vector along the stem, pointing up.
+    centre (numpy array): A point on the stem axis.
+    """
+    sample = voxel_subsample(points, voxel_size)
+    for iteration in range(iterations + 1):
+        centre = sample.mean(axis=0)
+        _, _, components = np.linalg.svd(sample - centre, full_matrices=False)
+        axis = components[0] if components[0][2] >= 0 else -components[0]
+        if iteration == iterations:
+            break
+
+        offsets = sample - centre
+        distances = np.linalg.norm(offsets - np.outer(offsets @ axis, axis), axis=1)
+        median = np.median(distances)
+        mad = np.median(np.abs(distances - median))
+        inliers = distances <= median + inlier_distance_factor * max(mad, 1e-6)
+        if np.count_nonzero(inliers) < 10:
+            break
+        sample = sample[inliers]
+
+    return axis, centre
+
+def rotation_to_vertical(axis):
+    """
+    Description:
+    Rotation matrix turning a unit vector onto the Z axis by the shortest rotation (Rodrigues' formula).
+
+    Parameters:
+    axis (numpy array): The unit vector to rotate.
+
+    Returns:
+    numpy array: The 3x3 rotation matrix.
+    """
+    z_axis = np.array([0.0, 0.0, 1.0])
+    rotation_axis = np.cross(axis, z_axis)
+    sin_angle = np.linalg.norm(rotation_axis)
+    cos_angle = np.dot(axis, z_axis)
+    if sin_angle < 1e-12:
+        return np.eye(3)
+    k = rotation_axis / sin_angle
+    cross_matrix = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+    return np.eye(3) + sin_angle * cross_matrix + (1 - cos_angle) * cross_matrix @ cross_matrix
+
+def calculate_diameter_at_height(point_cloud, height, adaptive=False):
     """
     Description:
     Calculates the diameter of a tree at a specified height calling sliced_point_cloud at a height, extracting a small sample at that height to fit a circle.
+    With adaptive set, the slab thickness adapts to the point density through fit_slice_at_height().
 
     Parameters:
     point_cloud (open3d.geometry.PointCloud): The original point cloud.
     height (float): The height to obtain the diameter.
+    adaptive (bool, Default = False): Use an adaptive slab rather than a fixed one of +-1 cm.
 
     Returns:
     diameter (float): The Diameter.
     """
+    if adaptive:
+        slice_fit = fit_slice_at_height(sort_points_by_height(np.asarray(point_cloud.points)), height)
+        return slice_fit['diameter'] if slice_fit is not None else None
+
     try:
-        logging.info("Attempting calculate_diameter_at_height()...")
+        logging.debug("Attempting calculate_diameter_at_height()...")
         # Assuming the tree is upright and Z represents height, slice a thin section around the desired height to use in Cylinder Fitting
         sliced_point_cloud, _ = slice_point_cloud(point_cloud, height - 0.01, height + 0.01)
         if len(sliced_point_cloud.points) == 0:
@@ -182,7 +391,7 @@ def calculate_diameter_at_height(point_cloud, height):
         points = np.asarray(sliced_point_cloud.points)[:, :2]
         _, _, radius = fit_circle_to_points(points)
         diameter = 2 * radius
-        logging.info(f"Extracted diameter {diameter} from the point cloud")
+        logging.debug("Extracted diameter %s from the point cloud", diameter)
         return diameter
     except Exception as e:
         logging.error(f"Failed to calculate diameter: {e}")
@@ -0,0 +1,337 @@
+import os
+import shutil
+import logging
+from itertools import islice
+import numpy as np
+import open3d as o3d
+import laspy
+from utils.config import POINT_CACHE_SUFFIX, STREAM_CHUNK_POINTS, BYTES_PER_DISPLAYED_POINT
+from utils.file_operations import partial_filepath
+from utils.shared_arrays import SharedArray
+from utils.octree_index import OctreeIndex
+
+# Text formats that are parsed a chunk of lines at a time, anything else is read whole by Open3D once
+STREAMABLE_EXTENSIONS = ('.xyz', '.xyzn', '.xyzrgb', '.txt')
+
+# Binary formats read with laspy, and converted to .xyz before processing
+LAS_EXTENSIONS = ('.las',)
+
+def point_cache_filepath(path):
+    """
+    Description:
+    The path of the memory mappable .npy cache of a point cloud, kept next to it.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+
+    Returns:
+    str: The path of the cache.
+    """
+    return os.path.splitext(path)[0] + POINT_CACHE_SUFFIX
+
+def load_point_cache(path):
+    """
+    Description:
+    Opens the cache of a point cloud as a read only memory map, so only the pages that are used are read.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+
+    Returns:
+    numpy memmap or None: The (N, 3) points, or None if there is no cache or it is older than the point cloud.
+    """
+    cache_path = point_cache_filepath(path)
+    try:
+        if os.path.getmtime(cache_path) < os.path.getmtime(path):
+            return None
+        points = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if points.ndim != 2 or points.shape[1] != 3:
+        return None
+    return points
+
+def iter_point_chunks(path, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Description:
+    Reads the XYZ coordinates of a point cloud a chunk at a time, so a scan never has to fit in memory whole.
+    Uses the memory mapped cache if there is one, parses text formats a block of lines at a time, reads LAS
+    files a block of records at a time with laspy and falls back to reading other formats with Open3D.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points per chunk.
+
+    Yields:
+    numpy array: (n, 3) float64 arrays of points, in file order.
+    """
+    cached_points = load_point_cache(path)
+    if cached_points is not None:
+        for start in range(0, len(cached_points), chunk_points):
+            yield np.asarray(cached_points[start:start + chunk_points])
+        return
+
+    if os.path.splitext(path)[1].lower() in STREAMABLE_EXTENSIONS:
+        with open(path) as file:
+            while True:
+                lines = list(islice(file, chunk_points))
+                if not lines:
+                    break
+                chunk = np.loadtxt(lines, usecols=(0, 1, 2), ndmin=2, comments=('#', '//'))
+                if len(chunk):
+                    yield chunk
+        return
+
+    if os.path.splitext(path)[1].lower() in LAS_EXTENSIONS:
+        with laspy.open(path) as reader:
+            for records in reader.chunk_iterator(chunk_points):
+                yield np.column_stack([records.x, records.y, records.z])
+        return
+
+    points = np.asarray(o3d.io.read_point_cloud(path).points)
+    for start in range(0, len(points), chunk_points):
+        yield points[start:start + chunk_points]
+
+def convert_to_xyz(source_path, destination_path, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Description:
+    Writes the XYZ coordinates of any readable point cloud, such as a LAS file, to an .xyz text file, streaming
+    it a chunk at a time. The file is written to a temporary path and renamed into place once complete.
+
+    Parameters:
+    source_path (str): The file path of the point cloud.
+    destination_path (str): The path of the .xyz file.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points converted at a time.
+
+    Returns:
+    int: The number of points written.
+    """
+    temporary_path = partial_filepath(destination_path)
+    num_points = 0
+    with open(temporary_path, 'w') as xyz_file:
+        for chunk in iter_point_chunks(source_path, chunk_points):
+            np.savetxt(xyz_file, chunk, fmt="%.6f")
+            num_points += len(chunk)
+    os.replace(temporary_path, destination_path)
+    logging.info("Converted %d points of %s to %s", num_points, source_path, destination_path)
+    return num_points
+
+def build_point_cache(path, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Description:
+    Writes the points of a point cloud to a .npy cache next to it, streaming them so memory use stays at one
+    chunk. The points are appended to a raw file first, then the .npy header is written once the count is
+    known and the raw data is copied behind it; the cache only appears once complete.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points read at a time.
+
+    Returns:
+    numpy memmap or None: The cache opened as a memory map, or None if it could not be written.
+    """
+    cache_path = point_cache_filepath(path)
+    raw_path = partial_filepath(cache_path) + '.raw'
+    cache_partial_path = partial_filepath(cache_path)
+    try:
+        count = 0
+        with open(raw_path, 'wb') as raw_file:
+            for chunk in iter_point_chunks(path, chunk_points):
+                raw_file.write(np.ascontiguousarray(chunk, dtype='<f8').tobytes())
+                count += len(chunk)
+
+        with open(cache_partial_path, 'wb') as cache_file:
+            np.lib.format.write_array_header_1_0(cache_file, {'descr': '<f8', 'fortran_order': False, 'shape': (count, 3)})
+            with open(raw_path, 'rb') as raw_file:
+                shutil.copyfileobj(raw_file, cache_file, 16 * 1024 * 1024)
+        os.replace(cache_partial_path, cache_path)
+    except (OSError, ValueError) as e:
+        logging.warning("Could not cache the points of %s: %s", path, e)
+        if os.path.exists(cache_partial_path):
+            os.remove(cache_partial_path)
+        return None
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    logging.info("Cached %d points of %s in %s", count, path, cache_path)
+    return load_point_cache(path)
+
+def load_shared_points(path, chunk_points=STREAM_CHUNK_POINTS, spill_directory=None):
+    """
+    Description:
+    Loads the points of a point cloud into a SharedArray, so they can be handed to worker processes by handle
+    instead of being pickled. A scan with a memory mapped cache is shared straight from the cache without
+    reading it; others are counted first, from the LAS header or by a pass over the lines of a text format that
+    does not parse them, then streamed into the shared array a chunk at a time, so no more than a chunk is held
+    besides it. Formats read by Open3D are loaded whole and copied in.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points read at a time.
+    spill_directory (str, Default = None): Directory of the fallback file if shared memory is unavailable.
+
+    Returns:
+    SharedArray: The (N, 3) float64 points, to be closed by the caller once the workers are done.
+    """
+    cache_path = point_cache_filepath(path)
+    if load_point_cache(path) is not None:
+        return SharedArray.from_file(cache_path)
+
+    count = _count_points(path)
+    if count is None:
+        return SharedArray.from_array(np.concatenate(list(iter_point_chunks(path, chunk_points)) or [np.empty((0, 3))]), spill_directory)
+
+    shared_points = SharedArray.empty((count, 3), np.float64, spill_directory)
+    start = 0
+    try:
+        for chunk in iter_point_chunks(path, chunk_points):
+            if start + len(chunk) > count:
+                raise ValueError(f"{path} has more points than the {count} counted, it changed while being read")
+            shared_points.array[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        if start != count:
+            raise ValueError(f"{path} has {start} points instead of the {count} counted, it changed while being read")
+    except Exception:
+        shared_points.close()
+        raise
+    return shared_points
+
+def _count_points(path):
+    """
+    Description:
+    The number of points iter_point_chunks() yields for a LAS or text point cloud, without parsing them: the
+    point count of the LAS header, or the lines of a text format that are neither blank nor comments. None for
+    the formats read by Open3D.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in LAS_EXTENSIONS:
+        with laspy.open(path) as reader:
+            return int(reader.header.point_count)
+    if extension in STREAMABLE_EXTENSIONS:
+        with open(path, 'rb') as file:
+            return sum(1 for line in file if line.strip() and not line.lstrip().startswith((b'#', b'//')))
+    return None
+
+def point_budget(memory_budget_mb, bytes_per_point=BYTES_PER_DISPLAYED_POINT):
+    """
+    Description:
+    The number of points that can be displayed within a memory budget.
+
+    Parameters:
+    memory_budget_mb (float): The memory budget in megabytes.
+    bytes_per_point (int, Default = BYTES_PER_DISPLAYED_POINT): Memory used by each displayed point.
+
+    Returns:
+    int: The number of points, at least 1.
+    """
+    return max(1, int(memory_budget_mb * 1024 * 1024 // bytes_per_point))
+
+def _voxel_reduce(points, voxel_size, origin):
+    """
+    Description:
+    Keeps the first point of every occupied voxel of a grid anchored at origin, in the original order.
+    """
+    keys = np.floor((points - origin) / voxel_size).astype(np.int64)
+    _, first_indices = np.unique(keys, axis=0, return_index=True)
+    return points[np.sort(first_indices)]
+
+def _voxel_subsample_stream(chunks, max_points, voxel_size):
+    """
+    Description:
+    Voxel downsamples a stream of chunks to at most max_points, coarsening the grid by a quarter whenever the
+    points kept so far exceed the budget. Points are only reduced once the budget is exceeded, unless a
+    voxel size is given.
+    """
+    kept = np.empty((0, 3))
+    origin = None
+    for chunk in chunks:
+        if origin is None:
+            origin = chunk[0]
+        kept = np.concatenate([kept, chunk])
+        if voxel_size is not None:
+            kept = _voxel_reduce(kept, voxel_size, origin)
+        while len(kept) > max_points:
+            if voxel_size is None:
+                # The scans are mostly surfaces, so start well below the spacing that spreads the budget over the largest face
+                extent = np.ptp(kept, axis=0)
+                voxel_size = max(float(np.max(extent)) / np.sqrt(max_points) / 4, 1e-6)
+            else:
+                voxel_size *= 1.25
+            kept = _voxel_reduce(kept, voxel_size, origin)
+    return kept, voxel_size
+
+def random_subsample_stream(chunks, max_points, seed):
+    """
+    Description:
+    Uniform random sample of at most max_points from a stream of chunks without knowing its length up front:
+    every point draws a random key and the points with the smallest keys are kept (reservoir sampling).
+    """
+    rng = np.random.default_rng(seed)
+    kept = np.empty((0, 3))
+    kept_keys = np.empty(0)
+    for chunk in chunks:
+        kept = np.concatenate([kept, chunk])
+        kept_keys = np.concatenate([kept_keys, rng.random(len(chunk))])
+        if len(kept) > max_points:
+            selection = np.argpartition(kept_keys, max_points)[:max_points]
+            kept, kept_keys = kept[selection], kept_keys[selection]
+    return kept
+
+def load_points_within_budget(path, max_points, method="voxel", voxel_size=None, use_cache=True, seed=0, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Description:
+    Loads at most max_points points of a point cloud, streaming the file so memory use is bounded by the budget
+    and one chunk rather than the size of the scan. With use_cache the scan is parsed once into a memory mapped
+    .npy cache, which later loads read directly. A cloud with an up to date OctreeIndex sidecar, such as a
+    processed taper, is read from it instead: "voxel" samples the coarsest level of detail over the budget, and
+    "random" samples the memory mapped points of the index.
+
+    Parameters:
+    path (str): The file path of the point cloud.
+    max_points (int): The most points to return.
+    method (str, Default = "voxel"): "voxel" for an even spatial coverage, "random" for a uniform random sample.
+    voxel_size (float, Default = None): Smallest voxel size for "voxel", only reduced when over budget if None.
+    use_cache (bool, Default = True): Read from, and create, the memory mapped cache of the scan.
+    seed (int, Default = 0): Seed of the random sample, so repeated loads show the same points.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points read at a time.
+
+    Returns:
+    numpy array: The (n, 3) points, n <= max_points.
+    """
+    if method not in ("voxel", "random"):
+        raise ValueError(f"Unknown subsampling method: {method}")
+
+    index = OctreeIndex.open(path) if voxel_size is None else None
+    if index is not None:
+        if index.num_points <= max_points:
+            return np.array(index.points)
+        # Each level has about 8 times the points of the one above, so the first level over the budget is sampled down
+        level = index.level_for_budget(max_points) + 1 if method == "voxel" else index.depth
+        level_points = index.level_of_detail(level)
+        indices = np.sort(np.random.default_rng(seed).choice(len(level_points), max_points, replace=False))
+        logging.info("Loaded %d points of level %d of %d of the octree of %s", max_points, level, index.depth, path)
+        return np.asarray(level_points[indices])
+
+    cached_points = None
+    if use_cache:
+        cached_points = load_point_cache(path)
+        if cached_points is None:
+            cached_points = build_point_cache(path, chunk_points)
+
+    if cached_points is not None and method == "random":
+        # The length is known, so the sample can be read straight from the memory map
+        if len(cached_points) <= max_points:
+            return np.array(cached_points)
+        indices = np.sort(np.random.default_rng(seed).choice(len(cached_points), max_points, replace=False))
+        return np.asarray(cached_points[indices])
+
+    chunks = iter_point_chunks(path, chunk_points)
+    if method == "random":
+        points = random_subsample_stream(chunks, max_points, seed)
+    else:
+        points, voxel_size = _voxel_subsample_stream(chunks, max_points, voxel_size)
+        if voxel_size is not None:
+            logging.info("Voxel downsampled %s with a voxel size of %.4f m", path, voxel_size)
+    logging.info("Loaded %d points of %s within a budget of %d", len(points), path, max_points)
+    return points
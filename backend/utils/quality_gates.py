@@ -0,0 +1,180 @@
+import logging
+import numpy as np
+from sklearn.cluster import DBSCAN
+from utils.point_cloud_utils import voxel_subsample, fit_circle_algebraic
+
+# Reason codes recorded in the run journal for a rejected tree
+REASON_TOO_FEW_POINTS = "too_few_points"
+REASON_TOO_SHORT = "insufficient_height"
+REASON_NO_BREAST_HEIGHT_RING = "no_breast_height_ring"
+REASON_NO_DOMINANT_CLUSTER = "no_dominant_cluster"
+
+# Gates evaluated at each checkpoint, right after loading and after each stage of the taper extraction, with the
+# thresholds overriding their defaults. Only the cheap gates run before cleaning, the ring and cluster gates need the
+# noise removed first. The preprocessed taper is sparse, its ring gate matches the slab and the 3 points the
+# processing stage needs to measure the diameter at breast height.
+QUALITY_GATES = {
+    'loaded': {'point_count': {'min_points': 1000}, 'vertical_extent': {}},
+    'cleaning': {'point_count': {'min_points': 500}, 'vertical_extent': {}, 'breast_height_ring': {}, 'cluster_dominance': {}},
+    'preprocessing': {'point_count': {'min_points': 50}, 'vertical_extent': {},
+                      'breast_height_ring': {'half_thickness': 0.15, 'min_ring_points': 3, 'min_arc_degrees': 30}},
+}
+
+# Most points the gates look at, larger clouds are randomly subsampled
+QUALITY_SAMPLE_SIZE = 50000
+
+class QualityGateError(Exception):
+    """
+    Description:
+    Raised when a tree fails a quality gate, carrying the reason code recorded for it in the run journal.
+
+    Parameters:
+    reason (str): One of the REASON_ codes.
+    message (str): What was measured against which threshold.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(f"{reason}: {message}")
+        self.reason = reason
+        self.message = message
+
+def check_point_count(points, min_points=500):
+    """
+    Description:
+    Fails clouds with too few points to measure a stem.
+
+    Parameters:
+    points (numpy array): The (N, 3) points, not subsampled.
+    min_points (int, Default = 500): Fewest points accepted.
+
+    Returns:
+    tuple or None: (reason, message) on failure, None if the gate passes.
+    """
+    if len(points) < min_points:
+        return REASON_TOO_FEW_POINTS, f"{len(points)} points, at least {min_points} needed"
+    return None
+
+def check_vertical_extent(points, min_height=1.5):
+    """
+    Description:
+    Fails clouds too short to reach above breast height, with the lowest and highest 0.5% ignored as noise.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    min_height (float, Default = 1.5): Lowest vertical extent accepted in meters.
+
+    Returns:
+    tuple or None: (reason, message) on failure, None if the gate passes.
+    """
+    low, high = np.percentile(points[:, 2], [0.5, 99.5])
+    if high - low < min_height:
+        return REASON_TOO_SHORT, f"vertical extent of {high - low:.2f} m, at least {min_height:.2f} m needed"
+    return None
+
+def check_breast_height_ring(points, dbh_height=1.3, half_thickness=0.05, min_ring_points=20, min_radius=0.02,
+                             max_radius=1.5, min_inlier_fraction=0.5, min_arc_degrees=60):
+    """
+    Description:
+    Fails clouds without a recognisable stem at breast height: the points of a band around breast height must
+    contain a circle of plausible radius, with most of the band close to it and an arc of at least
+    min_arc_degrees covered (a scan from one side only covers half the stem). The circle is an algebraic fit
+    refined once on the points near it, far cheaper than the least squares fits of the processing stage.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    dbh_height (float, Default = 1.3): Breast height above the base in meters.
+    half_thickness (float, Default = 0.05): Half the thickness of the band in meters.
+    min_ring_points (int, Default = 20): Fewest points in the band.
+    min_radius (float, Default = 0.02): Smallest plausible stem radius in meters.
+    max_radius (float, Default = 1.5): Largest plausible stem radius in meters.
+    min_inlier_fraction (float, Default = 0.5): Least fraction of the band within 25% of the radius of the circle.
+    min_arc_degrees (float, Default = 60): Least arc of the circle covered by points, in 10 degree bins.
+
+    Returns:
+    tuple or None: (reason, message) on failure, None if the gate passes.
+    """
+    base_height = np.percentile(points[:, 2], 0.5)
+    band = points[np.abs(points[:, 2] - (base_height + dbh_height)) <= half_thickness, :2]
+    if len(band) < min_ring_points:
+        return REASON_NO_BREAST_HEIGHT_RING, f"{len(band)} points at breast height, at least {min_ring_points} needed"
+
+    # Start from the points near the median so scattered noise does not drag the first fit
+    candidates = band[np.linalg.norm(band - np.median(band, axis=0), axis=1) <= max_radius]
+    for _ in range(2):
+        if len(candidates) < 3:
+            return REASON_NO_BREAST_HEIGHT_RING, "too few points to fit a circle at breast height"
+        centre, radius = fit_circle_algebraic(candidates)
+        residuals = np.abs(np.linalg.norm(band - centre, axis=1) - radius)
+        candidates = band[residuals <= max(2.5 * np.median(residuals), 0.005)]
+
+    inliers = band[residuals <= 0.25 * radius]
+    inlier_fraction = len(inliers) / len(band)
+    angles = np.degrees(np.arctan2(inliers[:, 1] - centre[1], inliers[:, 0] - centre[0]))
+    arc_degrees = 10 * len(np.unique(np.floor(angles / 10)))
+
+    if not min_radius <= radius <= max_radius:
+        return REASON_NO_BREAST_HEIGHT_RING, f"radius of {radius:.3f} m at breast height is implausible"
+    if inlier_fraction < min_inlier_fraction:
+        return REASON_NO_BREAST_HEIGHT_RING, f"only {inlier_fraction:.0%} of the breast height band lies on a circle"
+    if arc_degrees < min_arc_degrees:
+        return REASON_NO_BREAST_HEIGHT_RING, f"stem covered over {arc_degrees} degrees, at least {min_arc_degrees} needed"
+    return None
+
+def check_cluster_dominance(points, voxel_size=0.05, eps=0.15, min_samples=4, min_fraction=0.3):
+    """
+    Description:
+    Fails clouds without one dominant connected object, such as scans of scattered noise or of several
+    separate trees. DBSCAN runs on a voxel subsample, so it costs a fraction of the clustering of preprocessing.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    voxel_size (float, Default = 0.05): Voxel size of the subsample in meters.
+    eps (float, Default = 0.15): DBSCAN neighbourhood radius in meters, a few voxels.
+    min_samples (int, Default = 4): DBSCAN core point neighbour count.
+    min_fraction (float, Default = 0.3): Least fraction of the subsample in the largest cluster.
+
+    Returns:
+    tuple or None: (reason, message) on failure, None if the gate passes.
+    """
+    sample = voxel_subsample(points, voxel_size)
+    labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(sample)
+    clustered = labels[labels >= 0]
+    largest_fraction = np.bincount(clustered).max() / len(sample) if clustered.size else 0.0
+    if largest_fraction < min_fraction:
+        return REASON_NO_DOMINANT_CLUSTER, f"largest cluster holds {largest_fraction:.0%} of the points, at least {min_fraction:.0%} needed"
+    return None
+
+# Map of the gate names used in QUALITY_GATES to their functions
+gate_functions = {
+    'point_count': check_point_count,
+    'vertical_extent': check_vertical_extent,
+    'breast_height_ring': check_breast_height_ring,
+    'cluster_dominance': check_cluster_dominance,
+}
+
+def enforce_quality_gates(points, checkpoint, sample_size=QUALITY_SAMPLE_SIZE):
+    """
+    Description:
+    Evaluates the quality gates of a checkpoint and stops the processing of a tree that fails one, before
+    more time is spent on it. The point count is taken on all points, the other gates on a random subsample.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    checkpoint (str): A key of QUALITY_GATES.
+    sample_size (int, Default = QUALITY_SAMPLE_SIZE): Most points the other gates look at.
+
+    Raises:
+    QualityGateError: With the reason code of the first gate that failed.
+    """
+    points = np.asarray(points)
+    sample = points
+    if len(points) > sample_size:
+        sample = points[np.random.default_rng(0).choice(len(points), sample_size, replace=False)]
+
+    for gate, thresholds in QUALITY_GATES[checkpoint].items():
+        failure = gate_functions[gate](points if gate == 'point_count' else sample, **thresholds)
+        if failure is not None:
+            reason, message = failure
+            logging.warning("Quality gate '%s' failed after %s: %s", gate, checkpoint, message)
+            raise QualityGateError(reason, message)
+    logging.info("Quality gates passed after %s", checkpoint)
@@ -0,0 +1,93 @@
+import logging
+import numpy as np
+from sklearn.cluster import DBSCAN
+from utils.config import STREAM_CHUNK_POINTS
+from utils.point_stream import iter_point_chunks, random_subsample_stream
+from utils.point_cloud_utils import fit_circle_algebraic, fit_circle_to_points
+
+# Points sampled by the first pass to estimate the ground height
+GROUND_SAMPLE_POINTS = 100_000
+
+# Most band points passed to the outlier filter and the circle fit
+MAX_BAND_POINTS = 20_000
+
+def quick_dbh(path, dbh_height=1.3, half_thickness=0.05, ground_percentile=1.0, eps=0.05, min_samples=5,
+              mad_threshold=3.0, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Description:
+    Previews the diameter at breast height of a raw scan in seconds, without the cleaning, preprocessing and
+    processing stages. The scan is streamed twice: the first pass estimates the ground as a low percentile of a
+    random sample of heights, the second keeps only the band around ground + dbh_height. In the band, the largest
+    DBSCAN cluster is taken as the stem, points further from an algebraic circle than mad_threshold median absolute
+    deviations are dropped, and the remaining points are fitted with fit_circle_to_points().
+    The confidence is the product of the fraction of the stem cluster kept as inliers, the arc of the stem covered
+    by them (full marks from 180 degrees, a scan from one side) and the fit quality (zero from an RMS residual of
+    10% of the radius). Trust previews below about 0.5 only after full processing.
+
+    Parameters:
+    path (str): The file path of the raw scan.
+    dbh_height (float, Default = 1.3): Breast height above the ground in meters.
+    half_thickness (float, Default = 0.05): Half the thickness of the band in meters.
+    ground_percentile (float, Default = 1.0): Percentile of the heights taken as the ground.
+    eps (float, Default = 0.05): DBSCAN neighbourhood radius in meters for the stem cluster.
+    min_samples (int, Default = 5): DBSCAN core point neighbour count.
+    mad_threshold (float, Default = 3.0): Median absolute deviations of the radial residual beyond which points are outliers.
+    chunk_points (int, Default = STREAM_CHUNK_POINTS): Most points read at a time.
+
+    Returns:
+    preview (dict): The 'dbh', centre 'x' and 'y', 'confidence', 'ground_height', 'num_points' fitted,
+        'inlier_fraction', 'arc_degrees' and 'fit_quality', or None if no stem was found in the band.
+    """
+    sample = random_subsample_stream(iter_point_chunks(path, chunk_points), GROUND_SAMPLE_POINTS, seed=0)
+    if len(sample) == 0:
+        logging.error("No points could be read from %s", path)
+        return None
+    ground_height = float(np.percentile(sample[:, 2], ground_percentile))
+    band_height = ground_height + dbh_height
+
+    band = np.concatenate([chunk[np.abs(chunk[:, 2] - band_height) <= half_thickness, :2]
+                           for chunk in iter_point_chunks(path, chunk_points)])
+    if len(band) > MAX_BAND_POINTS:
+        band = band[np.random.default_rng(0).choice(len(band), MAX_BAND_POINTS, replace=False)]
+    logging.info("Quick DBH of %s: ground at %.3f, %d points in the band", path, ground_height, len(band))
+    if len(band) < min_samples:
+        logging.warning("Too few points at breast height in %s for a quick DBH", path)
+        return None
+
+    labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(band)
+    if not np.any(labels >= 0):
+        logging.warning("No stem found at breast height in %s", path)
+        return None
+    stem = band[labels == np.argmax(np.bincount(labels[labels >= 0]))]
+
+    centre, radius = fit_circle_algebraic(stem)
+    residuals = np.linalg.norm(stem - centre, axis=1) - radius
+    mad = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    inliers = stem[np.abs(residuals - np.median(residuals)) <= max(mad_threshold * mad, 0.002)]
+    if len(inliers) < 3:
+        logging.warning("Too few stem points at breast height in %s for a quick DBH", path)
+        return None
+
+    fit = fit_circle_to_points(inliers)
+    if fit is None:
+        return None
+    x, y, radius = fit
+    radius = abs(radius)
+    fit_quality = float(np.sqrt(np.mean((np.linalg.norm(inliers - [x, y], axis=1) - radius) ** 2)) / radius)
+    angles = np.degrees(np.arctan2(inliers[:, 1] - y, inliers[:, 0] - x))
+    arc_degrees = 10 * len(np.unique(np.floor(angles / 10)))
+    inlier_fraction = len(inliers) / len(stem)
+    confidence = inlier_fraction * min(arc_degrees / 180, 1.0) * max(0.0, 1 - fit_quality / 0.1)
+
+    logging.info("Quick DBH of %s: %.4f m with a confidence of %.2f", path, 2 * radius, confidence)
+    return {
+        'dbh': 2 * radius,
+        'x': x,
+        'y': y,
+        'confidence': confidence,
+        'ground_height': ground_height,
+        'num_points': len(inliers),
+        'inlier_fraction': inlier_fraction,
+        'arc_degrees': arc_degrees,
+        'fit_quality': fit_quality,
+    }
@@ -0,0 +1,164 @@
+import os
+import csv
+import logging
+import numpy as np
+from utils.config import RESULTS_FILENAME, PARTIAL_SUFFIX
+from utils.file_operations import partial_filepath, parse_metrics_row, parse_metric_value
+
+def results_filepath(destination_directory):
+    """
+    Description:
+    The path of the csv aggregating the metrics of every tree of a destination directory.
+
+    Parameters:
+    destination_directory (str): The destination directory of the processed trees.
+
+    Returns:
+    str: The path of the aggregated csv.
+    """
+    return os.path.join(destination_directory, RESULTS_FILENAME)
+
+def aggregate_results(destination_directory, force=False):
+    """
+    Description:
+    Gathers the one row csv written for each tree by the processing stage into a single UTF-8 csv, one row per
+    tree sorted by file name, with the columns of the first tree. Partial files of a csv still being written are skipped. The csv is rewritten only when a tree was processed
+    or removed since it was last written, so opening the results of a finished run reads one file.
+
+    Parameters:
+    destination_directory (str): The destination directory of the processed trees.
+    force (bool, Default = False): Rewrite the csv even if it is up to date.
+
+    Returns:
+    str: The path of the aggregated csv.
+    """
+    csv_directory = os.path.join(destination_directory, "csv")
+    results_path = results_filepath(destination_directory)
+    if not os.path.isdir(csv_directory):
+        csv_entries, newest_change = [], 0
+    else:
+        csv_entries = sorted((entry for entry in os.scandir(csv_directory) if entry.name.endswith(".csv") and PARTIAL_SUFFIX not in entry.name),
+                             key=lambda entry: entry.name)
+        # The directory changes when a csv is removed, the files when they are rewritten
+        newest_change = max([os.path.getmtime(csv_directory)] + [entry.stat().st_mtime for entry in csv_entries])
+    if not force and os.path.exists(results_path) and os.path.getmtime(results_path) >= newest_change:
+        return results_path
+
+    headers = None
+    temporary_path = partial_filepath(results_path)
+    with open(temporary_path, 'w', newline='', encoding='utf-8') as results_file:
+        writer = csv.writer(results_file)
+        for entry in csv_entries:
+            try:
+                with open(entry.path, newline='', encoding='utf-8') as csv_file:
+                    metrics = next(csv.DictReader(csv_file), None)
+            except (OSError, csv.Error, UnicodeDecodeError) as e:
+                logging.warning("Skipping %s in the results: %s", entry.path, e)
+                continue
+            if not metrics or 'tree_name' not in metrics:
+                continue
+            if headers is None:
+                headers = list(metrics)
+                writer.writerow(headers)
+            writer.writerow([metrics.get(header) or '' for header in headers])
+        if headers is None:
+            writer.writerow(['tree_name'])
+    os.replace(temporary_path, results_path)
+    logging.info("Aggregated the results of %d trees to %s", len(csv_entries), results_path)
+    return results_path
+
+class ResultsTable:
+    """
+    Description:
+    Read only view of the aggregated results of a destination directory for browsing large runs. Opening it
+    only indexes the byte offset of every row, rows are parsed when they are read, a page at a time, and a
+    column is parsed for all rows only when the table is first sorted by it.
+
+    Parameters:
+    destination_directory (str): The destination directory of the processed trees.
+    """
+
+    def __init__(self, destination_directory):
+        self.path = aggregate_results(destination_directory)
+        with open(self.path, 'rb') as results_file:
+            self.headers = next(csv.reader([results_file.readline().decode('utf-8')]), [])
+            header_length = results_file.tell()
+        # Every newline after the header starts a row, the last one ends the file
+        if os.path.getsize(self.path) > header_length:
+            data = np.memmap(self.path, dtype=np.uint8, mode='r', offset=header_length)
+            self._offsets = np.concatenate([[header_length], np.flatnonzero(data == ord('\n'))[:-1] + header_length + 1])
+            del data
+        else:
+            self._offsets = np.empty(0, dtype=np.int64)
+        self.order = np.arange(len(self._offsets))
+        self._columns = {}
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def row(self, index):
+        """
+        Description:
+        Reads one row in the current order.
+
+        Parameters:
+        index (int): The position of the row in the current order.
+
+        Returns:
+        list: The row data in the format returned by processing_stage().
+        """
+        return self.rows(index, index + 1)[0]
+
+    def rows(self, start, stop):
+        """
+        Description:
+        Reads the rows between two positions of the current order, seeking to each of them.
+
+        Parameters:
+        start (int): The first position.
+        stop (int): The position after the last.
+
+        Returns:
+        list of lists: The row data, see row().
+        """
+        rows = []
+        with open(self.path, 'rb') as results_file:
+            for row_index in self.order[start:stop]:
+                results_file.seek(self._offsets[row_index])
+                rows.append(parse_metrics_row(next(csv.reader([results_file.readline().decode('utf-8')]))))
+        return rows
+
+    def sort(self, column, descending=False):
+        """
+        Description:
+        Orders the rows by a column, numerically when its values are numbers, with empty values last.
+
+        Parameters:
+        column (str): The name of the column.
+        descending (bool, Default = False): Largest values first.
+        """
+        values = self._column(column)
+        missing = np.array([value is None for value in values])
+        if any(isinstance(value, str) for value in values):
+            keys = np.array(['' if value is None else str(value).lower() for value in values])
+        else:
+            keys = np.array([np.nan if value is None else value for value in values], dtype=float)
+        order = np.argsort(keys, kind='stable')
+        if descending:
+            order = order[::-1]
+        self.order = np.concatenate([order[~missing[order]], order[missing[order]]])
+
+    def _column(self, column):
+        """
+        Description:
+        The values of a column for every row in file order, parsed once and kept.
+        """
+        if column not in self._columns:
+            column_index = self.headers.index(column)
+            with open(self.path, newline='', encoding='utf-8') as results_file:
+                reader = csv.reader(results_file)
+                next(reader)
+                values = [row[column_index] if column_index < len(row) else '' for row in reader]
+            # The tree name is always kept as text, see parse_metrics_row()
+            self._columns[column] = [value or None for value in values] if column_index == 0 else [parse_metric_value(value) for value in values]
+        return self._columns[column]
@@ -0,0 +1,200 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+from utils.config import STAGE_PREFIXES, JOURNAL_FILENAME
+
+# Outputs whose checksum was computed by this process, by (path, size, mtime_ns), so a file is hashed once per run
+_known_checksums = {}
+
+class RunJournal:
+    """
+    Description:
+    A crash-safe record of which stages have completed for each tree in a destination directory, kept in a
+    SQLite database next to the processed files. Every completed stage is stored with the path, size, modification
+    time and SHA-256 checksum of its output, so a restarted batch resumes from the last stage whose output is still
+    intact instead of trusting whatever file happens to carry a stage suffix. A changed size is caught without
+    reading the file, and a process hashes a given output at most once. Connections are opened per call so
+    the journal can be shared by several worker processes.
+
+    Parameters:
+    directory (str): The destination directory the journal belongs to.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, JOURNAL_FILENAME)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                "tree TEXT NOT NULL, "
+                "stage TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "output_path TEXT, "
+                "checksum TEXT, "
+                "detail TEXT, "
+                "updated_at REAL NOT NULL, "
+                "PRIMARY KEY (tree, stage))"
+            )
+            # Journals written before the size and modification time were recorded are verified by checksum alone
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(stages)")}
+            for column in ("size", "mtime_ns"):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE stages ADD COLUMN {column} INTEGER")
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def record_stage(self, tree, stage, output_path, status="completed", detail=None):
+        """
+        Description:
+        Records the outcome of a stage for a tree, replacing any previous record of that stage.
+        The checksum of the output is taken at the time of recording.
+
+        Parameters:
+        tree (str): The base filename of the tree.
+        stage (str): The name of the stage, one of STAGE_PREFIXES.
+        output_path (str): The path of the file written by the stage, or None.
+        status (str, Default = "completed"): The outcome of the stage.
+        detail (str, Default = None): Additional information about the outcome.
+        """
+        checksum, size, mtime_ns = None, None, None
+        if output_path and os.path.isfile(output_path):
+            stat = os.stat(output_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            checksum = file_checksum(output_path)
+            _known_checksums[(output_path, size, mtime_ns)] = checksum
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO stages (tree, stage, status, output_path, checksum, detail, updated_at, size, mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (tree, stage, status, output_path, checksum, detail, time.time(), size, mtime_ns)
+            )
+        logging.info("Journal: %s %s %s", tree, stage, status)
+
+    def get_record(self, tree, stage):
+        """
+        Description:
+        Gets the record of a stage for a tree.
+
+        Parameters:
+        tree (str): The base filename of the tree.
+        stage (str): The name of the stage.
+
+        Returns:
+        dict or None: The record with status, output_path, checksum, detail, updated_at, size and mtime_ns, or None if never recorded.
+        """
+        fields = ("status", "output_path", "checksum", "detail", "updated_at", "size", "mtime_ns")
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT {', '.join(fields)} FROM stages WHERE tree = ? AND stage = ?",
+                (tree, stage)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(fields, row))
+
+    def is_completed(self, tree, stage, verify=True):
+        """
+        Description:
+        Checks that a stage completed for a tree and that its output is still on disk with the recorded size and
+        checksum. The size is compared first, so a truncated or rewritten output is caught without reading it,
+        and the checksum is only computed if this process has not already hashed the file as it is now.
+
+        Parameters:
+        tree (str): The base filename of the tree.
+        stage (str): The name of the stage.
+        verify (bool, Default = True): Compare the checksum, otherwise trust an output of the recorded size and
+            modification time, for a quick guess that the worker processing the tree confirms.
+
+        Returns:
+        bool: True if the stage can be skipped.
+        """
+        return self._verified_output(tree, stage, verify) is not None
+
+    def resume_point(self, tree, stages=None, verify=True):
+        """
+        Description:
+        Finds the most advanced stage whose output is intact, to resume processing of a tree from.
+
+        Parameters:
+        tree (str): The base filename of the tree.
+        stages (list of str, Default = None): The stage names to consider, in order, defaults to all of STAGE_PREFIXES.
+        verify (bool, Default = True): Compare the checksums of the outputs, see is_completed().
+
+        Returns:
+        tuple: The name of the stage (str) and the path to its output (str), or (None, None) if nothing has completed.
+        """
+        if stages is None:
+            stages = [stage_name for stage_name, _ in STAGE_PREFIXES]
+        for stage_name in reversed(stages):
+            output_path = self._verified_output(tree, stage_name, verify)
+            if output_path is not None:
+                return stage_name, output_path
+        return None, None
+
+    def _verified_output(self, tree, stage, verify):
+        """
+        Description:
+        The output path of a completed stage whose output is intact, see is_completed(), None otherwise.
+        """
+        record = self.get_record(tree, stage)
+        if record is None or record["status"] != "completed":
+            return None
+        output_path = record["output_path"]
+        if not output_path or not os.path.isfile(output_path):
+            return None
+        stat = os.stat(output_path)
+        if record["size"] is not None and stat.st_size != record["size"]:
+            logging.warning("Journal: output of %s %s has changed size, redoing the stage", tree, stage)
+            return None
+        if not verify:
+            return output_path if stat.st_mtime_ns == record["mtime_ns"] else None
+        key = (output_path, stat.st_size, stat.st_mtime_ns)
+        if key not in _known_checksums:
+            _known_checksums[key] = file_checksum(output_path)
+        if _known_checksums[key] != record["checksum"]:
+            logging.warning("Journal: output of %s %s does not match its checksum, redoing the stage", tree, stage)
+            return None
+        return output_path
+
+    def rejections(self):
+        """
+        Description:
+        Lists the trees rejected by a quality gate, see utils.quality_gates.
+
+        Returns:
+        dict: The reason and message of each rejected tree, keyed by tree.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT tree, detail FROM stages WHERE status = 'rejected' ORDER BY tree"
+            ).fetchall()
+        return dict(rows)
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """
+    Description:
+    Computes the SHA-256 checksum of a file, reading it in chunks.
+
+    Parameters:
+    path (str): The file to checksum.
+    chunk_size (int, Default = 1 MiB): Number of bytes to read at a time.
+
+    Returns:
+    str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,177 @@
+import os
+import logging
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+
+# Picklable description of a shared array, passed to worker processes instead of the array itself. The array
+# lives in the shared memory block called name, or in the .npy file at path when name is None.
+SharedArrayHandle = namedtuple("SharedArrayHandle", ["name", "shape", "dtype", "path"], defaults=[None])
+
+class SharedArray:
+    """
+    Description:
+    An array placed where other processes can map it without copying: a block of shared memory, or a memory
+    mapped .npy file when shared memory cannot hold it (or the array is already such a file). The creating
+    process owns the storage and releases it with close(), or by using the object as a context manager;
+    workers receive the picklable handle and open it with attached_array().
+
+    Parameters:
+    array (numpy array): The array backed by the shared storage.
+    handle (SharedArrayHandle): The handle of the storage.
+    block (SharedMemory, Default = None): The shared memory block, None for a file.
+    owns_file (bool, Default = False): Remove the file on close().
+    """
+
+    def __init__(self, array, handle, block=None, owns_file=False):
+        self.array = array
+        self.handle = handle
+        self._block = block
+        self._owns_file = owns_file
+
+    @classmethod
+    def empty(cls, shape, dtype=np.float64, spill_directory=None):
+        """
+        Description:
+        Allocates an uninitialised shared array, in shared memory or, if that fails, in a temporary .npy file
+        in spill_directory.
+
+        Parameters:
+        shape (tuple): The shape of the array.
+        dtype (numpy dtype, Default = numpy.float64): The type of the elements.
+        spill_directory (str, Default = None): Directory of the fallback file, the system temporary directory if None.
+
+        Returns:
+        SharedArray: The shared array.
+        """
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        try:
+            block = shared_memory.SharedMemory(create=True, size=size)
+        except OSError as e:
+            logging.warning("Shared memory unavailable (%s), using a memory mapped file instead", e)
+            file_descriptor, path = tempfile.mkstemp(suffix=".npy", dir=spill_directory)
+            os.close(file_descriptor)
+            array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+            return cls(array, SharedArrayHandle(None, tuple(shape), dtype.str, path), owns_file=True)
+
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        return cls(array, SharedArrayHandle(block.name, tuple(shape), dtype.str), block)
+
+    @classmethod
+    def from_array(cls, array, spill_directory=None):
+        """
+        Description:
+        Copies an array into a new shared array.
+
+        Parameters:
+        array (numpy array): The array to share.
+        spill_directory (str, Default = None): Directory of the fallback file, see empty().
+
+        Returns:
+        SharedArray: The shared array.
+        """
+        array = np.asarray(array)
+        shared = cls.empty(array.shape, array.dtype, spill_directory)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Description:
+        Shares an existing .npy file by memory mapping it, without copying. The file is not removed on close().
+
+        Parameters:
+        path (str): The path of the .npy file.
+
+        Returns:
+        SharedArray: The shared array.
+        """
+        array = np.load(path, mmap_mode='r')
+        return cls(array, SharedArrayHandle(None, array.shape, array.dtype.str, os.path.abspath(path)))
+
+    def close(self):
+        """
+        Description:
+        Releases the storage: unlinks the shared memory block, or removes the temporary file. Workers that still
+        have it open keep their mapping until they close it.
+        """
+        self.array = None
+        if self._block is not None:
+            _close_block(self._block)
+            self._block.unlink()
+            self._block = None
+        if self._owns_file and self.handle.path and os.path.exists(self.handle.path):
+            os.remove(self.handle.path)
+            self._owns_file = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def share_array(array):
+    """
+    Description:
+    Copies an array into a new block of shared memory, so worker processes can read it without it being pickled.
+    The caller owns the block and must close() it once the workers are done, see SharedArray.
+
+    Parameters:
+    array (numpy array): The array to share.
+
+    Returns:
+    SharedArray: The shared array, its handle is passed to attach_array() in the workers.
+    """
+    return SharedArray.from_array(np.ascontiguousarray(array))
+
+def attach_array(handle):
+    """
+    Description:
+    Opens an array shared by a SharedArray without copying it.
+
+    Parameters:
+    handle (SharedArrayHandle): The handle of the array.
+
+    Returns:
+    shared_block (SharedMemory or None): The shared memory block, to be closed (not unlinked) when no longer used, None for a file.
+    array (numpy array): The array, backed by the shared memory or the memory mapped file.
+    """
+    if handle.name is None:
+        return None, np.load(handle.path, mmap_mode='r')
+    shared_block = shared_memory.SharedMemory(name=handle.name)
+    return shared_block, np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shared_block.buf)
+
+@contextmanager
+def attached_array(handle):
+    """
+    Description:
+    Context manager around attach_array() that closes the mapping on exit. Arrays that must outlive the
+    context, such as the points of an Open3D cloud, have to be copied out of it.
+
+    Parameters:
+    handle (SharedArrayHandle): The handle of the array.
+
+    Yields:
+    numpy array: The shared array.
+    """
+    shared_block, array = attach_array(handle)
+    try:
+        yield array
+    finally:
+        del array
+        if shared_block is not None:
+            _close_block(shared_block)
+
+def _close_block(shared_block):
+    """
+    Description:
+    Closes a shared memory block, leaving it to the garbage collector if views of it are still alive.
+    """
+    try:
+        shared_block.close()
+    except BufferError:
+        logging.debug("Shared memory %s still has views, it is closed once they are released", shared_block.name)
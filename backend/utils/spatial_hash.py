@@ -0,0 +1,50 @@
+import numpy as np
+
+# Bits per axis of the keys of voxel_hash_keys(), three axes fit in an int64
+VOXEL_HASH_BITS = 21
+
+def voxel_hash_keys(points, voxel_size, origin):
+    """
+    Description:
+    Hashes every point to the voxel of a grid anchored at origin, packed into one int64 key of VOXEL_HASH_BITS bits
+    per axis, cheaper to group by than the rows of voxel coordinates. The origin is expected to be the minimum
+    bound of the points, as every caller passes, so the voxel coordinates are not negative and the whole range of
+    the bits is available. Clouds spanning more voxels than that on an axis fall back to numbering the distinct
+    voxels with np.unique() over the rows, slower but exact. Either way the keys sort like the voxel coordinates,
+    but they are only comparable between points hashed by the same call.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+    voxel_size (float): Edge length of the voxels in meters.
+    origin (numpy array): The corner of the grid, the minimum bound of the points.
+
+    Returns:
+    numpy array: The (N,) int64 keys.
+    """
+    cells = np.floor((np.asarray(points) - origin) / voxel_size).astype(np.int64)
+    if len(cells) and (cells.min() < 0 or cells.max() >= 1 << VOXEL_HASH_BITS):
+        _, inverse = np.unique(cells, axis=0, return_inverse=True)
+        return inverse.reshape(-1).astype(np.int64)
+    return (cells[:, 0] << (2 * VOXEL_HASH_BITS)) | (cells[:, 1] << VOXEL_HASH_BITS) | cells[:, 2]
+
+def deduplicate_points(points, tolerance):
+    """
+    Description:
+    Thins exact and near duplicate points, such as multiple returns and overlapping sweeps, in a single pass: every
+    point is hashed to a cell of tolerance meters and the first point of each cell is kept, in the original order.
+
+    Parameters:
+    points (numpy array): An (N, 3) array of points.
+    tolerance (float): Edge length of the cells in meters, nothing is removed if 0 or None.
+
+    Returns:
+    points (numpy array): The unique points, the input itself when none were removed.
+    removed (int): The number of points removed.
+    """
+    if not tolerance or len(points) == 0:
+        return points, 0
+    keys = voxel_hash_keys(points, tolerance, np.min(points, axis=0))
+    _, first_indices = np.unique(keys, return_index=True)
+    if len(first_indices) == len(points):
+        return points, 0
+    return points[np.sort(first_indices)], len(points) - len(first_indices)
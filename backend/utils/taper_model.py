@@ -0,0 +1,193 @@
+import os
+import json
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+from utils.file_operations import partial_filepath
+
+class TaperModel:
+    """
+    Description:
+    A continuous model of stem radius over height, fitted once from the slice fits of the processing stage so that
+    diameters, heights and volumes can be queried at any height without reloading the point cloud. The measured
+    radii are first made non-increasing with height, then interpolated with a monotone (PCHIP) spline which is
+    tabulated on a fine grid together with its cumulative volume. Every query is a vectorised lookup in those tables.
+
+    Parameters:
+    heights (array like): Heights above the base of the tree in meters.
+    radii (array like): The measured radius at each height in meters, None or NaN where no radius was measured.
+    total_height (float): Height of the top of the tree in meters, where the radius reaches 0.
+    weights (array like, Default = None): Confidence of each radius, higher is more trusted.
+    resolution (float, Default = 0.01): Spacing of the lookup tables in meters.
+    """
+
+    def __init__(self, heights, radii, total_height, weights=None, resolution=0.01):
+        heights = np.asarray(heights, dtype=float)
+        radii = np.asarray([np.nan if radius is None else radius for radius in radii], dtype=float)
+        weights = np.ones_like(heights) if weights is None else np.asarray(weights, dtype=float)
+
+        valid = np.isfinite(heights) & np.isfinite(radii) & (radii > 0) & np.isfinite(weights) & (weights > 0)
+        if np.count_nonzero(valid) < 2:
+            raise ValueError("At least two measured radii are required to fit a taper model.")
+
+        order = np.argsort(heights[valid])
+        knot_heights = heights[valid][order]
+        knot_radii = _non_increasing(radii[valid][order], weights[valid][order])
+
+        # Duplicate heights would break the spline, keep the first of each
+        knot_heights, unique_index = np.unique(knot_heights, return_index=True)
+        knot_radii = knot_radii[unique_index]
+        if knot_heights.size < 2:
+            raise ValueError("At least two distinct heights are required to fit a taper model.")
+
+        if total_height > knot_heights[-1]:
+            knot_heights = np.append(knot_heights, total_height)
+            knot_radii = np.append(knot_radii, 0.0)
+
+        self.knot_heights = knot_heights
+        self.knot_radii = knot_radii
+        self.total_height = float(total_height)
+        self.resolution = resolution
+
+        spline = PchipInterpolator(knot_heights, knot_radii, extrapolate=False)
+        num_samples = int(np.ceil((knot_heights[-1] - knot_heights[0]) / resolution)) + 1
+        self._grid_heights = np.linspace(knot_heights[0], knot_heights[-1], num_samples)
+        self._grid_diameters = 2 * np.clip(spline(self._grid_heights), 0, None)
+        areas = np.pi * (self._grid_diameters / 2) ** 2
+        self._grid_volumes = np.concatenate(([0.0], np.cumsum((areas[1:] + areas[:-1]) / 2 * np.diff(self._grid_heights))))
+
+    def diameter_at(self, height):
+        """
+        Description:
+        Diameter of the stem at one or more heights, 0 above the top and the lowest measured diameter below it.
+
+        Parameters:
+        height (float or array like): Heights above the base of the tree in meters.
+
+        Returns:
+        float or numpy array: The diameters in meters.
+        """
+        return np.interp(height, self._grid_heights, self._grid_diameters, right=0.0)
+
+    def height_at_diameter(self, diameter):
+        """
+        Description:
+        Lowest height at which the stem has thinned to one or more diameters.
+
+        Parameters:
+        diameter (float or array like): Diameters in meters.
+
+        Returns:
+        float or numpy array: The heights above the base of the tree in meters.
+        """
+        # Diameters never increase with height, so the negated table is sorted for np.interp
+        return np.interp(-np.asarray(diameter, dtype=float), -self._grid_diameters, self._grid_heights)
+
+    def volume_between(self, lower_height, upper_height):
+        """
+        Description:
+        Stem volume between two heights.
+
+        Parameters:
+        lower_height (float or array like): Lower heights above the base of the tree in meters.
+        upper_height (float or array like): Upper heights above the base of the tree in meters.
+
+        Returns:
+        float or numpy array: The volumes in cubic meters.
+        """
+        lower_volume = np.interp(lower_height, self._grid_heights, self._grid_volumes)
+        upper_volume = np.interp(upper_height, self._grid_heights, self._grid_volumes)
+        return np.clip(upper_volume - lower_volume, 0, None)
+
+    def merchantable_volume(self, top_diameter, stump_height=0.3):
+        """
+        Description:
+        Stem volume from the stump up to the height where the stem reaches a top diameter.
+
+        Parameters:
+        top_diameter (float or array like): Minimum top diameters in meters.
+        stump_height (float, Default = 0.3): Height of the stump in meters.
+
+        Returns:
+        float or numpy array: The merchantable volumes in cubic meters.
+        """
+        return self.volume_between(stump_height, self.height_at_diameter(top_diameter))
+
+    def total_volume(self):
+        """
+        Description:
+        Volume of the whole modelled stem.
+
+        Returns:
+        float: The volume in cubic meters.
+        """
+        return float(self._grid_volumes[-1])
+
+    def to_dict(self):
+        """
+        Description:
+        The knots of the model, which is everything needed to rebuild it.
+
+        Returns:
+        dict: The serialisable representation of the model.
+        """
+        return {
+            'heights': self.knot_heights.tolist(),
+            'radii': self.knot_radii.tolist(),
+            'total_height': self.total_height,
+            'resolution': self.resolution,
+        }
+
+    def save(self, path):
+        """
+        Description:
+        Writes the model to a JSON file, through a temporary file renamed into place once complete.
+
+        Parameters:
+        path (str): The path of the JSON file.
+        """
+        temporary_path = partial_filepath(path)
+        with open(temporary_path, 'w') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Description:
+        Reads a model written by save().
+
+        Parameters:
+        path (str): The path of the JSON file.
+
+        Returns:
+        TaperModel: The model.
+        """
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data['heights'], data['radii'], data['total_height'], resolution=data['resolution'])
+
+def _non_increasing(values, weights):
+    """
+    Description:
+    Weighted isotonic regression with the pool adjacent violators algorithm, giving the closest sequence to
+    values that never increases.
+
+    Parameters:
+    values (numpy array): The values in order.
+    weights (numpy array): The weight of each value.
+
+    Returns:
+    numpy array: The non-increasing fit.
+    """
+    block_values, block_weights, block_sizes = [], [], []
+    for value, weight in zip(values, weights):
+        block_values.append(value)
+        block_weights.append(weight)
+        block_sizes.append(1)
+        while len(block_values) > 1 and block_values[-2] < block_values[-1]:
+            total_weight = block_weights[-2] + block_weights[-1]
+            merged_value = (block_values[-2] * block_weights[-2] + block_values[-1] * block_weights[-1]) / total_weight
+            block_values[-2:] = [merged_value]
+            block_weights[-2:] = [total_weight]
+            block_sizes[-2:] = [block_sizes[-2] + block_sizes[-1]]
+    return np.repeat(block_values, block_sizes)
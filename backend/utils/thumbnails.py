@@ -0,0 +1,174 @@
+import os
+import csv
+import glob
+import html
+import logging
+import numpy as np
+from urllib.parse import quote
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.file_operations import partial_filepath
+from utils.config import PARTIAL_SUFFIX
+
+# Directory, inside the destination directory, the thumbnails and their index page are written to
+THUMBNAIL_DIRECTORY = "thumbnails"
+
+# Most points drawn in the side profile, more only slow the rendering down without changing the picture
+THUMBNAIL_MAX_POINTS = 20000
+
+def thumbnail_directory(destination_directory):
+    """
+    Description:
+    The directory the thumbnails of a destination directory are written to.
+
+    Parameters:
+    destination_directory (str): The destination directory of the processed trees.
+
+    Returns:
+    str: The path of the thumbnail directory.
+    """
+    return os.path.join(destination_directory, THUMBNAIL_DIRECTORY)
+
+def render_tree_thumbnail(points, measurements, total_height, output_path, taper_model=None, max_points=THUMBNAIL_MAX_POINTS, dpi=80):
+    """
+    Description:
+    Renders a PNG of a processed tree without a display: a side profile of the points with the measured
+    diameters drawn across the stem, next to the taper plot of the measured diameters (and the continuous
+    taper model if given). Uses the Agg canvas directly rather than pyplot, so it needs no window system and
+    is safe to call from any worker process or thread.
+
+    Parameters:
+    points (numpy array): The (N, 3) points of the tree taper.
+    measurements (list): The [height above the base, diameter] of each cookie, the diameter None where missing.
+    total_height (float): Height of the tree in meters.
+    output_path (str): The path of the PNG.
+    taper_model (TaperModel, Default = None): Continuous taper model drawn as a line through the measurements.
+    max_points (int, Default = THUMBNAIL_MAX_POINTS): Most points drawn, a random subset is drawn above it.
+    dpi (int, Default = 80): Resolution of the image.
+
+    Returns:
+    bool: True if the thumbnail was written.
+    """
+    try:
+        if len(points) > max_points:
+            points = points[np.random.default_rng(0).choice(len(points), max_points, replace=False)]
+        base_height = np.min(points[:, 2]) if len(points) else 0.0
+        heights = np.array([height for height, _ in measurements], dtype=float)
+        diameters = np.array([np.nan if diameter is None else diameter for _, diameter in measurements], dtype=float)
+
+        figure = Figure(figsize=(6, 4), dpi=dpi)
+        FigureCanvasAgg(figure)
+        profile_axes, taper_axes = figure.subplots(1, 2, gridspec_kw={'width_ratios': [1, 2]})
+
+        centre_x = np.median(points[:, 0]) if len(points) else 0.0
+        profile_axes.scatter(points[:, 0] - centre_x, points[:, 2] - base_height, s=1, c='0.4', linewidths=0, rasterized=True)
+        valid = np.isfinite(diameters)
+        profile_axes.hlines(heights[valid], -diameters[valid] / 2, diameters[valid] / 2, colors='tab:red', linewidth=1)
+        profile_axes.set_ylim(0, max(total_height, 1e-3))
+        profile_axes.set_aspect('equal', adjustable='datalim')
+        profile_axes.set_xlabel("x (m)")
+        profile_axes.set_ylabel("height (m)")
+        profile_axes.set_title("Side profile", fontsize=9)
+
+        if taper_model is not None:
+            model_heights = np.linspace(0, taper_model.total_height, 200)
+            taper_axes.plot(model_heights, taper_model.diameter_at(model_heights) * 100, color='tab:blue', linewidth=1, label="taper model")
+        taper_axes.plot(heights[valid], diameters[valid] * 100, 'o', color='tab:red', markersize=3, label="measured")
+        if not np.all(valid):
+            taper_axes.plot(heights[~valid], np.zeros(np.count_nonzero(~valid)), 'x', color='k', markersize=4, label="missing")
+        taper_axes.set_xlim(0, max(total_height, 1e-3))
+        taper_axes.set_ylim(bottom=0)
+        taper_axes.set_xlabel("height (m)")
+        taper_axes.set_ylabel("diameter (cm)")
+        taper_axes.set_title("Taper", fontsize=9)
+        taper_axes.legend(fontsize=7)
+
+        figure.suptitle(os.path.splitext(os.path.basename(output_path))[0], fontsize=10)
+        figure.tight_layout()
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temporary_path = partial_filepath(output_path)
+        figure.savefig(temporary_path, format='png')
+        os.replace(temporary_path, output_path)
+        logging.info("Thumbnail saved to %s", output_path)
+        return True
+    except Exception as e:
+        logging.error("Failed to render the thumbnail %s: %s", output_path, e)
+        return False
+
+def write_thumbnail_index(destination_directory):
+    """
+    Description:
+    Writes thumbnails/index.html in a destination directory: one card per tree with its thumbnail, height,
+    volume and DBH, read from the csv files of the destination directory so trees processed in earlier runs
+    are included. The page is static and only references the images, so hundreds of trees load quickly.
+
+    Parameters:
+    destination_directory (str): The destination directory of the processed trees.
+
+    Returns:
+    str or None: The path of the index page, or None if it could not be written.
+    """
+    directory = thumbnail_directory(destination_directory)
+    cards = []
+    for csv_filename in sorted(glob.glob(os.path.join(destination_directory, "csv", "*.csv"))):
+        if PARTIAL_SUFFIX in os.path.basename(csv_filename):
+            continue
+        try:
+            with open(csv_filename, newline='', encoding='utf-8') as csv_file:
+                metrics = next(csv.DictReader(csv_file), None)
+        except (OSError, csv.Error, UnicodeDecodeError) as e:
+            logging.warning("Skipping %s in the thumbnail index: %s", csv_filename, e)
+            continue
+        if not metrics or 'tree_name' not in metrics:
+            continue
+
+        tree_name = str(metrics['tree_name'])
+        details = [f"Height: {_format_metric(_to_float(metrics.get('tree_height')), 'm')}",
+                   f"Volume: {_format_metric(_to_float(metrics.get('volume')), 'm³', 4)}"]
+        dbh = _to_float(metrics.get('diameter_4'))
+        details.append(f"DBH: {_format_metric(dbh * 100 if dbh is not None else None, 'cm', 1)}")
+        image = f'<img src="{quote(tree_name)}.png" loading="lazy" alt="{html.escape(tree_name)}">' \
+            if os.path.exists(os.path.join(directory, tree_name + ".png")) else '<div class="missing">No thumbnail</div>'
+        cards.append(f'<figure>{image}<figcaption><b>{html.escape(tree_name)}</b><br>{" | ".join(details)}</figcaption></figure>')
+
+    page = (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Project Pinecone results</title>\n'
+        '<style>body{font-family:sans-serif;margin:1em}main{display:flex;flex-wrap:wrap;gap:1em}'
+        'figure{margin:0;width:480px}img{width:100%}figcaption{font-size:0.85em}'
+        '.missing{height:320px;background:#eee;display:flex;align-items:center;justify-content:center}</style>\n'
+        f'</head><body><h1>Project Pinecone results ({len(cards)} trees)</h1>\n<main>\n' + '\n'.join(cards) + '\n</main></body></html>\n'
+    )
+
+    index_path = os.path.join(directory, "index.html")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = partial_filepath(index_path)
+        with open(temporary_path, 'w', encoding='utf-8') as index_file:
+            index_file.write(page)
+        os.replace(temporary_path, index_path)
+    except OSError as e:
+        logging.error("Failed to write the thumbnail index %s: %s", index_path, e)
+        return None
+
+    logging.info("Thumbnail index of %d trees saved to %s", len(cards), index_path)
+    return index_path
+
+def _to_float(value):
+    """
+    Description:
+    Converts a csv value to a float, None where it is empty or not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _format_metric(value, unit, decimals=2):
+    """
+    Description:
+    Formats a metric for the index page, n/a where it is missing.
+    """
+    if value is None or not np.isfinite(value):
+        return "n/a"
+    return f"{value:.{decimals}f} {unit}"
@@ -0,0 +1,329 @@
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from utils.concurrency import get_n_jobs, get_cpu_count
+from utils.shared_arrays import share_array, attach_array
+from utils.config import TILE_OVERLAP, TILES_PER_WORKER
+
+# Points of the cloud being tiled, attached once per worker process by _attach_points()
+_shared_block = None
+_shared_points = None
+
+def plan_tiles(points, tile_size, tile_height=None, origin=None):
+    """
+    Description:
+    Partitions a point cloud into a grid of XY tiles, or XYZ tiles when a tile height is given. The points are
+    reordered so that the points of each tile are contiguous, which lets every tile be described by a range.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    tile_size (float): Width of the tiles along X and Y in meters.
+    tile_height (float, Default = None): Height of the tiles in meters, the tiles span the full height if None.
+    origin (numpy array, Default = None): Corner of the grid, the minimum bound of the points if None.
+
+    Returns:
+    order (numpy array): The indices of the points in tile order, points[order] groups them by tile.
+    tiles (list of dict): Per tile its grid 'key', the 'start' and 'end' of its points in tile order, its
+        'core_min' and 'core_max' bounds along the tiled 'dims', and the indices of its 'neighbours' in tiles.
+    """
+    dims = [0, 1, 2] if tile_height is not None else [0, 1]
+    sizes = np.array([tile_size, tile_size, tile_height if tile_height is not None else 0.0])[dims]
+    origin = np.min(points, axis=0)[dims] if origin is None else np.asarray(origin, dtype=float)[dims]
+
+    keys = np.floor((points[:, dims] - origin) / sizes).astype(np.int64)
+    key_offset = np.min(keys, axis=0)
+    grid_shape = tuple(np.max(keys, axis=0) - key_offset + 1)
+    linear_keys, inverse = np.unique(np.ravel_multi_index((keys - key_offset).T, grid_shape), return_inverse=True)
+    tile_keys = np.column_stack(np.unravel_index(linear_keys, grid_shape)) + key_offset
+    # Stable, so the points of a tile keep their original relative order and the tile runs are deterministic
+    order = np.argsort(inverse, kind='stable')
+    ends = np.cumsum(np.bincount(inverse, minlength=len(tile_keys)))
+    starts = np.concatenate([[0], ends[:-1]])
+
+    key_lookup = {tuple(key): index for index, key in enumerate(tile_keys.tolist())}
+    offsets = np.array(np.meshgrid(*[[-1, 0, 1]] * len(dims), indexing='ij')).reshape(len(dims), -1).T
+    tiles = []
+    for index, key in enumerate(tile_keys):
+        neighbours = [key_lookup[tuple(neighbour)] for neighbour in (key + offsets).tolist()
+                      if tuple(neighbour) in key_lookup and key_lookup[tuple(neighbour)] != index]
+        tiles.append({
+            'key': tuple(key.tolist()),
+            'start': int(starts[index]),
+            'end': int(ends[index]),
+            'dims': dims,
+            'core_min': origin + key * sizes,
+            'core_max': origin + (key + 1) * sizes,
+            'neighbours': neighbours,
+        })
+    return order, tiles
+
+def automatic_tile_size(points, workers, tiles_per_worker=TILES_PER_WORKER):
+    """
+    Description:
+    A tile width that splits the XY extent of the points into about tiles_per_worker tiles per worker, enough
+    tiles to balance the load without the overlap dominating.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    workers (int): Number of worker processes.
+    tiles_per_worker (int, Default = TILES_PER_WORKER): Tiles per worker to aim for.
+
+    Returns:
+    float: The tile width in meters.
+    """
+    extent = np.ptp(points[:, :2], axis=0)
+    area = max(float(extent[0] * extent[1]), float(np.max(extent)) ** 2 / 16, 1e-6)
+    return float(np.sqrt(area / max(1, workers * tiles_per_worker)))
+
+def tiling_workers(workers=None):
+    """
+    Description:
+    The number of worker processes a tiled operation uses: the thread budget of this process if one was
+    applied by apply_thread_limits(), so tiling inside a batch worker stays within its share of the cores.
+
+    Parameters:
+    workers (int, Default = None): Explicit number of workers.
+
+    Returns:
+    int: The number of workers.
+    """
+    if workers is not None:
+        return max(1, workers)
+    n_jobs = get_n_jobs()
+    return n_jobs if n_jobs > 0 else get_cpu_count()
+
+def run_tiled(points, tile_function, tile_size=None, overlap=TILE_OVERLAP, tile_height=None, origin=None, workers=None, **kwargs):
+    """
+    Description:
+    Runs tile_function over overlapping tiles of a point cloud on a pool of worker processes. The points are
+    placed in shared memory once in tile order, each worker attaches to them and receives only the ranges of
+    a tile and its neighbours, so nothing large is pickled. Each tile sees its own (core) points and the
+    points of the neighbouring tiles within overlap of its bounds (halo). Results come back in tile order
+    whatever order the workers finish in, so the stitched output is deterministic.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    tile_function (function): Module level function called as tile_function(core, halo, tile, **kwargs), where
+        tile is the entry of plan_tiles() with the 'halo_min' and 'halo_max' bounds and the 'global_min',
+        'global_max' and 'total_points' of the cloud added.
+    tile_size (float, Default = None): Width of the tiles, see automatic_tile_size() if None.
+    overlap (float, Default = TILE_OVERLAP): Width of the halo around each tile in meters.
+    tile_height (float, Default = None): Height of the tiles, the tiles span the full height if None.
+    origin (numpy array, Default = None): Corner of the tile grid, the minimum bound of the points if None.
+    workers (int, Default = None): Number of worker processes, see tiling_workers().
+    kwargs: Passed on to tile_function.
+
+    Returns:
+    order (numpy array): The indices of the points in tile order.
+    tiles (list of dict): The tiles, see plan_tiles().
+    results (list): The result of tile_function for each tile, in the order of tiles.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    workers = tiling_workers(workers)
+    if tile_size is None:
+        tile_size = automatic_tile_size(points, workers)
+
+    order, tiles = plan_tiles(points, tile_size, tile_height, origin)
+    global_min, global_max = np.min(points, axis=0), np.max(points, axis=0)
+    for tile in tiles:
+        dims = tile['dims']
+        tile['halo_min'] = tile['core_min'] - overlap
+        tile['halo_max'] = tile['core_max'] + overlap
+        tile['global_min'] = global_min[dims]
+        tile['global_max'] = global_max[dims]
+        tile['total_points'] = len(points)
+
+    sorted_points = points[order]
+    workers = min(workers, len(tiles))
+    logging.info("Running %s over %d tiles of %.2f m on %d workers", tile_function.__name__, len(tiles), tile_size, workers)
+
+    if workers <= 1:
+        results = [_run_tile_on(sorted_points, tiles, index, tile_function, kwargs) for index in range(len(tiles))]
+        return order, tiles, results
+
+    with share_array(sorted_points) as shared_points:
+        del sorted_points
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_points, initargs=(shared_points.handle,)) as executor:
+            results = list(executor.map(_run_tile, [(tiles, index, tile_function, kwargs) for index in range(len(tiles))]))
+    return order, tiles, results
+
+def _attach_points(handle):
+    """
+    Description:
+    Initialises a tiling worker: attaches the shared points once for every tile the worker runs.
+    """
+    global _shared_block, _shared_points
+    _shared_block, _shared_points = attach_array(handle)
+
+def _run_tile(task):
+    """
+    Description:
+    Runs a tile in a worker process on the shared points.
+    """
+    tiles, index, tile_function, kwargs = task
+    return _run_tile_on(_shared_points, tiles, index, tile_function, kwargs)
+
+def _run_tile_on(sorted_points, tiles, index, tile_function, kwargs):
+    """
+    Description:
+    Gathers the core and halo points of a tile from the points in tile order and runs tile_function on them.
+    """
+    tile = tiles[index]
+    dims = tile['dims']
+    core = sorted_points[tile['start']:tile['end']]
+    halo_parts = []
+    for neighbour_index in tile['neighbours']:
+        neighbour = tiles[neighbour_index]
+        candidates = sorted_points[neighbour['start']:neighbour['end']]
+        inside = np.all((candidates[:, dims] >= tile['halo_min']) & (candidates[:, dims] <= tile['halo_max']), axis=1)
+        halo_parts.append(candidates[inside])
+    halo = np.concatenate(halo_parts) if halo_parts else np.empty((0, 3))
+    return tile_function(core, halo, tile, **kwargs)
+
+def _tile_mean_neighbour_distances(core, halo, tile, nb_neighbors):
+    """
+    Description:
+    Average distance from each core point to its nb_neighbors nearest neighbours (counting itself) among the
+    core and halo points. A result is exact when the furthest neighbour is no further than the nearest side of
+    the halo that has points beyond it, the other points are flagged for the caller to recompute.
+    """
+    local_points = np.concatenate([core, halo])
+    k = min(nb_neighbors, tile['total_points'])
+    if len(local_points) < k:
+        return np.zeros(len(core)), np.zeros(len(core), dtype=bool)
+
+    distances, _ = cKDTree(local_points).query(core, k=k)
+    if k == 1:
+        distances = distances[:, None]
+
+    dims = tile['dims']
+    # Sides of the halo on the boundary of the whole cloud have no points beyond them
+    lower = np.where(tile['halo_min'] <= tile['global_min'], -np.inf, tile['halo_min'])
+    upper = np.where(tile['halo_max'] >= tile['global_max'], np.inf, tile['halo_max'])
+    margins = np.min(np.minimum(core[:, dims] - lower, upper - core[:, dims]), axis=1)
+    return distances.mean(axis=1), distances[:, -1] <= margins
+
+def tiled_statistical_outliers(points, nb_neighbors=20, std_ratio=1.0, **tiling):
+    """
+    Description:
+    Statistical outlier removal over tiles: the average neighbour distances are computed per tile in parallel,
+    then a single global threshold of mean + std_ratio standard deviations is applied, matching the untiled
+    removal exactly. The few points near a tile edge whose neighbours may lie outside the halo are recomputed
+    against the whole cloud.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    nb_neighbors (int, Default = 20): Number of neighbours to average over, counting the point itself.
+    std_ratio (float, Default = 1.0): Standard deviation ratio of the threshold.
+    tiling: Passed on to run_tiled().
+
+    Returns:
+    numpy array: The indices of the points kept, in ascending order.
+    """
+    order, _, results = run_tiled(points, _tile_mean_neighbour_distances, nb_neighbors=nb_neighbors, **tiling)
+    average_distances = np.empty(len(points))
+    exact = np.empty(len(points), dtype=bool)
+    average_distances[order] = np.concatenate([distances for distances, _ in results])
+    exact[order] = np.concatenate([tile_exact for _, tile_exact in results])
+
+    inexact_rows = np.flatnonzero(~exact)
+    if inexact_rows.size:
+        logging.info("Recomputing %d points near tile edges against the whole cloud", inexact_rows.size)
+        k = min(nb_neighbors, len(points))
+        distances, _ = cKDTree(points).query(points[inexact_rows], k=k, workers=get_n_jobs())
+        average_distances[inexact_rows] = distances.reshape(len(inexact_rows), k).mean(axis=1)
+
+    threshold = average_distances.mean() + std_ratio * average_distances.std(ddof=1)
+    return np.flatnonzero(average_distances < threshold)
+
+def _tile_radius_inliers(core, halo, tile, nb_neighbors, radius):
+    """
+    Description:
+    Flags the core points with more than nb_neighbors points (counting itself) among the core and halo points
+    within radius. With a halo at least radius wide every neighbour within radius is in the tile, so the flags
+    are exact.
+    """
+    local_points = np.concatenate([core, halo])
+    if len(local_points) <= nb_neighbors:
+        return np.zeros(len(core), dtype=bool)
+    distances, _ = cKDTree(local_points).query(core, k=nb_neighbors + 1, distance_upper_bound=radius)
+    return distances[:, -1] <= radius
+
+def tiled_radius_outliers(points, nb_neighbors=15, radius=0.05, **tiling):
+    """
+    Description:
+    Radius outlier removal over tiles: a point is kept when more than nb_neighbors points (counting itself) lie
+    within radius of it, like Open3D's remove_radius_outlier(). The halo of the tiles is widened to the radius, so the result matches the untiled
+    removal exactly and no KD-tree over the whole cloud is built.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    nb_neighbors (int, Default = 15): Number of other points required within the radius.
+    radius (float, Default = 0.05): Radius in meters.
+    tiling: Passed on to run_tiled(), the overlap is at least the radius.
+
+    Returns:
+    numpy array: The indices of the points kept, in ascending order.
+    """
+    tiling['overlap'] = max(tiling.get('overlap', TILE_OVERLAP), radius)
+    order, _, results = run_tiled(points, _tile_radius_inliers, nb_neighbors=nb_neighbors, radius=radius, **tiling)
+    inliers = np.empty(len(points), dtype=bool)
+    inliers[order] = np.concatenate(results)
+    return np.flatnonzero(inliers)
+
+def _voxel_origin(points, voxel_size):
+    """
+    Description:
+    The corner of the voxel grid, half a voxel below the minimum bound like Open3D's voxel downsampling.
+    """
+    return np.min(points, axis=0) - voxel_size / 2
+
+def _tile_voxel_sums(core, halo, tile, voxel_size, voxel_origin, grid_shape):
+    """
+    Description:
+    Sums and counts the core points of each voxel of the global grid, keyed by the voxel's linear index.
+    """
+    voxel_indices = np.floor((core - voxel_origin) / voxel_size).astype(np.int64)
+    voxel_keys = np.ravel_multi_index(voxel_indices.T, grid_shape)
+    unique_keys, inverse, counts = np.unique(voxel_keys, return_inverse=True, return_counts=True)
+    sums = np.column_stack([np.bincount(inverse, weights=core[:, axis], minlength=len(unique_keys)) for axis in range(3)])
+    return unique_keys, sums, counts
+
+def tiled_voxel_downsample(points, voxel_size=0.02, **tiling):
+    """
+    Description:
+    Voxel downsampling over tiles, each point replaced by the average of the points in its voxel like Open3D's
+    voxel_down_sample(). The voxel grid is anchored to the bounds of the whole cloud and the tiles are aligned
+    to it, so voxels do not depend on the tiling; the per tile sums are merged by voxel, so a voxel split
+    between tiles is still averaged once. The output is ordered by voxel, identical for any tiling.
+
+    Parameters:
+    points (numpy array): The (N, 3) points.
+    voxel_size (float, Default = 0.02): Voxel size in meters.
+    tiling: Passed on to run_tiled(), the tile size is rounded up to a whole number of voxels.
+
+    Returns:
+    numpy array: The (M, 3) downsampled points.
+    """
+    voxel_origin = _voxel_origin(points, voxel_size)
+    grid_shape = tuple(int(size) for size in np.floor((np.max(points, axis=0) - voxel_origin) / voxel_size).astype(np.int64) + 1)
+    if np.prod(np.array(grid_shape, dtype=float)) >= 2 ** 62:
+        raise ValueError(f"Too many voxels of {voxel_size} m to index")
+
+    tile_size = tiling.pop('tile_size', None)
+    if tile_size is None:
+        tile_size = automatic_tile_size(points, tiling_workers(tiling.get('workers')))
+    tiling['tile_size'] = np.ceil(tile_size / voxel_size) * voxel_size
+    tiling['overlap'] = 0.0
+    tiling['origin'] = voxel_origin
+
+    _, _, results = run_tiled(points, _tile_voxel_sums, voxel_size=voxel_size, voxel_origin=voxel_origin, grid_shape=grid_shape, **tiling)
+    keys = np.concatenate([tile_keys for tile_keys, _, _ in results])
+    sums = np.concatenate([tile_sums for _, tile_sums, _ in results])
+    counts = np.concatenate([tile_counts for _, _, tile_counts in results])
+
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    merged_counts = np.bincount(inverse, weights=counts, minlength=len(unique_keys))
+    merged_sums = np.column_stack([np.bincount(inverse, weights=sums[:, axis], minlength=len(unique_keys)) for axis in range(3)])
+    return merged_sums / merged_counts[:, None]
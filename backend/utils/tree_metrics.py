@@ -0,0 +1,157 @@
+import numpy as np
+
+# Minimum top diameters in meters the merchantable volume is reported to
+MERCHANTABLE_TOP_DIAMETERS = [0.05, 0.10, 0.15]
+
+def frustum_volumes(heights, diameters):
+    """
+    Description:
+    Volume of the frustum between each pair of consecutive measurements, NaN where either diameter is missing.
+
+    Parameters:
+    heights (numpy array): Heights of the measurements in meters, in ascending order.
+    diameters (numpy array): Diameters at those heights in meters, NaN where missing.
+
+    Returns:
+    numpy array: The volume of each of the len(heights) - 1 segments in cubic meters.
+    """
+    segment_heights = np.diff(heights)
+    r1 = diameters[:-1] / 2
+    r2 = diameters[1:] / 2
+    return (1 / 3) * np.pi * segment_heights * (r1 ** 2 + r1 * r2 + r2 ** 2)
+
+def merchantable_volumes(heights, diameters, top_diameters):
+    """
+    Description:
+    Volume from the lowest measurement up to where the stem first narrows to each top diameter, with the
+    crossing located by linear interpolation inside the segment. Computed for all top diameters at once.
+
+    Parameters:
+    heights (numpy array): Heights of the measurements in meters, in ascending order.
+    diameters (numpy array): Diameters at those heights in meters, NaN where missing.
+    top_diameters (array like): Minimum top diameters in meters.
+
+    Returns:
+    numpy array: The merchantable volume for each top diameter in cubic meters.
+    """
+    top_diameters = np.asarray(top_diameters, dtype=float)[:, None]
+    d1, d2 = diameters[None, :-1], diameters[None, 1:]
+    segment_heights = np.diff(heights)[None, :]
+
+    # Fraction of each segment below the crossing, 1 if it never narrows to the top diameter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(d2 >= top_diameters, 1.0, np.clip((d1 - top_diameters) / (d1 - d2), 0, 1))
+    # Everything above the first segment that crosses the top diameter is not merchantable, missing diameters do not end it
+    continues = ~(d2[:, :-1] < top_diameters)
+    fraction *= np.cumprod(np.concatenate([np.ones((fraction.shape[0], 1)), continues], axis=1), axis=1)
+
+    r1 = d1 / 2
+    r_top = (d1 + fraction * (d2 - d1)) / 2
+    volumes = (1 / 3) * np.pi * fraction * segment_heights * (r1 ** 2 + r1 * r_top + r_top ** 2)
+    return np.nansum(volumes, axis=1)
+
+def compute_tree_metrics(heights, diameters, centres, total_height, dbh_height=1.3, top_diameters=MERCHANTABLE_TOP_DIAMETERS, stem_rotation=None):
+    """
+    Description:
+    Computes the per-tree metrics from the slice fits already made by the processing stage, without touching
+    the point cloud. Everything is vectorised over the slices.
+
+    Volume: Sum of the frustums between consecutive slices, leaving out segments with a missing diameter.
+    Basal area: Cross sectional area at breast height.
+    Form factor: Volume relative to a cylinder with the basal area and the height of the tree.
+    Lean: Angle from vertical, and its azimuth from the X axis, of the line fitted through the slice centres.
+    Sweep: Largest distance of a slice centre from the straight line between the lowest and highest centre.
+    Merchantable volume: Volume up to each of the top diameters, see merchantable_volumes().
+
+    Parameters:
+    heights (array like): Heights of the slices above the base of the tree in meters.
+    diameters (array like): Diameter of each slice in meters, None or NaN where no circle was fitted.
+    centres (array like): The (x, y) centre of each slice, None or NaN where no circle was fitted.
+    total_height (float): Height of the tree in meters.
+    dbh_height (float, Default = 1.3): Breast height in meters.
+    top_diameters (array like, Default = MERCHANTABLE_TOP_DIAMETERS): Top diameters for the merchantable volumes.
+    stem_rotation (array like, Default = None): The 3x3 rotation applied by align_stem_axis(), so the lean is
+        reported in the original scan orientation rather than relative to the aligned stem.
+
+    Returns:
+    metrics (dict): The 'volume', 'basal_area', 'form_factor', 'lean_degrees', 'lean_azimuth_degrees', 'sweep'
+        and 'merchantable_volumes' (one per top diameter), NaN where they cannot be computed.
+    """
+    heights = np.asarray(heights, dtype=float)
+    diameters = np.array([np.nan if diameter is None else diameter for diameter in diameters], dtype=float)
+    centres = np.array([(np.nan, np.nan) if centre is None else centre for centre in centres], dtype=float).reshape(-1, 2)
+
+    order = np.argsort(heights)
+    heights, diameters, centres = heights[order], diameters[order], centres[order]
+    valid = np.isfinite(diameters)
+
+    volume = float(np.nansum(frustum_volumes(heights, diameters)))
+
+    if np.count_nonzero(valid) >= 1:
+        dbh = np.interp(dbh_height, heights[valid], diameters[valid])
+        basal_area = np.pi * (dbh / 2) ** 2
+    else:
+        basal_area = np.nan
+    form_factor = volume / (basal_area * total_height) if basal_area > 0 and total_height > 0 else np.nan
+
+    centre_valid = np.all(np.isfinite(centres), axis=1)
+    lean_degrees = lean_azimuth_degrees = sweep = np.nan
+    if np.count_nonzero(centre_valid) >= 2:
+        centre_heights = heights[centre_valid]
+        stem_centres = centres[centre_valid]
+
+        # Least squares line x(h), y(h) through the centres, its slope gives the lean
+        design = np.column_stack([centre_heights, np.ones_like(centre_heights)])
+        (slope_x, slope_y), _ = np.linalg.lstsq(design, stem_centres, rcond=None)[0]
+        direction = np.array([slope_x, slope_y, 1.0])
+        if stem_rotation is not None:
+            direction = np.asarray(stem_rotation).T @ direction
+        lean_degrees = float(np.degrees(np.arccos(np.clip(direction[2] / np.linalg.norm(direction), -1, 1))))
+        lean_azimuth_degrees = float(np.degrees(np.arctan2(direction[1], direction[0])) % 360)
+
+        axis_points = np.column_stack([stem_centres, centre_heights])
+        chord = axis_points[-1] - axis_points[0]
+        chord_length = np.linalg.norm(chord)
+        if chord_length > 0:
+            offsets = axis_points - axis_points[0]
+            sweep = float(np.max(np.linalg.norm(np.cross(offsets, chord / chord_length), axis=1)))
+
+    return {
+        'volume': volume,
+        'basal_area': float(basal_area),
+        'form_factor': float(form_factor),
+        'lean_degrees': lean_degrees,
+        'lean_azimuth_degrees': lean_azimuth_degrees,
+        'sweep': sweep,
+        'merchantable_volumes': merchantable_volumes(heights, diameters, top_diameters).tolist(),
+    }
+
+def metric_headers(top_diameters=MERCHANTABLE_TOP_DIAMETERS):
+    """
+    Description:
+    The csv column names of the metrics returned by compute_tree_metrics(), in the order of metric_values().
+
+    Parameters:
+    top_diameters (array like, Default = MERCHANTABLE_TOP_DIAMETERS): Top diameters of the merchantable volumes.
+
+    Returns:
+    list: The column names.
+    """
+    headers = ['basal_area', 'form_factor', 'lean_degrees', 'lean_azimuth_degrees', 'sweep']
+    headers.extend(f'merchantable_volume_{round(top_diameter * 100)}cm' for top_diameter in top_diameters)
+    return headers
+
+def metric_values(metrics):
+    """
+    Description:
+    The values of the metrics returned by compute_tree_metrics(), in the order of metric_headers().
+
+    Parameters:
+    metrics (dict): The metrics.
+
+    Returns:
+    list: The values.
+    """
+    values = [metrics['basal_area'], metrics['form_factor'], metrics['lean_degrees'], metrics['lean_azimuth_degrees'], metrics['sweep']]
+    values.extend(metrics['merchantable_volumes'])
+    return values
@@ -0,0 +1,259 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Add the backend directory to sys.path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
+
+from service import warm_worker, run_job
+from utils.concurrency import plan_concurrency, apply_thread_limits, get_cpu_count
+from utils.logging_utils import start_logging
+from utils.file_operations import partial_filepath
+from utils.point_stream import LAS_EXTENSIONS
+from utils.results_table import aggregate_results
+from utils.config import WATCH_STATE_FILENAME, WATCH_MAX_POOL_CRASHES, PARTIAL_SUFFIX
+
+# Scan formats picked up from the watched directory
+WATCH_EXTENSIONS = ('.xyz',) + LAS_EXTENSIONS
+
+class HotFolderWatcher:
+    """
+    Description:
+    Processes the scans copied into a directory as they arrive, with the extract_tree_taper + processing_stage
+    chain of process() on a pool of warm worker processes. The directory is polled, which works on network
+    shares where change notifications are unreliable, and a file is only processed once its size and
+    modification time have not changed for settle_seconds, so files still being copied are left alone.
+    At most workers + max_queued scans are handed to the pool; further ready scans wait in the directory until
+    a worker frees up. The outcome of every scan is saved to WATCH_STATE_FILENAME in the watched directory with
+    its size and modification time, so a restarted watcher skips the scans it already processed and picks up a
+    scan again only if it was replaced. A worker dying, killed for running out of memory for instance, breaks the
+    whole pool: the pool is restarted and the scans it held are processed again, up to WATCH_MAX_POOL_CRASHES times.
+
+    Parameters:
+    watch_directory (str): The directory scans are copied into.
+    destination_directory (str, Default = None): The destination directory, ./pinecone in the watched directory if None.
+    workers (int, Default = None): Number of worker processes, derived from the core count if not given.
+    threads (int, Default = None): Number of threads per worker, derived from the core count if not given.
+    max_queued (int, Default = None): Most scans waiting in the pool for a worker, the number of workers if None.
+    poll_seconds (float, Default = 2.0): Seconds between scans of the directory.
+    settle_seconds (float, Default = 10.0): Seconds a file must stay unchanged before it is processed.
+    """
+
+    def __init__(self, watch_directory, destination_directory=None, workers=None, threads=None, max_queued=None,
+                 poll_seconds=2.0, settle_seconds=10.0):
+        self.watch_directory = watch_directory
+        self.destination_directory = destination_directory or os.path.join(watch_directory, "pinecone")
+        self.workers, self.threads = plan_concurrency(get_cpu_count(), workers, threads)
+        self.max_queued = self.workers if max_queued is None else max_queued
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.state_path = os.path.join(watch_directory, WATCH_STATE_FILENAME)
+        self.state = self._load_state()
+        # Files seen changing, by name: their (size, mtime) and the time that signature was first seen
+        self.settling = {}
+        self.ready = deque()
+        # Signature of each ready or running scan when it settled, recorded with its outcome
+        self.signatures = {}
+        self.running = {}
+        # Times each scan was in a pool that broke
+        self.crashes = {}
+        self.executor = None
+        self.log_queue = None
+        self.backpressure = False
+
+    def start_workers(self):
+        """
+        Description:
+        Starts the worker pool, loading the heavy libraries in every worker up front.
+        """
+        apply_thread_limits(self.threads)
+        self.log_queue = start_logging(multiprocess=True, console_level=logging.INFO)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker, initargs=(self.threads, self.log_queue))
+        logging.info("Watching %s with %d workers of %d threads, results in %s", self.watch_directory, self.workers,
+                     self.threads, self.destination_directory)
+
+    def restart_workers(self):
+        """
+        Description:
+        Replaces a broken worker pool with a new one.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker, initargs=(self.threads, self.log_queue))
+        logging.warning("Restarted the worker pool")
+
+    def shutdown(self):
+        """
+        Description:
+        Stops the pool after the scans being processed finish, queued scans are picked up again on restart.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def scan(self):
+        """
+        Description:
+        Lists the watched directory and moves the scans whose size and modification time settled to the ready queue.
+        Scans already processed with the same signature, and scans queued or running, are skipped.
+        """
+        now = time.monotonic()
+        present = set()
+        for entry in os.scandir(self.watch_directory):
+            name = entry.name
+            if (not entry.is_file() or name.startswith('.') or PARTIAL_SUFFIX in name
+                    or os.path.splitext(name)[1].lower() not in WATCH_EXTENSIONS):
+                continue
+            present.add(name)
+            stat = entry.stat()
+            if stat.st_size == 0:
+                continue
+            signature = [stat.st_size, stat.st_mtime_ns]
+            if name in self.ready or name in self.running.values():
+                continue
+            record = self.state.get(name)
+            if record is not None and record['signature'] == signature:
+                continue
+
+            settling = self.settling.get(name)
+            if settling is None or settling[0] != signature:
+                self.settling[name] = (signature, now)
+            elif now - settling[1] >= self.settle_seconds:
+                del self.settling[name]
+                self.signatures[name] = signature
+                self.ready.append(name)
+                logging.info("%s is ready for processing", name)
+
+        # Forget files removed before they settled
+        for name in set(self.settling) - present:
+            del self.settling[name]
+
+    def dispatch(self):
+        """
+        Description:
+        Hands ready scans to the pool while it holds fewer than workers + max_queued of them.
+        """
+        while self.ready and len(self.running) < self.workers + self.max_queued:
+            name = self.ready.popleft()
+            future = self.executor.submit(run_job, os.path.join(self.watch_directory, name), self.destination_directory)
+            self.running[future] = name
+        if self.ready and not self.backpressure:
+            logging.warning("The processing queue is full, %d ready scans wait for a worker", len(self.ready))
+        self.backpressure = bool(self.ready)
+
+    def collect(self, timeout):
+        """
+        Description:
+        Waits up to timeout seconds for scans to finish and records their outcome in the state file. When the pool
+        broke, the scans it held are not recorded but queued again ahead of the others, and the pool is restarted.
+
+        Parameters:
+        timeout (float): The most seconds to wait.
+        """
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+        if broken:
+            # Every scan still in the pool is lost with it, not only those already reported
+            done = list(self.running)
+        retried = []
+        for future in done:
+            name = self.running.pop(future)
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.crashes[name] = self.crashes.get(name, 0) + 1
+                if self.crashes[name] <= WATCH_MAX_POOL_CRASHES:
+                    retried.append(name)
+                    continue
+            signature = self.signatures.pop(name)
+            self.crashes.pop(name, None)
+            try:
+                result = future.result()
+                status = 'done' if result['metrics'] is not None else 'failed'
+                error = None if status == 'done' else "Processing did not complete, see the log of the tree"
+            except BrokenProcessPool as e:
+                status, error = 'failed', f"A worker died every time it was processed: {e}"
+            except Exception as e:
+                status, error = 'failed', str(e)
+            self.state[name] = {'signature': signature, 'status': status, 'error': error, 'finished_at': time.time()}
+            if status == 'done':
+                logging.info("Processed %s", name)
+            else:
+                logging.error("Failed to process %s: %s", name, error)
+        if broken:
+            logging.warning("A worker died, %d scans of the broken pool will be processed again", len(retried))
+            self.ready.extendleft(reversed(retried))
+            self.restart_workers()
+        if len(retried) < len(done):
+            self._save_state()
+            if not self.running and not self.ready:
+                aggregate_results(self.destination_directory)
+
+    def run(self, stop_when_idle=False):
+        """
+        Description:
+        Polls, dispatches and collects until interrupted.
+
+        Parameters:
+        stop_when_idle (bool, Default = False): Return once every scan in the directory has been processed.
+        """
+        self.start_workers()
+        try:
+            while True:
+                self.scan()
+                self.dispatch()
+                if stop_when_idle and not (self.settling or self.ready or self.running):
+                    return
+                self.collect(self.poll_seconds)
+        finally:
+            self.shutdown()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read the watch state %s, every scan will be checked again: %s", self.state_path, e)
+            return {}
+
+    def _save_state(self):
+        temporary_path = partial_filepath(self.state_path)
+        with open(temporary_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=1)
+        os.replace(temporary_path, self.state_path)
+
+def main():
+    """
+    Description:
+    Command line entry point of the hot folder watcher.
+    """
+    parser = argparse.ArgumentParser(description="Process point cloud scans as they are copied into a directory.")
+    parser.add_argument("directory", help="Directory to watch for .xyz and .las scans")
+    parser.add_argument("--destination", default=None, help="Destination directory for processed files, ./pinecone in the watched directory by default")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, the limit of concurrently processed trees")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads per worker")
+    parser.add_argument("--max-queued", type=int, default=None, help="Most scans waiting for a worker, the number of workers by default")
+    parser.add_argument("--poll", type=float, default=2.0, help="Seconds between scans of the directory")
+    parser.add_argument("--settle", type=float, default=10.0, help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--once", action="store_true", help="Exit once every scan in the directory has been processed")
+    args = parser.parse_args()
+
+    start_logging(console_level=logging.INFO)
+    watcher = HotFolderWatcher(args.directory, args.destination, args.workers, args.threads, args.max_queued, args.poll, args.settle)
+    try:
+        watcher.run(stop_when_idle=args.once)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
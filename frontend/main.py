@@ -1,16 +1,17 @@
 import tkinter as tk
-from tkinter import filedialog, LabelFrame
+from tkinter import filedialog, LabelFrame, ttk
 import subprocess
 import os
 import sys
 import threading
+import multiprocessing
 
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from backend.main import process, visualize_point_cloud, process_and_visualize
+from backend.main import process, visualize_point_cloud, process_and_visualize, apply_thread_limits, get_cpu_count, quick_dbh, ResultsTable
 
 def disable_all_buttons():
     """
@@ -20,29 +21,35 @@ def disable_all_buttons():
     process_button["state"] = "disabled"
     visualize_button["state"] = "disabled"
     process_and_visualize_button["state"] = "disabled"
+    quick_dbh_button["state"] = "disabled"
+    results_button["state"] = "disabled"
 
 def enable_all_buttons():
     """
-    enables all buttons
+    enables all buttons, those acting on the selected file only once a file is selected
     """
+    file_state = "normal" if file_path_label.cget("text").split("File Path:")[1].strip() else "disabled"
     browse_button["state"] = "normal"
-    process_button["state"] = "normal"
-    visualize_button["state"] = "normal"
-    process_and_visualize_button["state"] = "normal"
+    process_button["state"] = file_state
+    visualize_button["state"] = file_state
+    process_and_visualize_button["state"] = file_state
+    quick_dbh_button["state"] = file_state
+    results_button["state"] = "normal"
 
 def wait_while_processing(target_function):
     """
     Decorator function to allow multithreading of the backend processing. Diables all buttons while
     a chile process is running, and re-enables it when the child process is done. Updates the status lable to
-    ensure clarity of current process.
+    ensure clarity of current process, showing the message returned by the target function when it has one.
     """
-    def threading_wrapper():
+    def threading_wrapper(*args):
         def run():
             root.after(0, update_status, "Processing...")
+            message = None
             try:
-                target_function()
+                message = target_function(*args)
             finally:
-                root.after(0, update_status, "Ready")
+                root.after(0, update_status, message or "Ready")
                 root.after(0, enable_all_buttons)
 
         disable_all_buttons()
@@ -56,6 +63,7 @@ def browse_file():
         process_button["state"] = "normal"
         visualize_button["state"] = "normal"
         process_and_visualize_button["state"] = "normal"
+        quick_dbh_button["state"] = "normal"
         
         for entry in dbh_height_group + main_taper_group:
             entry.delete(0, tk.END)
@@ -70,8 +78,11 @@ def process_file():
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
 
+    apply_selected_thread_limit()
     processed_file, _ = process(file_path, destination_directory)
-    update_entries(processed_file)
+    if processed_file is None:
+        return f"Processing failed, see the log in {os.path.join(destination_directory, 'logs')}"
+    root.after(0, update_entries, processed_file)
  
 @wait_while_processing
 def visualize_file():
@@ -82,8 +93,120 @@ def visualize_file():
 def process_and_visualize_file():
     file_path = file_path_label.cget("text").split("File Path: ")[1]
     destination_directory = os.path.join(os.path.dirname(file_path), "pinecone")
+    apply_selected_thread_limit()
     processed_file = process_and_visualize(file_path, destination_directory)
-    update_entries(processed_file)
+    if processed_file is None:
+        return f"Processing failed, see the log in {os.path.join(destination_directory, 'logs')}"
+    root.after(0, update_entries, processed_file)
+
+@wait_while_processing
+def quick_dbh_file():
+    file_path = file_path_label.cget("text").split("File Path: ")[1]
+    preview = quick_dbh(file_path)
+    root.after(0, update_quick_dbh_entries, file_path, preview)
+
+# Rows shown per page of the results table, the Treeview only ever holds one page
+RESULTS_PAGE_SIZE = 200
+
+# Columns of the results table, (csv column, heading)
+RESULTS_COLUMNS = [("tree_name", "Tree"), ("tree_height", "Height (M)"), ("diameter_4", "DBH (M)"),
+                   ("volume", "Volume (M³)"), ("basal_area", "Basal Area (M²)")]
+
+# The open results table, its current page and sort
+results_view = {'table': None, 'page': 0, 'sort': None, 'descending': False}
+
+def open_results():
+    """
+    Asks for a destination directory and shows the results of all its trees in the results table
+    """
+    directory = filedialog.askdirectory(title="Select a Pinecone results directory")
+    if not directory:
+        return
+    load_results(directory)
+
+@wait_while_processing
+def load_results(directory):
+    """
+    Aggregates and indexes the results of a directory off the Tk thread, then shows them
+    """
+    root.after(0, update_status, "Loading results...")
+    table = ResultsTable(directory)
+    root.after(0, show_loaded_results, table)
+    return f"{len(table)} trees in {directory}"
+
+def show_loaded_results(table):
+    results_view.update(table=table, page=0, sort=None, descending=False)
+    show_results_page()
+
+def show_results_page():
+    """
+    Replaces the rows of the results table with the current page, read from disk
+    """
+    table = results_view['table']
+    results_tree.delete(*results_tree.get_children())
+    if table is None:
+        return
+    page_count = max(1, -(-len(table) // RESULTS_PAGE_SIZE))
+    results_view['page'] = min(max(results_view['page'], 0), page_count - 1)
+    start = results_view['page'] * RESULTS_PAGE_SIZE
+
+    column_indices = [table.headers.index(column) if column in table.headers else None for column, _ in RESULTS_COLUMNS]
+    for offset, row in enumerate(table.rows(start, start + RESULTS_PAGE_SIZE)):
+        values = []
+        for index in column_indices:
+            value = row[index] if index is not None and index < len(row) else None
+            values.append("n/a" if value is None else value if isinstance(value, str) else "{:.3f}".format(value))
+        # The item id is the position in the sorted table, so a selection maps back to its row
+        results_tree.insert("", tk.END, iid=str(start + offset), values=values)
+    results_page_label.config(text=f"Page {results_view['page'] + 1} of {page_count}")
+
+def change_results_page(step):
+    results_view['page'] += step
+    show_results_page()
+
+def sort_results(column):
+    """
+    Sorts the results table by a column, clicking the same heading again reverses the order. Ignored while
+    another task runs, the table is sorted on the processing thread
+    """
+    table = results_view['table']
+    if table is None or column not in table.headers or results_button["state"] == "disabled":
+        return
+    results_view['descending'] = not results_view['descending'] if results_view['sort'] == column else False
+    results_view['sort'] = column
+    sort_results_table(table, column, results_view['descending'])
+
+@wait_while_processing
+def sort_results_table(table, column, descending):
+    """
+    Parses the column and orders the table off the Tk thread, then shows its first page
+    """
+    root.after(0, update_status, "Sorting results...")
+    table.sort(column, descending)
+    root.after(0, show_sorted_results, table)
+
+def show_sorted_results(table):
+    if results_view['table'] is table:
+        results_view['page'] = 0
+        show_results_page()
+
+def select_result(event):
+    """
+    Shows the selected tree of the results table in the detail fields
+    """
+    selection = results_tree.selection()
+    if selection and results_view['table'] is not None:
+        update_entries(results_view['table'].row(int(selection[0])))
+
+def apply_selected_thread_limit():
+    """
+    Limits the backend's Open3D, BLAS and scikit-learn threads to the value selected in the Threads box
+    """
+    try:
+        threads = int(threads_spinbox.get())
+    except ValueError:
+        threads = get_cpu_count()
+    apply_thread_limits(threads)
 
 def resource_path(relative_path):
     """
@@ -127,100 +250,164 @@ def update_entries(csv_data):
 
         # Update each entry with "H: height D: diameter" format
         if height_index < len(csv_data) and diameter_index < len(csv_data):
-            entry_text = "H: {:.2f} M  D: {:.2f} M".format(csv_data[height_index], csv_data[diameter_index])
+            if csv_data[diameter_index] is None:
+                entry_text = "H: {:.2f} M  D: n/a".format(csv_data[height_index])
+            else:
+                entry_text = "H: {:.2f} M  D: {:.2f} M".format(csv_data[height_index], csv_data[diameter_index])
             all_measurement_entries[i].delete(0, tk.END)
             all_measurement_entries[i].insert(0, entry_text)
 
+def update_quick_dbh_entries(file_path, preview):
+    """
+    Clears the GUI entries and shows the quick DBH preview in the DBH cookie, with its confidence.
+
+    Parameters:
+    file_path (str): The path of the previewed scan.
+    preview (dict): The preview returned by quick_dbh(), or None if no stem was found.
+    """
+    for entry in dbh_height_group + main_taper_group:
+        entry.delete(0, tk.END)
+    for field in tree_information_fields:
+        entries[field].delete(0, tk.END)
+
+    entries["Tree Name"].insert(0, os.path.splitext(os.path.basename(file_path))[0])
+    if preview is None:
+        dbh_height_group[3].insert(0, "H: 1.30 M  D: n/a")
+    else:
+        dbh_height_group[3].insert(0, "H: 1.30 M  D: {:.2f} M ({:.0%})".format(preview['dbh'], preview['confidence']))
+
 def update_status(message):
     status_label.config(text=message)
     
 ## Tkinter window
 
-root = tk.Tk()
-root.title("Pinecone Project")
-
-window_width = 650
-window_height = 700
-root.geometry(f"{window_width}x{window_height}")
-
-screen_width = root.winfo_screenwidth()
-screen_height = root.winfo_screenheight()
-center_x = int((screen_width - window_width) / 2)
-center_y = int((screen_height - window_height) / 2)
-root.geometry(f"{window_width}x{window_height}+{center_x}+{center_y}")
-
-file_path_frame = tk.Frame(root)
-file_path_frame.pack(side="top", fill="x")
-
-status_label = tk.Label(file_path_frame, text="Ready", font=("Arial", 12))
-status_label.pack(side="top", fill="x", pady=10)
-
-file_path_label = tk.Label(file_path_frame, text="File Path:", font=("Arial", 12))
-file_path_label.pack(side="top", fill="x", pady=10)
-
-button_frame = tk.Frame(root)
-button_frame.pack(side="top", pady=20)
-
-browse_button = tk.Button(button_frame, text="Browse", command=browse_file, font=("Arial", 12))
-browse_button.pack(side="left", padx=10)
-
-process_button = tk.Button(button_frame, text="Process File", command=process_file, font=("Arial", 12), state="disabled")
-process_button.pack(side="left", padx=10)
-
-visualize_button = tk.Button(button_frame, text="Visualize File", command=visualize_file, font=("Arial", 12), state="disabled")
-visualize_button.pack(side="left", padx=10)
-
-process_and_visualize_button = tk.Button(button_frame, text="Process and Visualize File", command=process_and_visualize_file, font=("Arial", 12), state="disabled")
-process_and_visualize_button.pack(side="left", padx=10)
-
-# Group box for tree overview
-tree_information_group = tk.LabelFrame(root, text="Tree Information", padx=10, pady=10)
-tree_information_group.pack(side="top", fill="x", padx=20, pady=10)
-
-tree_information_fields = ["Tree Name", "Tree Height", "Increment", "Est Volume"]
-entries = {}
-for i, field in enumerate(tree_information_fields):
-    row = i // 2
-    col = i % 2
-    label = tk.Label(tree_information_group, text=f"{field}:", font=("Arial", 12))
-    label.grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
-    entry = tk.Entry(tree_information_group, bg="lightgrey", font=("Arial", 12))
-    entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
-    entries[field] = entry
-
-# Configure columns to have uniform weight
-tree_information_group.grid_columnconfigure((0, 1), weight=1)
-
-# First group box for DBH entries representing the 3 heights below dbh, and dbh
-dbh_group = LabelFrame(root, text="DBH", padx=10, pady=10)
-dbh_group.pack(side="top", fill="x", padx=20, pady=10)
-
-dbh_height_group = []
-for i in range(1, 5):
-    row = (i-1) // 2
-    col = (i-1) % 2
-    tk.Label(dbh_group, text=f"Cookie {i}:", font=("Arial", 12)).grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
-    entry = tk.Entry(dbh_group, bg="lightgrey", font=("Arial", 12))
-    entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
-    dbh_height_group.append(entry)
-
-# Configure columns to have uniform weight
-dbh_group.grid_columnconfigure((0, 1), weight=1)
-
-# Second group box for main taper to represent the 9 measurable cookies
-taper_group = LabelFrame(root, text="Main Taper", padx=10, pady=10)
-taper_group.pack(side="top", fill="x", padx=20, pady=10)
-
-main_taper_group = []
-for i in range(5, 14):
-    row = (i-1) // 2
-    col = (i-1) % 2
-    tk.Label(taper_group, text=f"Cookie {i}:", font=("Arial", 12)).grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
-    entry = tk.Entry(taper_group, bg="lightgrey", font=("Arial", 12))
-    entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
-    main_taper_group.append(entry)
-
-# Configure columns to have uniform weight
-taper_group.grid_columnconfigure((0, 1), weight=1)
-
-root.mainloop()
\ No newline at end of file
+# Tiling and batch processing start worker processes that import this module, only the main process opens the window
+if __name__ == "__main__":
+    # Lets the worker processes of a frozen Windows executable start instead of opening another window
+    multiprocessing.freeze_support()
+
+    root = tk.Tk()
+    root.title("Pinecone Project")
+
+    window_width = 780
+    window_height = 950
+    root.geometry(f"{window_width}x{window_height}")
+
+    screen_width = root.winfo_screenwidth()
+    screen_height = root.winfo_screenheight()
+    center_x = int((screen_width - window_width) / 2)
+    center_y = int((screen_height - window_height) / 2)
+    root.geometry(f"{window_width}x{window_height}+{center_x}+{center_y}")
+
+    file_path_frame = tk.Frame(root)
+    file_path_frame.pack(side="top", fill="x")
+
+    status_label = tk.Label(file_path_frame, text="Ready", font=("Arial", 12))
+    status_label.pack(side="top", fill="x", pady=10)
+
+    file_path_label = tk.Label(file_path_frame, text="File Path:", font=("Arial", 12))
+    file_path_label.pack(side="top", fill="x", pady=10)
+
+    button_frame = tk.Frame(root)
+    button_frame.pack(side="top", pady=20)
+
+    browse_button = tk.Button(button_frame, text="Browse", command=browse_file, font=("Arial", 12))
+    browse_button.pack(side="left", padx=10)
+
+    process_button = tk.Button(button_frame, text="Process File", command=process_file, font=("Arial", 12), state="disabled")
+    process_button.pack(side="left", padx=10)
+
+    visualize_button = tk.Button(button_frame, text="Visualize File", command=visualize_file, font=("Arial", 12), state="disabled")
+    visualize_button.pack(side="left", padx=10)
+
+    process_and_visualize_button = tk.Button(button_frame, text="Process and Visualize File", command=process_and_visualize_file, font=("Arial", 12), state="disabled")
+    process_and_visualize_button.pack(side="left", padx=10)
+
+    quick_dbh_button = tk.Button(button_frame, text="Quick DBH", command=quick_dbh_file, font=("Arial", 12), state="disabled")
+    quick_dbh_button.pack(side="left", padx=10)
+
+    settings_frame = tk.Frame(root)
+    settings_frame.pack(side="top")
+
+    tk.Label(settings_frame, text="Threads:", font=("Arial", 12)).pack(side="left", padx=(10, 2))
+    threads_spinbox = tk.Spinbox(settings_frame, from_=1, to=get_cpu_count(), width=5, font=("Arial", 12))
+    threads_spinbox.delete(0, tk.END)
+    threads_spinbox.insert(0, get_cpu_count())
+    threads_spinbox.pack(side="left", padx=(2, 10))
+
+    results_button = tk.Button(settings_frame, text="Open Results", command=open_results, font=("Arial", 12))
+    results_button.pack(side="left", padx=10)
+
+    # Group box for tree overview
+    tree_information_group = tk.LabelFrame(root, text="Tree Information", padx=10, pady=10)
+    tree_information_group.pack(side="top", fill="x", padx=20, pady=10)
+
+    tree_information_fields = ["Tree Name", "Tree Height", "Increment", "Est Volume"]
+    entries = {}
+    for i, field in enumerate(tree_information_fields):
+        row = i // 2
+        col = i % 2
+        label = tk.Label(tree_information_group, text=f"{field}:", font=("Arial", 12))
+        label.grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
+        entry = tk.Entry(tree_information_group, bg="lightgrey", font=("Arial", 12))
+        entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
+        entries[field] = entry
+
+    # Configure columns to have uniform weight
+    tree_information_group.grid_columnconfigure((0, 1), weight=1)
+
+    # First group box for DBH entries representing the 3 heights below dbh, and dbh
+    dbh_group = LabelFrame(root, text="DBH", padx=10, pady=10)
+    dbh_group.pack(side="top", fill="x", padx=20, pady=10)
+
+    dbh_height_group = []
+    for i in range(1, 5):
+        row = (i-1) // 2
+        col = (i-1) % 2
+        tk.Label(dbh_group, text=f"Cookie {i}:", font=("Arial", 12)).grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
+        entry = tk.Entry(dbh_group, bg="lightgrey", font=("Arial", 12))
+        entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
+        dbh_height_group.append(entry)
+
+    # Configure columns to have uniform weight
+    dbh_group.grid_columnconfigure((0, 1), weight=1)
+
+    # Second group box for main taper to represent the 9 measurable cookies
+    taper_group = LabelFrame(root, text="Main Taper", padx=10, pady=10)
+    taper_group.pack(side="top", fill="x", padx=20, pady=10)
+
+    main_taper_group = []
+    for i in range(5, 14):
+        row = (i-1) // 2
+        col = (i-1) % 2
+        tk.Label(taper_group, text=f"Cookie {i}:", font=("Arial", 12)).grid(row=row, column=col*2, sticky="e", padx=(5, 2), pady=5)
+        entry = tk.Entry(taper_group, bg="lightgrey", font=("Arial", 12))
+        entry.grid(row=row, column=col*2+1, sticky="ew", padx=(2, 5), pady=5)
+        main_taper_group.append(entry)
+
+    # Configure columns to have uniform weight
+    taper_group.grid_columnconfigure((0, 1), weight=1)
+
+    # Results table of a whole run, paged so only RESULTS_PAGE_SIZE rows exist as items at any time
+    results_group = LabelFrame(root, text="Results", padx=10, pady=10)
+    results_group.pack(side="top", fill="both", expand=True, padx=20, pady=10)
+
+    results_tree = ttk.Treeview(results_group, columns=[column for column, _ in RESULTS_COLUMNS], show="headings", height=8, selectmode="browse")
+    for column, heading in RESULTS_COLUMNS:
+        results_tree.heading(column, text=heading, command=lambda column=column: sort_results(column))
+        results_tree.column(column, width=110, anchor="e" if column != "tree_name" else "w")
+    results_scrollbar = ttk.Scrollbar(results_group, orient="vertical", command=results_tree.yview)
+    results_tree.configure(yscrollcommand=results_scrollbar.set)
+    results_tree.bind("<<TreeviewSelect>>", select_result)
+    results_tree.grid(row=0, column=0, columnspan=3, sticky="nsew")
+    results_scrollbar.grid(row=0, column=3, sticky="ns")
+
+    tk.Button(results_group, text="< Previous", command=lambda: change_results_page(-1), font=("Arial", 10)).grid(row=1, column=0, sticky="w", pady=(5, 0))
+    results_page_label = tk.Label(results_group, text="No results loaded", font=("Arial", 10))
+    results_page_label.grid(row=1, column=1, pady=(5, 0))
+    tk.Button(results_group, text="Next >", command=lambda: change_results_page(1), font=("Arial", 10)).grid(row=1, column=2, sticky="e", pady=(5, 0))
+
+    results_group.grid_columnconfigure(1, weight=1)
+    results_group.grid_rowconfigure(0, weight=1)
+
+    root.mainloop()